@@ -1,84 +1,403 @@
 import uvicorn
 import pandas as pd
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-import shutil
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+import asyncio
+import contextvars
 import os
+import time
+from functools import partial
 
 
-from query_parser import get_operation, execute_llm_function
+from query_parser import aget_operation, aget_operations, run_llm_function, serialize_result, uses_second_dataset, call_compiler
+import excel_functions
+from translation_cache import translation_cache
+from dataset_versions import dataset_versions
+import serialization
+import column_index
+import ingest
+from out_of_core import ChunkedDataset, page_rows
+from prompt_builder import prompt_stats, usage_headers
+from metrics import metrics, span, rows, start_profile, profile_header
+from workers import executor, run_in_worker, EXECUTION_TIMEOUT
+from workbook_cache import workbook_cache
+from dataset_registry import dataset_registry, UPLOAD_DIRECTORY, DEFAULT_DATASET
 
 app = FastAPI()
 
-UPLOAD_DIRECTORY = "./uploads"
-
 # Creating the dynamic directory
 os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)  # For saving the uploaded files
 
-# Creating the DataFrame for the data manipulation
-df = pd.DataFrame()
-df_unstruct = pd.DataFrame()
-df_2 = pd.DataFrame() 
+# The DataFrames for the data manipulation are served per dataset by the dataset registry
+
+def load_dataset(dataset_id, sheet_name, version_id=None):
+    '''
+    This function is used to get the DataFrame an operation runs on: a given version of the dataset, or else the current version of the uploaded sheet
+
+    Args:
+    dataset_id: The ID of the dataset
+    sheet_name: The name or the position of the sheet
+    version_id: The ID of the dataset version to chain on
+
+    Returns:
+    tuple: The DataFrame and its version ID
+    '''
+    with span("load", sheet=sheet_name, version_id=version_id) as attributes:
+        dataset = dataset_registry.get(dataset_id)
+        if version_id:
+            df = dataset_versions.get(version_id, owner=dataset.dataset_id)
+        else:
+            df = dataset.load_sheet(sheet_name)
+            root_id = f"{dataset.dataset_id}-{dataset.content_hash()[:16]}-{sheet_name}"
+            version_id = dataset_versions.register(df, version_id=root_id, owner=dataset.dataset_id)
+        attributes["rows_out"] = len(df)
+        return df, version_id
+
+def execute_versioned(dataset_id, df, version_id, function_call_str, overrides=None):
+    '''
+    This function is used to execute the function call and register a table result (a DataFrame, or a ChunkedDataset out of core) as a new version derived from the input
+
+    Args:
+    dataset_id: The ID of the dataset
+    df: The dataset
+    version_id: The version ID of the dataset
+    function_call_str: The function call to execute
+    overrides: The request-level overrides of the functions
+
+    Returns:
+    tuple: The raw output and the version ID of the result (the input version if the result is not a table)
+    '''
+    # The second workbook is only loaded for the calls using it (e.g. joins)
+    df2 = None
+    if uses_second_dataset(function_call_str):
+        df2 = dataset_registry.get(dataset_id).load_sheet(0, "second")
+    result = run_llm_function(df, function_call_str, overrides, df2)
+    if isinstance(result, (pd.DataFrame, ChunkedDataset)):
+        version_id = dataset_versions.register(result, parent_id=version_id, owner=dataset_id or DEFAULT_DATASET)
+    return result, version_id
+
+def render_result(result, version_id, response, format="json", limit=None, offset=0):
+    '''
+    This function is used to serialize the output of an operation, streaming or paginating DataFrame results when requested. The JSON of a ChunkedDataset result is always paginated, by out_of_core.page_rows rows unless a limit is given
+
+    Args:
+    result: The raw output of the operation
+    version_id: The version ID of the result
+    response: The response, used for the headers of the non-streaming formats
+    format: 'json' (default), 'ndjson' or 'arrow'
+    limit: The number of rows of the page, None for all the rows
+    offset: The first row of the page
+
+    Returns:
+    The serialized output, or a StreamingResponse for the 'ndjson' and 'arrow' formats
+    '''
+    if format not in serialization.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format '{format}'. Choose from {list(serialization.FORMATS)}")
+    headers = {"X-Dataset-Version": version_id}
+    if isinstance(result, ChunkedDataset) and format == "json" and limit is None:
+        limit = page_rows(result)
+    elif not isinstance(result, (pd.DataFrame, ChunkedDataset)) or (format == "json" and limit is None and not offset):
+        response.headers.update(headers)
+        return serialize_result(result)
+
+    page, next_cursor = serialization.paginate(result, version_id, limit, offset)
+    if format == "json":
+        response.headers.update(headers)
+        return {
+            **result.attrs,
+            "data": serialization.to_records(page),
+            "total_rows": len(result),
+            "next_cursor": next_cursor
+        }
+
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    headers["X-Total-Rows"] = str(len(result))
+    stream = serialization.iter_ndjson(page) if format == "ndjson" else serialization.iter_arrow(page)
+    return StreamingResponse(stream, media_type=serialization.MEDIA_TYPES[format], headers=headers)
+
+def serialize_stage(result, version_id, response, format="json", limit=None, offset=0):
+    '''
+    This function is used to run render_result in the 'serialize' timing span of the request
+
+    Args:
+    result: The raw output of the operation
+    version_id: The version ID of the result
+    response: The response, used for the headers of the non-streaming formats
+    format: 'json', 'ndjson' or 'arrow'
+    limit: The number of rows of the page, None for all the rows
+    offset: The first row of the page
+
+    Returns:
+    The serialized output, or a StreamingResponse for the 'ndjson' and 'arrow' formats
+    '''
+    with span("serialize", format=format, rows_in=rows(result)):
+        return render_result(result, version_id, response, format, limit, offset)
+
+def execute_batch(dataset_id, df, version_id, function_calls, limit=None):
+    '''
+    This function is used to execute the distinct function calls of a batch once each, the calls filtering on the same column value sharing the filtered rows
+
+    Args:
+    dataset_id: The ID of the dataset
+    df: The dataset
+    version_id: The version ID of the dataset
+    function_calls: The distinct function calls to execute
+    limit: The number of rows returned per table result, None for all the rows (for a page of a ChunkedDataset, see out_of_core.page_rows)
+
+    Returns:
+    dict: The status, the serialized output (or the error detail), the version ID of the result and the execution time of each call
+    '''
+    outcomes = {}
+    with column_index.shared_selections():
+        for function_call_str in function_calls:
+            start = time.perf_counter()
+            try:
+                result, result_version = execute_versioned(dataset_id, df, version_id, function_call_str)
+                if isinstance(result, ChunkedDataset) or (isinstance(result, pd.DataFrame) and limit is not None):
+                    page, next_cursor = serialization.paginate(result, result_version, limit or page_rows(result))
+                    output = {**result.attrs, "data": serialization.to_records(page), "total_rows": len(result), "next_cursor": next_cursor}
+                else:
+                    output = serialize_result(result)
+                outcomes[function_call_str] = (200, output, result_version, time.perf_counter() - start)
+            except HTTPException as e:
+                outcomes[function_call_str] = (e.status_code, e.detail, version_id, time.perf_counter() - start)
+            except Exception as e:
+                outcomes[function_call_str] = (500, f"An error occurred: {str(e)}", version_id, time.perf_counter() - start)
+    return outcomes
+
+async def run_operation(dataset_id, sheet_name, user_input, version_id, response, overrides=None, format="json", limit=None, offset=0):
+    '''
+    This function is used to translate the user input and execute it on the dataset
+
+    Args:
+    dataset_id: The ID of the dataset
+    sheet_name: The name or the position of the sheet
+    user_input: The user input
+    version_id: The ID of the dataset version to chain on
+    response: The response, the version ID of the result is returned in the X-Dataset-Version header and the prompt tokens spent translating the input in the X-Prompt-Tokens header
+    overrides: The request-level overrides of the functions
+    format: The serialization of a DataFrame result, 'json', 'ndjson' or 'arrow'
+    limit: The number of rows of the first page, None for all the rows
+    offset: The first row of the page
+
+    Returns:
+    The output of the operation
+    '''
+    df, version_id = await run_in_worker(load_dataset, dataset_id, sheet_name, version_id)
+    usage = prompt_stats.track()
+    function_call_str = await aget_operation(df, user_input)
+    try:
+        result, result_version = await run_in_worker(execute_versioned, dataset_id, df, version_id, function_call_str, overrides)
+    except HTTPException:
+        translation_cache.discard(user_input, df.columns)
+        raise
+    rendered = await run_in_worker(serialize_stage, result, result_version, response, format, limit, offset)
+    (rendered.headers if isinstance(rendered, StreamingResponse) else response.headers).update(usage_headers(usage))
+    return rendered
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    '''
+    This function is used to time every request, count it by route and status, and return its profile in the X-Profile header when the request sends an X-Profile header
+
+    Args:
+    request: The request
+    call_next: The endpoint
+
+    Returns:
+    The response
+    '''
+    profile = start_profile()
+    start = time.perf_counter()
+    response = await call_next(request)
+    seconds = time.perf_counter() - start
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    metrics.requests.inc(route=route, status=response.status_code)
+    metrics.request_seconds.observe(seconds, route=route)
+    size = response.headers.get("content-length")
+    if size is not None:
+        metrics.response_bytes.observe(int(size), route=route)
+    if request.headers.get("X-Profile"):
+        response.headers["X-Profile"] = profile_header(profile, seconds, int(size) if size is not None else None)
+    return response
 
 @app.get("/")
 def home():
     return {"data": "Fast API works"}
 
-@app.post("/upload")
-async def upload_excel_file(excel_file: UploadFile = File(...)):
+@app.get("/cache-stats")
+def cache_stats():
+    '''
+    This function is used to get the hit/miss counters of the workbook and translation caches
+
+    Returns:
+    dict: The statistics of the caches
     '''
-    This function is used to upload the excel file
+    return {
+        "workbook_cache": workbook_cache.stats(),
+        "translation_cache": translation_cache.stats(),
+        "compiled_calls": call_compiler.stats(),
+        "prompts": prompt_stats.stats(),
+        "dataset_versions": dataset_versions.stats(),
+        "dataset_registry": dataset_registry.stats(),
+        "upload_jobs": ingest.ingest_jobs.stats()
+    }
+
+async def ingest_upload(dataset, workbook, excel_file, sheet_names, engine=None, chunked=None):
+    '''
+    This function is used to stream an uploaded workbook to storage and start its parse as a background job
 
     Args:
-    excel_file: The excel file to be uploaded
+    dataset: The dataset the workbook is uploaded to
+    workbook: 'main' or 'second'
+    excel_file: The uploaded excel file
+    sheet_names: The sheets to parse
+    engine: The engine used to parse the excel file
+    chunked: Whether to ingest the file out of core, None to decide from its size
 
     Returns:
-    dict: The response message and the number of rows in the uploaded file
+    tuple: The job and the future of its parsed sheets
+    '''
+    job = ingest.ingest_jobs.create(dataset.dataset_id, workbook)
+    tmp_path = await ingest.receive(excel_file, dataset.workbook_path(workbook), job)
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return job, loop.run_in_executor(executor, context.run, ingest.run, job, dataset, tmp_path, sheet_names, engine, chunked)
+
+async def wait_for_job(job, future):
+    '''
+    This function is used to wait for the parse of an uploaded workbook
+
+    Args:
+    job: The ingestion job
+    future: The future of its parsed sheets
+
+    Returns:
+    dict: The parsed sheets
     '''
     try:
-        upload_file_path = os.path.join(UPLOAD_DIRECTORY, "file1.xlsx")
+        # The job keeps running if the request times out, its outcome stays available on /upload-status
+        sheets = await asyncio.wait_for(asyncio.shield(future), timeout=EXECUTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"The file is still being parsed, follow /upload-status/{job.job_id}.")
+    if sheets is None:
+        raise HTTPException(status_code=400, detail=job.error)
+    return sheets
+
+def job_accepted(job):
+    '''
+    This function is used to build the response of an upload whose parse runs in the background
+
+    Args:
+    job: The ingestion job
+
+    Returns:
+    dict: The response message, the job ID and status and the URL of its status
+    '''
+    return {
+        "message": "File received, parsing in the background",
+        "dataset_id": job.dataset_id,
+        "job_id": job.job_id,
+        "status": job.status,
+        "status_url": f"/upload-status/{job.job_id}"
+    }
+
+@app.get("/metrics")
+def prometheus_metrics():
+    '''
+    This function is used to get the request and stage metrics and the cache statistics in the Prometheus text format
 
-        with open(upload_file_path, "wb") as buffer:
-            shutil.copyfileobj(excel_file.file, buffer)
+    Returns:
+    The metrics
+    '''
+    return PlainTextResponse(metrics.render(cache_stats()), media_type="text/plain; version=0.0.4")
 
-        global df, df_unstruct
-        df = pd.read_excel(upload_file_path)
-        df_unstruct = pd.read_excel(upload_file_path, sheet_name='Unstructured_Data')
+@app.post("/upload")
+async def upload_excel_file(excel_file: UploadFile = File(...), engine: str = Form(None), dataset_id: str = Form(DEFAULT_DATASET), wait: bool = Form(False), chunked: bool = Form(None)):
+    '''
+    This function is used to upload the excel file. The file is streamed to storage and parsed in the background, unless `wait` is set
+
+    Args:
+    excel_file: The excel file to be uploaded
+    engine: The engine used to parse the excel file (e.g. 'calamine' or 'openpyxl'), defaults to the EXCEL_ENGINE setting
+    dataset_id: The dataset (e.g. a session ID) the file is uploaded to, created if it does not exist
+    wait: Whether to wait for the file to be parsed
+    chunked: Whether to ingest the file out of core (its sheets stay on disk and are processed in chunks), defaults to the files of OUT_OF_CORE_MIN_BYTES or more
+
+    Returns:
+    dict: The job ID and the URL of its status, or once parsed the response message, the number of rows in the uploaded file, and the parse time and the memory per column (before and after the dtype optimization) of each sheet
+    '''
+    try:
+        dataset = dataset_registry.get(dataset_id, create=True)
+        job, future = await ingest_upload(dataset, "main", excel_file, [0, 'Unstructured_Data'], engine, chunked)
+        if not wait:
+            return job_accepted(job)
+        sheets = await wait_for_job(job, future)
+        df = sheets[0]
+        df_unstruct = sheets['Unstructured_Data']
 
         return {
             "message": "File uploaded successfully",
+            "dataset_id": dataset.dataset_id,
+            "job_id": job.job_id,
             "length": df.shape[0],
-            "length_unstruct": df_unstruct.shape[0]
+            "length_unstruct": df_unstruct.shape[0],
+            "parse_seconds": job.result["parse_seconds"],
+            "memory": job.result["memory"]
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while uploading the file: {str(e)}")
 
 @app.post("/upload-second")
-async def upload_second_excel_file(excel_file: UploadFile = File(...)):
+async def upload_second_excel_file(excel_file: UploadFile = File(...), dataset_id: str = Form(DEFAULT_DATASET), wait: bool = Form(False), chunked: bool = Form(None)):
     '''
-    This function is used to upload the excel file for the operations like join
+    This function is used to upload the excel file for the operations like join. The file is streamed to storage and parsed in the background, unless `wait` is set
 
     Args:
     excel_file: The excel file to be uploaded
+    dataset_id: The dataset (e.g. a session ID) the file is uploaded to, created if it does not exist
+    wait: Whether to wait for the file to be parsed
+    chunked: Whether to ingest the file out of core, defaults to the files of OUT_OF_CORE_MIN_BYTES or more
 
     Returns:
-    dict: The response message and the number of rows in the uploaded file
+    dict: The job ID and the URL of its status, or once parsed the response message, the number of rows in the uploaded file and its memory per column before and after the dtype optimization
     '''
     try:
-        upload_file_path = os.path.join(UPLOAD_DIRECTORY, "file2.xlsx")
-
-        with open(upload_file_path, "wb") as buffer:
-            shutil.copyfileobj(excel_file.file, buffer)
-
-        global df_2
-        df_2 = pd.read_excel(upload_file_path)
+        dataset = dataset_registry.get(dataset_id, create=True)
+        job, future = await ingest_upload(dataset, "second", excel_file, [0], chunked=chunked)
+        if not wait:
+            return job_accepted(job)
+        sheets = await wait_for_job(job, future)
+        df_2 = sheets[0]
 
         return {
             "message": "File uploaded successfully",
+            "dataset_id": dataset.dataset_id,
+            "job_id": job.job_id,
             "length": df_2.shape[0],
+            "memory": job.result["memory"]
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while uploading the file: {str(e)}")
 
+@app.get("/upload-status/{job_id}")
+def upload_status(job_id: str):
+    '''
+    This function is used to get the status of the parse of an uploaded file
+
+    Args:
+    job_id: The ID of the upload job
+
+    Returns:
+    dict: The status of the job ('receiving', 'queued', 'parsing', 'done' or 'failed'), with the number of rows, the parse time and the memory of each sheet once done, or the error if it failed
+    '''
+    return ingest.ingest_jobs.get(job_id).to_dict()
+
 @app.post("/query")
 def query_by_user(user_input: str = Form(...)):
     '''
@@ -96,43 +415,126 @@ def query_by_user(user_input: str = Form(...)):
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 @app.post("/operate")
-def operate(user_input: str = Form(...)):
+async def operate(response: Response, user_input: str = Form(...), dataset_id: str = Form(DEFAULT_DATASET), version_id: str = Form(None), format: str = Form("json"), limit: int = Form(None), offset: int = Form(0)):
     '''
     This function is used to get the user input and return the response
 
     Args:
     user_input: The user input
+    dataset_id: The dataset to run the operation on
+    version_id: The dataset version to run the operation on (the X-Dataset-Version header of a previous response), defaults to the uploaded sheet
+    format: The serialization of a table result, 'json' (default), 'ndjson' or 'arrow' (the last two are streamed)
+    limit: The number of rows of the first page of a table result, the following pages are read from /results with the returned cursor
+    offset: The first row of the page
 
     Returns:
     dict: The response of the operation that user has requested
     '''
     try:
-        response = get_operation(df, user_input)
-        print(response)
-        out = execute_llm_function(df, response)
-        return out
+        return await run_operation(dataset_id, 0, user_input, version_id, response, None, format, limit, offset)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 @app.post("/operate-unstruct")
-def operate_unstruct(user_input: str = Form(...)):
+async def operate_unstruct(response: Response, user_input: str = Form(...), dataset_id: str = Form(DEFAULT_DATASET), sentiment_backend: str = Form(None), version_id: str = Form(None), format: str = Form("json"), limit: int = Form(None), offset: int = Form(0)):
     '''
     This function is used to get the user input and return the response
 
     Args:
     user_input: The user input
+    dataset_id: The dataset to run the operation on
+    sentiment_backend: The default sentiment backend of the request, 'llm' or 'lexicon'
+    version_id: The dataset version to run the operation on (the X-Dataset-Version header of a previous response), defaults to the uploaded sheet
+    format: The serialization of a table result, 'json' (default), 'ndjson' or 'arrow' (the last two are streamed)
+    limit: The number of rows of the first page of a table result, the following pages are read from /results with the returned cursor
+    offset: The first row of the page
 
     Returns:
     dict: The response of the operation that user has requested
     '''
     try:
-        df_unstruct = pd.read_excel("./uploads/file1.xlsx", sheet_name='Unstructured_Data')
-        response = get_operation(df_unstruct, user_input)
-        print(response)
-        out = execute_llm_function(df_unstruct, response)
-        return out
+        overrides = None
+        if sentiment_backend:
+            overrides = {"get_sentiment": partial(excel_functions.get_sentiment, backend=sentiment_backend)}
+        return await run_operation(dataset_id, 'Unstructured_Data', user_input, version_id, response, overrides, format, limit, offset)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
+@app.post("/operate-batch")
+async def operate_batch(queries: list[str] = Form(...), dataset_id: str = Form(DEFAULT_DATASET), version_id: str = Form(None), limit: int = Form(None)):
+    '''
+    This function is used to run many queries on the same dataset in one request, e.g. the widgets of a dashboard
+
+    Args:
+    queries: The user inputs, one form field per query
+    dataset_id: The dataset to run the operations on
+    version_id: The dataset version to run the operations on, defaults to the uploaded sheet
+    limit: The number of rows returned per table result, the following pages are read from /results with the returned cursor
+
+    Returns:
+    dict: The result of each query in order, with its function call, status, timings and result version, and the LLM calls and prompt tokens of the batch
+    '''
+    try:
+        start = time.perf_counter()
+        df, version_id = await run_in_worker(load_dataset, dataset_id, 0, version_id)
+        usage = prompt_stats.track()
+        translations = await aget_operations(df, queries)
+        function_calls = list(dict.fromkeys(call for call, _ in translations.values() if isinstance(call, str)))
+        outcomes = await run_in_worker(execute_batch, dataset_id, df, version_id, function_calls, limit)
+
+        results = []
+        for query in queries:
+            call, translate_seconds = translations[query]
+            item = {"query": query, "translate_seconds": round(translate_seconds, 4)}
+            if isinstance(call, HTTPException):
+                item.update(status=call.status_code, detail=call.detail)
+            else:
+                status, output, result_version, execute_seconds = outcomes[call]
+                item.update(call=call, status=status, execute_seconds=round(execute_seconds, 4), version_id=result_version)
+                if status == 200:
+                    item["result"] = output
+                else:
+                    translation_cache.discard(query, df.columns)
+                    item["detail"] = output
+            results.append(item)
+        return {
+            "results": results,
+            "distinct_calls": len(function_calls),
+            "prompt_usage": usage,
+            "seconds": round(time.perf_counter() - start, 4)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+@app.get("/results")
+async def read_results(response: Response, dataset_id: str = DEFAULT_DATASET, cursor: str = None, version_id: str = None, format: str = "json", limit: int = None, offset: int = 0):
+    '''
+    This function is used to page through a table result without running the operation again
+
+    Args:
+    dataset_id: The dataset the result belongs to
+    cursor: The cursor of the next page returned by a previous response (next_cursor or the X-Next-Cursor header)
+    version_id: The dataset version to read, when no cursor is given
+    format: 'json' (default), 'ndjson' or 'arrow'
+    limit: The number of rows of the page, defaults to the limit of the cursor
+    offset: The first row of the page, when no cursor is given
+
+    Returns:
+    The page of the result
+    '''
+    if cursor:
+        version_id, offset, cursor_limit = serialization.decode_cursor(cursor)
+        limit = limit or cursor_limit
+    if not version_id:
+        raise HTTPException(status_code=400, detail="Provide a 'cursor' or a 'version_id'.")
+    df = dataset_versions.get(version_id, owner=dataset_registry.get(dataset_id).dataset_id)
+    return await run_in_worker(render_result, df, version_id, response, format, limit, offset)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,468 @@
+# Benchmark of the engine on synthetic workbooks.
+#
+# Generates workbooks with the schema of Genrated_dataset.xlsx (plus two date columns, so the date operations can be
+# measured) and its unstructured review sheet at several sizes, and a second workbook for the joins. For each size it
+# uploads the workbooks, runs every operation directly on the loaded sheet, then runs the /operate, /operate-unstruct
+# and /operate-batch endpoints in-process, with a local stub in place of the LLM returning canned function calls.
+# Latency percentiles, throughput and peak memory are written to a JSON file, which can be compared with the file of
+# a previous run (e.g. of another commit) with --compare.
+#
+# Usage: python benchmark.py --rows 10000 100000 1000000 --output benchmark_results.json
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_ROWS = [10000, 100000, 1000000]
+DEFAULT_REPEAT = 5
+SEED = 42
+
+DEPARTMENTS = ["HR", "Marketing", "Sales", "Finance", "IT"]
+EDUCATION_LEVELS = ["High School", "Bachelor", "Master", "PhD"]
+LOCATIONS = ["New York", "Los Angeles", "Chicago", "Houston", "Miami"]
+REVIEWS = [
+    "Terrible experience, would not recommend.", "The quality was below expectations.", "User-friendly and easy to use.",
+    "Great product, exceeded my expectations.", "Delivery was late and the box was damaged.", "Works as described.",
+    "Customer support was very helpful.", "Not worth the price.", "Average quality, nothing special.", "Absolutely love it!",
+]
+COMPLAINTS = ["Tracking details were not updated.", "Wrong size sent.", "Refund process took too long.", "Item arrived broken.", "No complaints."]
+FEEDBACK = ["Good value for money.", "Product exceeded expectations.", "Not as described on the website.", "Stylish and durable.", "Too expensive."]
+SUGGESTIONS = ["Increase product availability.", "Provide better warranty coverage.", "Improve packaging.", "Offer faster shipping.", "Add more colors."]
+
+# Canned translations of the stub LLM: query -> function call, for the main and the unstructured sheet
+OPERATIONS = {
+    "multiply the salary by itself": "maths_operations_on_same_col('multiply', df, 'Salary')",
+    "salary plus project count": "maths_operations_on_diff_cols('add', df, 'Salary', 'Project_Count')",
+    "summary report of the numbers": "calculate_summary_report(df)",
+    "total salary in IT": "sum_with_filter(df, 'Department', 'IT', 'Salary')",
+    "average salary in Finance": "avg_with_filter(df, 'Department', 'Finance', 'Salary')",
+    "mean and max salary and age per department and location": "group_aggregate(df, ['Department', 'Location'], ['Salary', 'Age'], ['mean', 'max'])",
+    "overall average salary": "total_avg(df, 'Salary')",
+    "age range": "min_max_values(df, 'Age')",
+    "people in Miami": "filter_data(df, 'Location', 'Miami')",
+    "salary pivot by department and education": "pivot_table(df, 'Department', 'Education_Level', 'Salary')",
+    "unpivot salary and age": "unpivot_table(df, ['Salary', 'Age'])",
+    "year month and day of joining": "date_operations(df, 'Joining_Date')",
+    "days from joining to last promotion": "date_difference(df, 'Joining_Date', 'Last_Promotion_Date', 'Days_To_Promotion')",
+    "join with the bonus file": "join_datasets(df, df2, 'inner', 'ID')",
+    "average HR salary per location": "filter_data(df, 'Department', 'HR')\ngroup_aggregate(result, 'Location', 'Salary', 'mean')",
+}
+UNSTRUCTURED_OPERATIONS = {
+    "quick sentiment of the reviews": "get_sentiment(df, 'Customer_Review', 'lexicon')",
+    "sentiment of the reviews": "get_sentiment(df, 'Customer_Review', 'llm')",
+}
+SENTIMENT_PROMPT = re.compile(r"following (\d+) numbered text entries")
+
+
+class StubMessage:
+    '''
+    Description: The response of the stub LLM.
+    '''
+
+    def __init__(self, content):
+        self.content = content
+        self.usage_metadata = None
+
+
+class StubLLM:
+    '''
+    Description: Local stand-in for the chat model, answering the translation prompts with the canned function calls and the sentiment prompts with neutral labels, after an optional simulated latency.
+    '''
+    model_name = "benchmark-stub"
+
+    def __init__(self, calls, latency=0.0):
+        self.calls = calls
+        self.latency = latency
+        self.prompts = 0
+
+    def answer(self, prompt):
+        '''
+        Description: This function returns the canned answer to a prompt.
+
+        Args:
+        prompt (str): The prompt.
+
+        Returns:
+        str: The answer.
+        '''
+        sentiment = SENTIMENT_PROMPT.search(prompt)
+        if sentiment:
+            return json.dumps(["Neutral"] * int(sentiment.group(1)))
+        if "User Queries:\n" in prompt:
+            numbered = prompt.split("User Queries:\n", 1)[1].splitlines()
+            lines = []
+            for line in numbered:
+                match = re.match(r"(\d+)\. (.+)$", line)
+                if match is None:
+                    break
+                lines.append(f"{match.group(1)}: " + self.calls.get(match.group(2), "calculate_summary_report(df)").replace("\n", "; "))
+            return "\n".join(lines)
+        query = prompt.rsplit("User Query: ", 1)[-1].strip()
+        return self.calls.get(query, "calculate_summary_report(df)")
+
+    def invoke(self, prompt):
+        self.prompts += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return StubMessage(self.answer(prompt))
+
+    async def ainvoke(self, prompt):
+        self.prompts += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return StubMessage(self.answer(prompt))
+
+
+def generate_workbook(path, rows, seed=SEED):
+    '''
+    Description: This function writes a workbook with a structured sheet of `rows` employees and an unstructured sheet of `rows` reviews.
+
+    Args:
+    path (str): The path of the workbook.
+    rows (int): The number of rows of each sheet.
+    seed (int): The seed of the random values.
+
+    Returns:
+    None
+    '''
+    rng = np.random.default_rng(seed)
+    joining = pd.Timestamp("2005-01-01") + pd.to_timedelta(rng.integers(0, 7000, rows), unit="D")
+    structured = pd.DataFrame({
+        "ID": np.arange(1, rows + 1),
+        "Age": rng.integers(18, 70, rows),
+        "Salary": rng.integers(30000, 120000, rows),
+        "Department": rng.choice(DEPARTMENTS, rows),
+        "Experience_Years": rng.integers(1, 40, rows),
+        "Performance_Rating": rng.integers(1, 5, rows),
+        "Education_Level": rng.choice(EDUCATION_LEVELS, rows),
+        "Location": rng.choice(LOCATIONS, rows),
+        "Remote_Work": rng.choice(["Yes", "No"], rows),
+        "Project_Count": rng.integers(0, 15, rows),
+        "Joining_Date": joining,
+        "Last_Promotion_Date": joining + pd.to_timedelta(rng.integers(0, 2000, rows), unit="D"),
+    })
+    unstructured = pd.DataFrame({
+        "ID": np.arange(1, rows + 1),
+        "Customer_Review": rng.choice(REVIEWS, rows),
+        "Complaint_Details": rng.choice(COMPLAINTS, rows),
+        "Product_Feedback": rng.choice(FEEDBACK, rows),
+        "Suggestions": rng.choice(SUGGESTIONS, rows),
+    })
+    with pd.ExcelWriter(path) as writer:
+        structured.to_excel(writer, sheet_name="Structured_Data", index=False)
+        unstructured.to_excel(writer, sheet_name="Unstructured_Data", index=False)
+
+
+def generate_second_workbook(path, rows, seed=SEED):
+    '''
+    Description: This function writes the second workbook joined on 'ID': the bonus of every other employee.
+
+    Args:
+    path (str): The path of the workbook.
+    rows (int): The number of employees of the main workbook.
+    seed (int): The seed of the random values.
+
+    Returns:
+    None
+    '''
+    rng = np.random.default_rng(seed + 1)
+    ids = np.arange(1, rows + 1, 2)
+    pd.DataFrame({"ID": ids, "Bonus": rng.integers(0, 10000, len(ids))}).to_excel(path, index=False)
+
+
+def summarize(name, scenario, rows, latencies, errors, peak_bytes=None):
+    '''
+    Description: This function summarizes the timed runs of a benchmark.
+
+    Args:
+    name (str): The name of the benchmark.
+    scenario (str): 'upload', 'operation' or 'endpoint'.
+    rows (int): The number of rows of the dataset.
+    latencies (list): The duration of each successful run in seconds.
+    errors (list): The error of each failed run.
+    peak_bytes (int): The peak memory allocated by one run, if measured.
+
+    Returns:
+    dict: The latency percentiles, throughput and peak memory.
+    '''
+    result = {"name": name, "scenario": scenario, "rows": rows, "runs": len(latencies), "errors": len(errors)}
+    if errors:
+        result["error"] = str(errors[0])
+    if latencies:
+        values = np.array(latencies)
+        total = float(values.sum())
+        result["latency_seconds"] = {
+            "min": round(float(values.min()), 6),
+            "p50": round(float(np.percentile(values, 50)), 6),
+            "p90": round(float(np.percentile(values, 90)), 6),
+            "p99": round(float(np.percentile(values, 99)), 6),
+            "max": round(float(values.max()), 6),
+            "mean": round(float(values.mean()), 6),
+        }
+        result["runs_per_second"] = round(len(values) / total, 3) if total else None
+        result["rows_per_second"] = round(rows * len(values) / total) if total else None
+    if peak_bytes is not None:
+        result["peak_alloc_bytes"] = peak_bytes
+    return result
+
+
+def timed(func, repeat):
+    '''
+    Description: This function runs a benchmark several times.
+
+    Args:
+    func (callable): The benchmark, raising on failure.
+    repeat (int): The number of runs.
+
+    Returns:
+    tuple: The duration of each successful run in seconds and the error of each failed run.
+    '''
+    latencies, errors = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            errors.append(e)
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def peak_allocation(func):
+    '''
+    Description: This function measures the peak memory allocated by one run of a benchmark (Python and NumPy allocations, not Arrow's).
+
+    Args:
+    func (callable): The benchmark.
+
+    Returns:
+    int: The peak allocated bytes, or None if the run failed.
+    '''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    except Exception:
+        return None
+    finally:
+        tracemalloc.stop()
+
+
+def max_rss_bytes():
+    '''
+    Description: This function returns the peak resident memory of the process.
+
+    Args:
+    None
+
+    Returns:
+    int: The peak resident memory in bytes, or None if it is not available.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def checked(response):
+    '''
+    Description: This function fails a benchmark run on an error response.
+
+    Args:
+    response: The response of the endpoint.
+
+    Returns:
+    The response.
+    '''
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code}: {response.text[:200]}")
+    return response
+
+
+def run_size(client, rows, workbook, second_workbook, repeat, upload_repeat, chunked=False):
+    '''
+    Description: This function runs the benchmarks on one size of dataset.
+
+    Args:
+    client (TestClient): The client of the app.
+    rows (int): The number of rows of the dataset.
+    workbook (str): The main workbook.
+    second_workbook (str): The second workbook.
+    repeat (int): The number of runs of each operation and endpoint.
+    upload_repeat (int): The number of runs of each upload.
+    chunked (bool): Whether to upload the workbooks in the out-of-core mode. Default is False.
+
+    Returns:
+    list: The result of each benchmark.
+    '''
+    import query_parser
+    from dataset_registry import dataset_registry
+
+    dataset_id = f"bench-{rows}"
+    results = []
+
+    def upload(endpoint, path):
+        with open(path, "rb") as f:
+            checked(client.post(endpoint, files={"excel_file": (os.path.basename(path), f)}, data={"dataset_id": dataset_id, "wait": "true", "chunked": str(chunked).lower()}))
+
+    for endpoint, path in (("/upload", workbook), ("/upload-second", second_workbook)):
+        latencies, errors = timed(lambda: upload(endpoint, path), upload_repeat)
+        results.append(summarize(endpoint, "upload", rows, latencies, errors))
+        print(f"{rows:>9} {endpoint:<60} {latencies[0] if latencies else float('nan'):.4f}s", flush=True)
+    if results[0]["errors"]:
+        return results
+
+    dataset = dataset_registry.get(dataset_id)
+    sheets = {0: dataset.load_sheet(0), "Unstructured_Data": dataset.load_sheet("Unstructured_Data")}
+    df2 = dataset.load_sheet(0, "second")
+    for sheet, operations in ((0, OPERATIONS), ("Unstructured_Data", UNSTRUCTURED_OPERATIONS)):
+        df = sheets[sheet]
+        for call in operations.values():
+            run = lambda: query_parser.execute_llm_function(df, call, df2=df2)
+            latencies, errors = timed(run, repeat)
+            name = call.replace("\n", "; ")
+            results.append(summarize(name, "operation", rows, latencies, errors, peak_allocation(run)))
+            print(f"{rows:>9} {name[:60]:<60} {results[-1].get('latency_seconds', {}).get('p50', float('nan')):.4f}s", flush=True)
+
+    for endpoint, operations in (("/operate", OPERATIONS), ("/operate-unstruct", UNSTRUCTURED_OPERATIONS)):
+        for query in operations:
+            run = lambda: checked(client.post(endpoint, data={"user_input": query, "dataset_id": dataset_id}))
+            latencies, errors = timed(run, repeat)
+            results.append(summarize(f"{endpoint} {query}", "endpoint", rows, latencies, errors))
+    batch = lambda: checked(client.post("/operate-batch", data={"queries": list(OPERATIONS), "dataset_id": dataset_id}))
+    latencies, errors = timed(batch, repeat)
+    results.append(summarize("/operate-batch", "endpoint", rows, latencies, errors))
+    return results
+
+
+def compare(results, previous_path):
+    '''
+    Description: This function prints the change of the median latency of each benchmark from a previous run.
+
+    Args:
+    results (list): The results of this run.
+    previous_path (str): The output file of the previous run.
+
+    Returns:
+    None
+    '''
+    with open(previous_path) as f:
+        previous = {(item["name"], item["rows"]): item for item in json.load(f)["results"]}
+    print(f"\nMedian latency compared with {previous_path}:")
+    for item in results:
+        before = previous.get((item["name"], item["rows"]), {}).get("latency_seconds")
+        after = item.get("latency_seconds")
+        if before and after and before["p50"]:
+            change = (after["p50"] / before["p50"] - 1) * 100
+            print(f"{item['rows']:>9} {item['name'].replace(chr(10), '; ')[:60]:<60} {before['p50']:.4f}s -> {after['p50']:.4f}s ({change:+.1f}%)")
+
+
+def git_commit():
+    '''
+    Description: This function returns the commit of the benchmarked tree.
+
+    Args:
+    None
+
+    Returns:
+    str: The commit hash, or None outside of a git checkout.
+    '''
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIRECTORY, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the engine on synthetic workbooks with a stubbed LLM.")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS, help="Sizes of the generated datasets.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Runs of each operation and endpoint.")
+    parser.add_argument("--upload-repeat", type=int, default=1, help="Runs of each upload.")
+    parser.add_argument("--chunked", action="store_true", help="Upload the workbooks in the out-of-core mode.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated latency of the stub LLM in seconds.")
+    parser.add_argument("--workdir", default=None, help="Directory of the generated workbooks and of the uploads, reused across runs (a temporary directory by default).")
+    parser.add_argument("--output", default="benchmark_results.json", help="The JSON file the results are written to.")
+    parser.add_argument("--compare", default=None, help="The JSON file of a previous run to compare with.")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    previous = os.path.abspath(args.compare) if args.compare else None
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="excel_ai_bench_"))
+    os.makedirs(workdir, exist_ok=True)
+    # The app stores the uploads and its caches relative to the working directory
+    os.chdir(workdir)
+    os.environ.setdefault("GROQ_API_KEY", "benchmark")
+    sys.path.insert(0, REPO_DIRECTORY)
+
+    from fastapi.testclient import TestClient
+    import app
+    import excel_functions
+    import query_parser
+
+    stub = StubLLM({**OPERATIONS, **UNSTRUCTURED_OPERATIONS}, args.llm_latency)
+    query_parser.groq_chat = stub
+    excel_functions.groq_chat = stub
+
+    datasets, results = [], []
+    with TestClient(app.app) as client:
+        for rows in args.rows:
+            workbook = os.path.join(workdir, f"bench_{rows}.xlsx")
+            second_workbook = os.path.join(workdir, f"bench_{rows}_second.xlsx")
+            start = time.perf_counter()
+            if not os.path.exists(workbook):
+                generate_workbook(workbook, rows)
+            if not os.path.exists(second_workbook):
+                generate_second_workbook(second_workbook, rows)
+            generate_seconds = time.perf_counter() - start
+
+            results.extend(run_size(client, rows, workbook, second_workbook, args.repeat, args.upload_repeat, args.chunked))
+            datasets.append({
+                "rows": rows,
+                "file_bytes": os.path.getsize(workbook),
+                "generate_seconds": round(generate_seconds, 4),
+                "max_rss_bytes": max_rss_bytes(),
+            })
+        cache_stats = client.get("/cache-stats").json()
+
+    report = {
+        "commit": git_commit(),
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {"rows": args.rows, "repeat": args.repeat, "upload_repeat": args.upload_repeat, "llm_latency": args.llm_latency, "chunked": args.chunked},
+        "datasets": datasets,
+        "results": results,
+        "llm_prompts": stub.prompts,
+        "cache_stats": cache_stats,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"\nResults written to {output}")
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+# Safe compiler of the function calls returned by the LLM, replacing eval().
+#
+# A call is parsed once into a plan: the name of a whitelisted operation and its arguments, each either one of the
+# dataset variables (df, df2, result) or a literal. Anything else (attributes, subscripts, nested calls, operators,
+# other names) is rejected. The arguments are bound to the signature of the operation when compiling, and the column
+# arguments are checked against the dataset when running. Plans are cached by call text, so repeated calls are replayed
+# without being parsed again.
+#
+# A plan can have several steps, one call per line (or separated by ';'), each step reading the output of the previous
+# one as `result`. The steps run in-process one after the other and only the output of the last one is returned.
+
+import ast
+import inspect
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+from fastapi import HTTPException
+
+from out_of_core import ChunkedDataset
+
+COMPILED_CALLS_CACHE_SIZE = int(os.getenv("COMPILED_CALLS_CACHE_SIZE", 4096))
+MAX_PLAN_STEPS = int(os.getenv("MAX_PLAN_STEPS", 8))
+VARIABLES = ("df", "df2", "result")
+# Parameters of the operations naming existing columns of their dataset (join keys are checked by the join itself)
+COLUMN_PARAMETERS = {
+    "column_name", "input_column_name", "column1", "column2", "date_column", "start_date_column", "end_date_column",
+    "text_column", "target_column", "index", "columns", "values", "value_vars", "group_by", "measures",
+}
+
+
+class CallStep:
+    '''
+    Description: A compiled function call: the operation to call and its arguments, bound to the parameters of the operation.
+    '''
+
+    def __init__(self, name, arguments, text):
+        self.name = name
+        # (parameter, kind, value) with kind 'variable' (value is a variable name) or 'literal'
+        self.arguments = arguments
+        self.text = text
+        self.variables = {value for _, kind, value in arguments if kind == "variable"}
+
+    def run(self, variables, functions):
+        '''
+        Description: This function runs the call.
+
+        Args:
+        variables (dict): The values of the dataset variables (df, df2, result).
+        functions (dict): The operations by name, with the request-level overrides.
+
+        Returns:
+        The output of the operation.
+        '''
+        kwargs = {}
+        for parameter, kind, value in self.arguments:
+            if kind == "variable":
+                if variables.get(value) is None:
+                    raise HTTPException(status_code=400, detail=f"'{value}' is not available for this operation.")
+                value = variables[value]
+            kwargs[parameter] = value
+        self.check_columns(kwargs)
+        return functions[self.name](**kwargs)
+
+    def check_columns(self, kwargs):
+        '''
+        Description: This function checks that the column arguments name columns of the dataset the operation runs on.
+
+        Args:
+        kwargs (dict): The arguments of the operation.
+
+        Returns:
+        None
+        '''
+        df = next((value for value in kwargs.values() if isinstance(value, (pd.DataFrame, ChunkedDataset))), None)
+        if df is None:
+            return
+        for parameter, value in kwargs.items():
+            if parameter not in COLUMN_PARAMETERS or value is None:
+                continue
+            names = [value] if isinstance(value, str) else value
+            if not isinstance(names, (list, tuple)):
+                continue
+            missing = [name for name in names if name not in df.columns]
+            if missing:
+                raise HTTPException(status_code=400, detail=f"Column(s) {missing} not found in DataFrame.")
+
+
+class CallPlan:
+    '''
+    Description: A compiled plan: the steps to run one after the other, each step reading the output of the previous one as `result`.
+    '''
+
+    def __init__(self, steps, text):
+        self.steps = steps
+        self.text = text
+        self.variables = set().union(*(step.variables for step in steps)) - {"result"}
+
+    def run(self, variables, functions):
+        '''
+        Description: This function runs the steps of the plan. The intermediate outputs are only passed to the next step, never serialized or stored.
+
+        Args:
+        variables (dict): The values of the dataset variables (df, df2).
+        functions (dict): The operations by name, with the request-level overrides.
+
+        Returns:
+        The output of the last step.
+        '''
+        variables = dict(variables)
+        for step in self.steps:
+            variables["result"] = step.run(variables, functions)
+        return variables["result"]
+
+
+def live_steps(steps):
+    '''
+    Description: This function removes the redundant steps of a plan: the steps whose output is not read by the next step (e.g. a conversion repeated by the next step on `df`) cannot change the output of the plan.
+
+    Args:
+    steps (list): The compiled steps.
+
+    Returns:
+    list: The steps the output of the last step depends on.
+    '''
+    live = [steps[-1]]
+    for step in reversed(steps[:-1]):
+        if "result" not in live[-1].variables:
+            break
+        live.append(step)
+    return live[::-1]
+
+
+def literal(node):
+    '''
+    Description: This function evaluates a literal argument (numbers, strings, booleans, None and lists, tuples, sets or dicts of them).
+
+    Args:
+    node (ast.AST): The argument.
+
+    Returns:
+    The value of the literal.
+    '''
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, RecursionError):
+        raise HTTPException(status_code=400, detail=f"Invalid operation: unsupported argument '{ast.unparse(node)}', only df, df2, result and literals are allowed.")
+
+
+def argument(node):
+    '''
+    Description: This function compiles an argument of a call.
+
+    Args:
+    node (ast.AST): The argument.
+
+    Returns:
+    tuple: ('variable', name) for the dataset variables, ('literal', value) for the literals.
+    '''
+    if isinstance(node, ast.Name):
+        if node.id not in VARIABLES:
+            raise HTTPException(status_code=400, detail=f"Invalid operation: unknown name '{node.id}'.")
+        return "variable", node.id
+    return "literal", literal(node)
+
+
+class CallCompiler:
+    '''
+    Description: Compiles the function calls into plans against a whitelist of operations and caches the plans by call text.
+    '''
+
+    def __init__(self, functions, max_size=COMPILED_CALLS_CACHE_SIZE):
+        self.functions = functions
+        self.signatures = {name: inspect.signature(func) for name, func in functions.items()}
+        self.max_size = max_size
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, text):
+        '''
+        Description: This function compiles a function call (or several, one per line), or returns its cached plan.
+
+        Args:
+        text (str): The function call, e.g. "avg_with_filter(df, 'Department', 'IT')".
+
+        Returns:
+        CallPlan: The compiled plan.
+        '''
+        text = text.strip()
+        with self._lock:
+            plan = self._plans.get(text)
+            if plan is not None:
+                self._plans.move_to_end(text)
+                self.hits += 1
+                return plan
+            self.misses += 1
+
+        try:
+            tree = ast.parse(text, mode="exec")
+        except SyntaxError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid operation: {e.msg}.")
+        normalized = ast.unparse(tree)
+        with self._lock:
+            plan = self._plans.get(normalized)
+        if plan is None:
+            plan = self.compile_plan(tree.body, normalized)
+        with self._lock:
+            self._plans[text] = self._plans[normalized] = plan
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+        return plan
+
+    def compile_plan(self, statements, text):
+        '''
+        Description: This function compiles the parsed statements of a plan, one function call each, and removes its redundant steps.
+
+        Args:
+        statements (list): The parsed statements.
+        text (str): The normalized text of the plan.
+
+        Returns:
+        CallPlan: The compiled plan.
+        '''
+        if not statements:
+            raise HTTPException(status_code=400, detail="Invalid operation: no function call found.")
+        if len(statements) > MAX_PLAN_STEPS:
+            raise HTTPException(status_code=400, detail=f"Invalid operation: plans are limited to {MAX_PLAN_STEPS} steps.")
+        if any(not isinstance(statement, ast.Expr) for statement in statements):
+            raise HTTPException(status_code=400, detail="Invalid operation: expected function calls only.")
+        steps = [self.compile_step(statement.value, ast.unparse(statement)) for statement in statements]
+        if "result" in steps[0].variables:
+            raise HTTPException(status_code=400, detail="Invalid operation: 'result' is only available from the second step.")
+        return CallPlan(live_steps(steps), text)
+
+    def compile_step(self, node, text):
+        '''
+        Description: This function compiles the parsed expression of a function call.
+
+        Args:
+        node (ast.AST): The parsed expression.
+        text (str): The normalized text of the call.
+
+        Returns:
+        CallStep: The compiled call.
+        '''
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name):
+            raise HTTPException(status_code=400, detail="Invalid operation: expected a single call of an available function.")
+        name = node.func.id
+        if name not in self.functions:
+            raise HTTPException(status_code=400, detail=f"Invalid operation: '{name}' is not an available function.")
+        if any(isinstance(arg, ast.Starred) for arg in node.args) or any(keyword.arg is None for keyword in node.keywords):
+            raise HTTPException(status_code=400, detail="Invalid operation: unpacked arguments are not allowed.")
+
+        args = [argument(arg) for arg in node.args]
+        kwargs = {keyword.arg: argument(keyword.value) for keyword in node.keywords}
+        try:
+            bound = self.signatures[name].bind(*args, **kwargs)
+        except TypeError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid arguments for '{name}': {str(e)}.")
+        arguments = tuple((parameter, kind, value) for parameter, (kind, value) in bound.arguments.items())
+        return CallStep(name, arguments, text)
+
+    def stats(self):
+        '''
+        Description: This function returns the hit/miss counters of the plan cache.
+
+        Args:
+        None
+
+        Returns:
+        dict: The cache statistics.
+        '''
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._plans)}
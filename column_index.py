@@ -0,0 +1,270 @@
+# Column statistics and value indexes of the loaded sheets, built once when a sheet is loaded and cached with it.
+#
+# Whole-column aggregates (sum, mean, min, max, counts) are read from the statistics, and equality filters on
+# low-cardinality columns take the matching rows from an inverted index (value -> row positions) instead of scanning
+# the column on every request. The statistics also describe the columns to the LLM.
+#
+# Derived dataset versions are not indexed: building an index costs more than the one scan of a one-off operation,
+# so the operations fall back to scanning when no index was built for their input.
+
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import dtype_optimizer
+import frame_cache
+
+# Columns with more distinct values than this get statistics but no value index
+COLUMN_INDEX_MAX_CARDINALITY = int(os.getenv("COLUMN_INDEX_MAX_CARDINALITY", 1000))
+# Number of distinct values of an indexed column listed to the LLM
+DESCRIBE_MAX_VALUES = int(os.getenv("DESCRIBE_MAX_VALUES", 5))
+CACHE_NAME = "column_index"
+
+_shared = threading.local()
+
+
+class ColumnIndex:
+    '''
+    Description: The statistics of every column of a DataFrame, the summary report of its numeric columns and the value indexes of its low-cardinality columns.
+    '''
+
+    def __init__(self, df, max_cardinality=COLUMN_INDEX_MAX_CARDINALITY):
+        self.rows = len(df)
+        self.summary = summary_report(df)
+        counts = df.count()
+        self.stats = {}
+        self.codes = {}
+        self.positions = {}
+        for column in df.columns:
+            series = df[column]
+            stats = {"dtype": str(series.dtype), "count": int(counts[column]), "null_count": self.rows - int(counts[column])}
+            if column in self.summary.index:
+                stats.update(sum=series.sum(), mean=series.mean(), min=series.min(), max=series.max())
+            self.stats[column] = stats
+            if not pd.api.types.is_datetime64_any_dtype(series.dtype) and not pd.api.types.is_timedelta64_dtype(series.dtype):
+                self._index_values(column, series, max_cardinality)
+
+    def _index_values(self, column, series, max_cardinality):
+        try:
+            codes, uniques = pd.factorize(series)
+        except TypeError:
+            # Unhashable values (e.g. lists) cannot be indexed
+            return
+        if len(uniques) > max_cardinality:
+            return
+        # Row positions grouped by code, missing values (code -1) first, each group in row order
+        order = np.argsort(codes, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(codes + 1, minlength=len(uniques) + 1))))
+        self.codes[column] = codes
+        self.positions[column] = {
+            value: order[offsets[code + 1]:offsets[code + 2]] for code, value in enumerate(uniques)
+        }
+
+    def lookup(self, column, value):
+        '''
+        Description: This function returns the positions of the rows where a column equals a value.
+
+        Args:
+        column (str): The column to filter on.
+        value: The value to filter on.
+
+        Returns:
+        np.ndarray: The row positions in ascending order, or None if the column has no value index.
+        '''
+        positions = self.positions.get(column)
+        if positions is None:
+            return None
+        try:
+            return positions.get(value, np.empty(0, dtype=np.intp))
+        except TypeError:
+            return None
+
+    def describe(self, max_values=DESCRIBE_MAX_VALUES):
+        '''
+        Description: This function describes the columns for the LLM in a compact form: their type, range of the numeric columns, values of the indexed text columns and missing values.
+
+        Args:
+        max_values (int): The number of values listed per indexed column.
+
+        Returns:
+        str: One line per column.
+        '''
+        lines = []
+        for column, stats in self.stats.items():
+            line = f"{column!r} {stats['dtype']}"
+            if "mean" in stats and not pd.api.types.is_bool_dtype(stats["dtype"]):
+                line += f" {stats['min']}..{stats['max']}"
+            elif column in self.positions and not pd.api.types.is_bool_dtype(stats["dtype"]):
+                line += ": " + list_values(list(self.positions[column]), max_values)
+            if stats["null_count"]:
+                line += f" ({stats['null_count']} missing)"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def list_values(values, max_values=DESCRIBE_MAX_VALUES):
+    '''
+    Description: This function lists the first values of a column for the LLM.
+
+    Args:
+    values (list): The distinct values.
+    max_values (int): The number of values listed.
+
+    Returns:
+    str: The listed values, with the number of values not listed.
+    '''
+    listed = "|".join(repr(value) for value in values[:max_values])
+    if len(values) > max_values:
+        listed += f"|+{len(values) - max_values} more"
+    return listed
+
+
+def build(df):
+    '''
+    Description: This function builds the column index of a DataFrame, or returns it if it was already built.
+
+    Args:
+    df (pd.DataFrame): The DataFrame, typically a loaded sheet.
+
+    Returns:
+    ColumnIndex: The column index.
+    '''
+    return frame_cache.cached(df, CACHE_NAME, lambda: ColumnIndex(df))
+
+
+def peek(df):
+    '''
+    Description: This function returns the column index of a DataFrame if it was built.
+
+    Args:
+    df (pd.DataFrame): The DataFrame.
+
+    Returns:
+    ColumnIndex: The column index, or None.
+    '''
+    return frame_cache.peek(df, CACHE_NAME)
+
+
+def select(df, column, value):
+    '''
+    Description: This function returns the rows where a column equals a value, from the value index when there is one, or from the selections shared in a shared_selections block.
+
+    Args:
+    df (pd.DataFrame): The DataFrame.
+    column (str): The column to filter on.
+    value: The value to filter on.
+
+    Returns:
+    pd.DataFrame: The matching rows.
+    '''
+    value = dtype_optimizer.coerce_value(df[column], value)
+    selections = getattr(_shared, "selections", None)
+    try:
+        key = (id(df), column, type(value), value)
+        # The entry holds the DataFrame, so that its ID cannot be reused by another one while the selections are shared
+        if selections is not None and key in selections and selections[key][0] is df:
+            return selections[key][1]
+    except TypeError:
+        selections = None
+
+    index = peek(df)
+    positions = index.lookup(column, value) if index is not None else None
+    rows = df[df[column] == value] if positions is None else df.take(positions)
+    if selections is not None:
+        selections[key] = (df, rows)
+    return rows
+
+
+@contextmanager
+def shared_selections():
+    '''
+    Description: This context manager lets the operations run in it on the current thread share their filtered rows, so that several aggregates on the same filter (e.g. of a batch of queries) scan or look it up once.
+
+    Args:
+    None
+
+    Yields:
+    None
+    '''
+    _shared.selections = {}
+    try:
+        yield
+    finally:
+        del _shared.selections
+
+
+def summary_columns(df):
+    '''
+    Description: This function returns the columns of the summary report: the numerical columns, without the boolean ones (e.g. the yes/no columns loaded as booleans), whose sum and average are not meaningful.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The dataset.
+
+    Returns:
+    list: The columns of the summary report.
+    '''
+    return [column for column, dtype in df.dtypes.items() if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)]
+
+
+def summary_report(df):
+    '''
+    Description: This function computes the summary report of a DataFrame.
+
+    Args:
+    df (pd.DataFrame): The DataFrame.
+
+    Returns:
+    pd.DataFrame: The sum, average, min and max of each column of summary_columns.
+    '''
+    numeric = df[summary_columns(df)]
+    return pd.DataFrame({
+        'sum': numeric.sum(),
+        'average': numeric.mean(),
+        'min': numeric.min(),
+        'max': numeric.max()
+    })
+
+
+@contextmanager
+def unshared_selections():
+    '''
+    Description: This context manager stops sharing the filtered rows in a shared_selections block, for the operations run on transient DataFrames (e.g. the chunks of an out-of-core dataset), which the shared selections would keep in memory until the end of the block.
+
+    Args:
+    None
+
+    Yields:
+    None
+    '''
+    selections = getattr(_shared, "selections", None)
+    _shared.selections = None
+    try:
+        yield
+    finally:
+        _shared.selections = selections
+
+
+def describe(df, max_values=DESCRIBE_MAX_VALUES):
+    '''
+    Description: This function describes the columns of a DataFrame for the LLM, with their statistics when the DataFrame is indexed, else with their type and the categories of the categorical columns.
+
+    Args:
+    df (pd.DataFrame): The DataFrame.
+    max_values (int): The number of values listed per column.
+
+    Returns:
+    str: One line per column.
+    '''
+    index = peek(df)
+    if index is not None:
+        return index.describe(max_values)
+    lines = []
+    for column, dtype in df.dtypes.items():
+        line = f"{column!r} {dtype}"
+        if isinstance(dtype, pd.CategoricalDtype):
+            line += ": " + list_values(list(dtype.categories), max_values)
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,207 @@
+# Registry of the uploaded datasets keyed by dataset ID, so that one worker can serve many tenants at the same time.
+#
+# Each dataset has its own directory holding its workbooks (file1.xlsx for the main workbook, file2.xlsx for the join
+# workbook) and their snapshots, and its own lock. The parsed sheets of every dataset share the workbook cache, whose
+# memory budget is the global budget: cold sheets are evicted least recently used first and memory-mapped back from
+# their snapshots on the next access.
+
+import contextlib
+import os
+import re
+import threading
+import time
+
+from fastapi import HTTPException
+
+import column_index
+import out_of_core
+import snapshot
+from workbook_cache import workbook_cache, parse_workbook
+
+UPLOAD_DIRECTORY = "./uploads"
+# The default dataset lives directly in the upload directory, where single-tenant deployments have their files
+DEFAULT_DATASET = "default"
+DATASET_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+WORKBOOKS = {"main": "file1.xlsx", "second": "file2.xlsx"}
+
+
+class Dataset:
+    '''
+    Description: The workbooks of one dataset and the lock serializing their replacement and loading.
+    '''
+
+    def __init__(self, dataset_id, directory):
+        self.dataset_id = dataset_id
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.last_used = time.time()
+
+    def workbook_path(self, workbook="main"):
+        '''
+        Description: This function returns the path of a workbook of the dataset.
+
+        Args:
+        workbook (str): 'main' or 'second'.
+
+        Returns:
+        str: The path of the workbook.
+        '''
+        return os.path.join(self.directory, WORKBOOKS[workbook])
+
+    def ingest(self, workbook, received_path, content_hash, sheet_names, engine=None, chunked=None):
+        '''
+        Description: This function parses the needed sheets of a received file in one pass, then replaces a workbook of the dataset with it, and indexes and snapshots the sheets. The received file is parsed without the lock of the dataset, so the operations keep being served from the previous workbook until the new one is ready. Large workbooks are ingested out of core: their sheets are streamed to their snapshots and served in chunks.
+
+        Args:
+        workbook (str): 'main' or 'second'.
+        received_path (str): The received file, moved in place of the workbook.
+        content_hash (str): The SHA-256 hash of the received file, computed while it was received.
+        sheet_names (list): The sheets to parse.
+        engine (str): The engine used to parse the workbook, the out-of-core ingestion always uses openpyxl.
+        chunked (bool): Whether to ingest the workbook out of core, None to decide from its size (OUT_OF_CORE_MIN_BYTES).
+
+        Returns:
+        tuple: The parsed sheets keyed like `sheet_names`, their parse time in seconds and their memory before and after the dtype optimization (or their rows and size on disk when ingested out of core).
+        '''
+        path = self.workbook_path(workbook)
+        if chunked is None:
+            chunked = out_of_core.wants_chunks(received_path)
+        try:
+            if chunked:
+                # The snapshots are staged under the name of the received file, and moved in place with the workbook
+                sheets, parse_seconds, memory = out_of_core.ingest_workbook(received_path, sheet_names, content_hash)
+            else:
+                sheets, parse_seconds, memory = parse_workbook(received_path, sheet_names, engine=engine)
+
+            with self.lock:
+                self.last_used = time.time()
+                workbook_cache.invalidate(path)
+                os.replace(received_path, path)
+                workbook_cache.remember_hash(path, content_hash)
+                for sheet, df in sheets.items():
+                    if chunked:
+                        os.replace(df.path, snapshot.snapshot_path(path, sheet))
+                        df = sheets[sheet] = out_of_core.ChunkedDataset.open(snapshot.snapshot_path(path, sheet))
+                    workbook_cache.put(path, sheet, df, write_snapshot=not chunked)
+        finally:
+            for sheet in sheet_names:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(snapshot.snapshot_path(received_path, sheet))
+        for df in sheets.values():
+            build_index(df)
+        return sheets, parse_seconds, memory
+
+    def load_sheet(self, sheet_name=0, workbook="main"):
+        '''
+        Description: This function returns a sheet of a workbook of the dataset from the workbook cache, or from its snapshot if it was spilled, with its column index.
+
+        Args:
+        sheet_name (str or int): The name or the position of the sheet.
+        workbook (str): 'main' or 'second'.
+
+        Returns:
+        pd.DataFrame or ChunkedDataset: The sheet.
+        '''
+        path = self.workbook_path(workbook)
+        with self.lock:
+            self.last_used = time.time()
+            if not os.path.exists(path):
+                kind = "excel file" if workbook == "main" else "second excel file"
+                raise HTTPException(status_code=400, detail=f"No {kind} uploaded yet for dataset '{self.dataset_id}'. Please upload it first.")
+            df = workbook_cache.get(path, sheet_name)
+        # Built once per loaded sheet, then cached with it
+        build_index(df)
+        return df
+
+    def content_hash(self, workbook="main"):
+        '''
+        Description: This function returns the content hash of a workbook of the dataset.
+
+        Args:
+        workbook (str): 'main' or 'second'.
+
+        Returns:
+        str: The content hash.
+        '''
+        return workbook_cache.content_hash(self.workbook_path(workbook))
+
+
+def build_index(df):
+    '''
+    Description: This function builds the column index of a loaded sheet, in one pass over its chunks if it was ingested out of core.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The sheet.
+
+    Returns:
+    ColumnIndex: The column index.
+    '''
+    if isinstance(df, out_of_core.ChunkedDataset):
+        return out_of_core.build_index(df)
+    return column_index.build(df)
+
+
+class DatasetRegistry:
+    '''
+    Description: Registry of the datasets keyed by dataset ID. Datasets uploaded before a restart are found again from their directory.
+    '''
+
+    def __init__(self, root=UPLOAD_DIRECTORY):
+        self.root = root
+        self._datasets = {}
+        self._lock = threading.Lock()
+
+    def directory(self, dataset_id):
+        '''
+        Description: This function returns the directory of a dataset.
+
+        Args:
+        dataset_id (str): The ID of the dataset.
+
+        Returns:
+        str: The directory of the dataset.
+        '''
+        if dataset_id == DEFAULT_DATASET:
+            return self.root
+        return os.path.join(self.root, "datasets", dataset_id)
+
+    def get(self, dataset_id=None, create=False):
+        '''
+        Description: This function returns a dataset, creating it if requested.
+
+        Args:
+        dataset_id (str): The ID of the dataset, the default dataset if None.
+        create (bool): Whether to create the dataset if it does not exist. Default is False.
+
+        Returns:
+        Dataset: The dataset.
+        '''
+        dataset_id = dataset_id or DEFAULT_DATASET
+        if not DATASET_ID_PATTERN.fullmatch(dataset_id):
+            raise HTTPException(status_code=400, detail="Invalid dataset ID, use 1 to 64 letters, digits, '-' or '_'.")
+        with self._lock:
+            dataset = self._datasets.get(dataset_id)
+            if dataset is not None:
+                return dataset
+            directory = self.directory(dataset_id)
+            if not create and not os.path.isdir(directory):
+                raise HTTPException(status_code=404, detail=f"Dataset '{dataset_id}' not found. Upload a file to create it.")
+            os.makedirs(directory, exist_ok=True)
+            dataset = self._datasets[dataset_id] = Dataset(dataset_id, directory)
+            return dataset
+
+    def stats(self):
+        '''
+        Description: This function returns the number of datasets known to the registry.
+
+        Args:
+        None
+
+        Returns:
+        dict: The registry statistics.
+        '''
+        with self._lock:
+            return {"datasets": len(self._datasets)}
+
+
+dataset_registry = DatasetRegistry()
@@ -0,0 +1,139 @@
+# Immutable versions of the datasets. Every operation returning a DataFrame creates a new version derived from its input, so that clients can chain operations on a specific version while the loaded sheets are never mutated.
+
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+from out_of_core import ChunkedDataset
+
+DATASET_VERSIONS_MAX_BYTES = int(os.getenv("DATASET_VERSIONS_MAX_BYTES", 256 * 1024 * 1024))
+DATASET_VERSIONS_MAX_COUNT = int(os.getenv("DATASET_VERSIONS_MAX_COUNT", 1024))
+# Budget of the spill files of the out-of-core results, whose rows are on disk instead of in memory
+DATASET_VERSIONS_MAX_DISK_BYTES = int(os.getenv("DATASET_VERSIONS_MAX_DISK_BYTES", 4 * 1024 * 1024 * 1024))
+
+
+def owned_bytes(df, parent):
+    '''
+    Description: This function estimates the memory owned by a version and not shared with its parent. Thanks to copy-on-write, the columns a derived version did not touch still share the buffers of its parent, so only the added or converted columns are counted.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The version.
+    parent (pd.DataFrame or ChunkedDataset): The version it was derived from, or None for a loaded sheet.
+
+    Returns:
+    int: The estimated number of bytes.
+    '''
+    if parent is None or isinstance(df, ChunkedDataset):
+        # Loaded sheets are owned by the workbook cache, and the rows of chunked results stay on disk (see spilled_bytes)
+        return 0
+    if isinstance(parent, ChunkedDataset) or len(df) != len(parent) or not df.index.equals(parent.index):
+        return int(df.memory_usage(deep=True).sum())
+    new_columns = [col for col in df.columns if col not in parent.columns or df[col].dtype != parent[col].dtype]
+    if not new_columns:
+        return 0
+    return int(df[new_columns].memory_usage(deep=True, index=False).sum())
+
+
+def spilled_bytes(df):
+    '''
+    Description: This function returns the disk space owned by a version: the size of the spill file of an out-of-core result, deleted once the version is garbage-collected.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The version.
+
+    Returns:
+    int: The number of bytes.
+    '''
+    if not isinstance(df, ChunkedDataset) or not df.owned:
+        # The snapshots of the loaded sheets are owned by their workbook
+        return 0
+    try:
+        return os.path.getsize(df.path)
+    except OSError:
+        return 0
+
+
+class DatasetVersions:
+    '''
+    Description: Registry of the dataset versions keyed by version ID. When the versions own more than `max_bytes` of memory or `max_disk_bytes` of spill files (or there are more than `max_count` of them) the least recently used ones are garbage-collected.
+    '''
+
+    def __init__(self, max_bytes=DATASET_VERSIONS_MAX_BYTES, max_count=DATASET_VERSIONS_MAX_COUNT, max_disk_bytes=DATASET_VERSIONS_MAX_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.max_disk_bytes = max_disk_bytes
+        self._versions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, df, parent_id=None, version_id=None, owner=None):
+        '''
+        Description: This function registers a DataFrame as a new version.
+
+        Args:
+        df (pd.DataFrame): The DataFrame of the version.
+        parent_id (str): The version the DataFrame was derived from, None for a loaded sheet.
+        version_id (str): The ID of the version, a random ID is generated if None.
+        owner (str): The dataset the version belongs to.
+
+        Returns:
+        str: The ID of the version.
+        '''
+        version_id = version_id or uuid.uuid4().hex[:16]
+        with self._lock:
+            parent = self._versions.get(parent_id)
+            size = owned_bytes(df, parent[0] if parent is not None else None)
+            self._versions[version_id] = (df, parent_id, size, owner, spilled_bytes(df))
+            self._versions.move_to_end(version_id)
+            self._collect()
+        return version_id
+
+    def get(self, version_id, owner=None):
+        '''
+        Description: This function returns the DataFrame of a version.
+
+        Args:
+        version_id (str): The ID of the version.
+        owner (str): The dataset the version must belong to.
+
+        Returns:
+        pd.DataFrame: The DataFrame of the version.
+        '''
+        with self._lock:
+            entry = self._versions.get(version_id)
+            if entry is None or entry[3] != owner:
+                raise HTTPException(status_code=404, detail=f"Dataset version '{version_id}' not found or expired.")
+            self._versions.move_to_end(version_id)
+            return entry[0]
+
+    def stats(self):
+        '''
+        Description: This function returns the number of versions and the memory and disk space they own.
+
+        Args:
+        None
+
+        Returns:
+        dict: The registry statistics.
+        '''
+        with self._lock:
+            return {
+                "versions": len(self._versions),
+                "bytes": sum(entry[2] for entry in self._versions.values()),
+                "max_bytes": self.max_bytes,
+                "disk_bytes": sum(entry[4] for entry in self._versions.values()),
+                "max_disk_bytes": self.max_disk_bytes,
+            }
+
+    def _collect(self):
+        total = sum(entry[2] for entry in self._versions.values())
+        disk = sum(entry[4] for entry in self._versions.values())
+        while len(self._versions) > 1 and (total > self.max_bytes or disk > self.max_disk_bytes or len(self._versions) > self.max_count):
+            _, entry = self._versions.popitem(last=False)
+            total -= entry[2]
+            disk -= entry[4]
+
+
+dataset_versions = DatasetVersions()
@@ -0,0 +1,153 @@
+# Compact dtypes for the loaded sheets.
+#
+# read_excel leaves the text columns as Python strings and the numbers as 64-bit. The loader converts low-cardinality
+# text columns to categoricals, yes/no columns to nullable booleans and date-like text columns to datetimes, and
+# downcasts the numbers when no value changes, which makes the resident sheets several times smaller and the equality
+# filters compare integer codes instead of strings.
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+OPTIMIZE_DTYPES = os.getenv("OPTIMIZE_DTYPES", "1") not in ("0", "false", "False")
+# Text columns with at most this share of distinct values become categoricals
+CATEGORY_MAX_RATIO = float(os.getenv("CATEGORY_MAX_RATIO", 0.5))
+# Share of the values of a text column that must parse as dates for the column to become a datetime column
+DATE_MIN_RATIO = float(os.getenv("DATE_MIN_RATIO", 0.9))
+DATE_SAMPLE_SIZE = 100
+
+BOOLEAN_WORDS = {"yes": True, "no": False, "y": True, "n": False, "true": True, "false": False}
+DATE_PATTERN = re.compile(r"^\s*(?:\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4})(?:[ T]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?\s*$")
+
+
+def as_boolean(series):
+    '''
+    Description: This function converts a yes/no (or true/false) text column to a nullable boolean column.
+
+    Args:
+    series (pd.Series): The text column.
+
+    Returns:
+    pd.Series: The boolean column, or None if some values are not yes/no words.
+    '''
+    values = series.dropna()
+    if values.empty or not all(isinstance(value, (str, bool)) for value in values.unique()):
+        return None
+    words = values.astype(str).str.strip().str.lower()
+    if not words.isin(list(BOOLEAN_WORDS)).all():
+        return None
+    return series.astype(str).str.strip().str.lower().map(BOOLEAN_WORDS).where(series.notna()).astype("boolean")
+
+
+def as_dates(series):
+    '''
+    Description: This function parses a text column holding dates.
+
+    Args:
+    series (pd.Series): The text column.
+
+    Returns:
+    pd.Series: The datetime column, or None if the column does not hold dates.
+    '''
+    values = series.dropna()
+    sample = values.iloc[:DATE_SAMPLE_SIZE]
+    if sample.empty or not all(isinstance(value, str) and DATE_PATTERN.match(value) for value in sample):
+        return None
+    parsed = pd.to_datetime(series, errors="coerce")
+    if parsed.notna().sum() < DATE_MIN_RATIO * len(values):
+        return None
+    return parsed
+
+
+def downcast(series):
+    '''
+    Description: This function stores a numerical column in the smallest dtype holding all its values exactly.
+
+    Args:
+    series (pd.Series): The numerical column.
+
+    Returns:
+    pd.Series: The downcast column, or the column itself if no smaller dtype fits.
+    '''
+    kind = "integer" if pd.api.types.is_integer_dtype(series.dtype) else "float"
+    smaller = pd.to_numeric(series, downcast=kind)
+    if smaller.dtype == series.dtype:
+        return series
+    if kind == "float" and not np.array_equal(smaller.to_numpy(dtype="float64"), series.to_numpy(dtype="float64"), equal_nan=True):
+        return series
+    return smaller
+
+
+def optimize_column(series):
+    '''
+    Description: This function chooses the compact dtype of a column.
+
+    Args:
+    series (pd.Series): The column.
+
+    Returns:
+    pd.Series: The column in its compact dtype.
+    '''
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype):
+        return series
+    if pd.api.types.is_numeric_dtype(dtype):
+        return downcast(series) if isinstance(dtype, np.dtype) else series
+    if pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+        for convert in (as_boolean, as_dates):
+            converted = convert(series)
+            if converted is not None:
+                return converted
+        distinct = series.nunique()
+        if len(series) and distinct <= CATEGORY_MAX_RATIO * len(series):
+            try:
+                return series.astype("category")
+            except TypeError:
+                # Unhashable values (e.g. lists) cannot be categories
+                return series
+    return series
+
+
+def optimize_dtypes(df):
+    '''
+    Description: This function converts the columns of a sheet to compact dtypes and reports the memory of each column before and after.
+
+    Args:
+    df (pd.DataFrame): The parsed sheet.
+
+    Returns:
+    tuple: The optimized sheet, and a report with the total bytes before and after and, per column, the dtypes and bytes before and after.
+    '''
+    dtypes = df.dtypes
+    before = df.memory_usage(deep=True, index=False)
+    if OPTIMIZE_DTYPES:
+        df = pd.DataFrame({column: optimize_column(df[column]) for column in df.columns}, index=df.index)
+    after = df.memory_usage(deep=True, index=False)
+
+    columns = {}
+    for position, column in enumerate(df.columns):
+        columns[str(column)] = {
+            "dtype_before": str(dtypes.iloc[position]),
+            "dtype_after": str(df[column].dtype),
+            "bytes_before": int(before.iloc[position]),
+            "bytes_after": int(after.iloc[position]),
+        }
+    return df, {"bytes_before": int(before.sum()), "bytes_after": int(after.sum()), "columns": columns}
+
+
+def coerce_value(series, value):
+    '''
+    Description: This function converts a filter value to the dtype of the filtered column, e.g. 'Yes' to True for a boolean column.
+
+    Args:
+    series (pd.Series): The filtered column.
+    value: The filter value.
+
+    Returns:
+    The converted value, or the value unchanged.
+    '''
+    if isinstance(value, str) and pd.api.types.is_bool_dtype(series.dtype):
+        return BOOLEAN_WORDS.get(value.strip().lower(), value)
+    return value
@@ -8,11 +8,23 @@ from langchain_groq import ChatGroq
 import json
 import os
 from fastapi import HTTPException
+import workbook_cache
+import sentiment
+from llm_limiter import llm_limiter
+import joins
+import column_index
+import frame_cache
+import out_of_core
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Operations return new DataFrames instead of mutating their input. With copy-on-write (always on from pandas 3.0)
+# the derived frames share the buffers of the columns they did not touch.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
 
 groq_chat = ChatGroq(
     groq_api_key=os.getenv('GROQ_API_KEY'), 
@@ -30,6 +42,17 @@ Supported Operations: The listed operations should be supported on the created E
 
 UPLOAD_DIRECTORY = "./uploads"
 
+# The operations also run on the sheets ingested out of core (out_of_core.ChunkedDataset): the row-wise operations
+# chunk by chunk, the aggregations from partial aggregates merged at the end, and the others on the dataset loaded in
+# memory when it fits in the OUT_OF_CORE_MEMORY_BUDGET.
+
+# Aggregations of group_aggregate and their pandas names, the LLM often says 'average' or 'avg' for 'mean'
+AGGREGATIONS = {
+    'sum': 'sum', 'mean': 'mean', 'average': 'mean', 'avg': 'mean', 'min': 'min', 'max': 'max',
+    'count': 'count', 'median': 'median', 'std': 'std', 'nunique': 'nunique'
+}
+NUMERIC_AGGREGATIONS = {'sum', 'mean', 'median', 'std'}
+
 
 def variable_name_genrator(filename: str) -> str:
     '''
@@ -48,7 +71,7 @@ def variable_name_genrator(filename: str) -> str:
 
 def create_dfs_from_uploads():
     '''
-    Description: This function will create DataFrames from the uploaded Excel files.
+    Description: This function will create DataFrames from the uploaded Excel files. The sheets are memory-mapped from their columnar snapshots when these are up to date.
     
     Args:
     None (No input arguments) 
@@ -66,7 +89,7 @@ def create_dfs_from_uploads():
         if filename.endswith(".xlsx"):
             file_path = os.path.join(UPLOAD_DIRECTORY, filename)
             try:
-                df = pd.read_excel(file_path)
+                df = workbook_cache.workbook_cache.get(file_path)
                 variable_name = variable_name_genrator(filename)
                 dfs[variable_name] = df
                 globals()[variable_name] = df  
@@ -83,6 +106,23 @@ dfs = create_dfs_from_uploads()
 
 
 
+def widen(series):
+    '''
+    Description: This function returns a numerical column in 64 bits, so that the arithmetic on the downcast columns of the loaded sheets cannot overflow.
+
+    Args:
+    series (pd.Series): The column.
+
+    Returns:
+    pd.Series: The column in int64 or float64, or unchanged if it is not a NumPy number column.
+    '''
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind in "iu" and series.dtype.itemsize < 8:
+        return series.astype("int64")
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind == "f" and series.dtype.itemsize < 8:
+        return series.astype("float64")
+    return series
+
+@out_of_core.rowwise
 def maths_operations_on_same_col(action, df, input_column_name):
     '''
     Description: This function performs basic mathematical operations such as addition, subtraction, multiplication, and division on numerical columns of a DataFrame. It creates new columns to store the results.
@@ -93,29 +133,32 @@ def maths_operations_on_same_col(action, df, input_column_name):
     input_column_name (str): The name of the column on which the operation is to be performed.
 
     Returns:
-    pd.DataFrame: The DataFrame with the new column added containing the result of the mathematical operation.
+    pd.DataFrame: A new DataFrame with the new column added containing the result of the mathematical operation, the input DataFrame is left unchanged.
     '''
     if input_column_name not in df.columns:
         raise HTTPException(status_code=400, detail=f"Column '{input_column_name}' not found in DataFrame.")
 
     result_col = f"{input_column_name}_{action}"
+    df = df.copy(deep=False)
+    column = widen(df[input_column_name])
 
     if action == "add":
-        df[result_col] = df[input_column_name] + df[input_column_name]
+        df[result_col] = column + column
     elif action == "subtract":
-        df[result_col] = df[input_column_name] - df[input_column_name]
+        df[result_col] = column - column
     elif action == "multiply":
-        df[result_col] = df[input_column_name] * df[input_column_name]
+        df[result_col] = column * column
     elif action == "divide":
-        if df[input_column_name].eq(0).any():
+        if column.eq(0).any():
             raise HTTPException(status_code=400, detail="Cannot divide by zero.")
-        df[result_col] = df[input_column_name] / df[input_column_name]
+        df[result_col] = column / column
     else:
         raise HTTPException(status_code=400, detail="Invalid operation! Choose from ['add', 'subtract', 'multiply', 'divide']")
     
     return df
 
 
+@out_of_core.rowwise
 def maths_operations_on_diff_cols(action, df, column1, column2):
     '''
     Description: This function performs basic mathematical operations such as addition, subtraction, multiplication, and division on numerical columns of a DataFrame. It creates new columns to store the results.
@@ -127,29 +170,32 @@ def maths_operations_on_diff_cols(action, df, column1, column2):
     column2 (str): The name of the second column on which the operation is to be performed.
 
     Returns:
-    pd.DataFrame: The DataFrame with the new column added containing the result of the mathematical operation.
+    pd.DataFrame: A new DataFrame with the new column added containing the result of the mathematical operation, the input DataFrame is left unchanged.
     '''
     if column1 not in df.columns or column2 not in df.columns:
         raise HTTPException(status_code=400, detail=f"One or both columns ('{column1}', '{column2}') not found in DataFrame.")
 
     result_col = f"{column1}_{action}_{column2}"
+    df = df.copy(deep=False)
+    first, second = widen(df[column1]), widen(df[column2])
 
     if action == "add":
-        df[result_col] = df[column1] + df[column2]
+        df[result_col] = first + second
     elif action == "subtract":
-        df[result_col] = df[column1] - df[column2]
+        df[result_col] = first - second
     elif action == "multiply":
-        df[result_col] = df[column1] * df[column2]
+        df[result_col] = first * second
     elif action == "divide":
-        if df[column2].eq(0).any():
+        if second.eq(0).any():
             raise HTTPException(status_code=400, detail=f"Cannot divide by zero in column '{column2}'.")
-        df[result_col] = df[column1] / df[column2]
+        df[result_col] = first / second
     else:
         raise HTTPException(status_code=400, detail="Invalid operation! Choose from ['add', 'subtract', 'multiply', 'divide']")
 
     return df
 
 
+@out_of_core.streamed(out_of_core.calculate_summary_report)
 def calculate_summary_report(df):
     '''
     Description: This function calculates aggregations like sum, average, min, max, etc., on numerical columns of a DataFrame and produces a summary report.
@@ -160,14 +206,12 @@ def calculate_summary_report(df):
     Returns:
     pd.DataFrame: A DataFrame containing the summary report with columns for sum, average, min, and max values.
     '''
-    summary = {
-        'sum': df.sum(numeric_only=True),
-        'average': df.mean(numeric_only=True),
-        'min': df.min(numeric_only=True),
-        'max': df.max(numeric_only=True)
-    }
-    return pd.DataFrame(summary)
+    index = column_index.peek(df)
+    if index is not None:
+        return index.summary
+    return column_index.summary_report(df)
 
+@out_of_core.in_memory
 def join_datasets(df1, df2, join_type='inner', on=None):
     '''
     Description: This function performs different types of joins (inner, left, right, etc.) with another dataset.
@@ -179,19 +223,20 @@ def join_datasets(df1, df2, join_type='inner', on=None):
     on (str or list): The column(s) to join the DataFrames on. If None, common columns will be used.
 
     Returns:
-    pd.DataFrame: The DataFrame resulting from the join operation.
+    pd.DataFrame: The DataFrame resulting from the join operation, overlapping columns take the '_x' and '_y' suffixes.
     '''
     if not isinstance(df1, pd.DataFrame) or not isinstance(df2, pd.DataFrame):
         raise HTTPException(status_code=400, detail="Both inputs should be pandas DataFrames.")
     if on is None:
-        common_cols = list(set(df1.columns) & set(df2.columns))
+        common_cols = [col for col in df1.columns if col in df2.columns]
         if not common_cols:
             raise HTTPException(status_code=400, detail="No common columns found for joining. Specify 'on' manually.")
         on = common_cols  # Use common columns as default join keys
-    
-    return pd.merge(df1, df2, how=join_type, on=on)
+
+    return joins.join(df1, df2, how=join_type, on=on)
 
 
+@out_of_core.streamed(out_of_core.pivot_table)
 def pivot_table(df, index, columns, values, aggfunc='sum'):
     '''
     Description: This function creates a pivot table from the existing data in a DataFrame.
@@ -210,8 +255,9 @@ def pivot_table(df, index, columns, values, aggfunc='sum'):
     if any(col not in df.columns for col in [index, columns, values]):
         raise HTTPException(status_code=400, detail="One or more specified columns are missing from the DataFrame.")
     
-    return pd.pivot_table(df, index=index, columns=columns, values=values, aggfunc=aggfunc)
+    return pd.pivot_table(df, index=index, columns=columns, values=values, aggfunc=aggfunc, observed=True)
 
+@out_of_core.in_memory
 def unpivot_table(df, value_vars, var_name='variable', value_name='value'):
     '''
     Description: This function performs the reverse operation to unpivot a pivot table back to a normal dataset.
@@ -233,6 +279,50 @@ def unpivot_table(df, value_vars, var_name='variable', value_name='value'):
                    value_vars=value_vars, var_name=var_name, value_name=value_name)
 
 
+def as_datetime(series):
+    '''
+    Description: This function parses a column as dates, unless it is already parsed (e.g. by a previous step of a plan).
+
+    Args:
+    series (pd.Series): The column.
+
+    Returns:
+    pd.Series: The parsed column, invalid dates becoming NaT.
+    '''
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return series
+    return pd.to_datetime(series, errors='coerce')
+
+def parsed_dates(df, column):
+    '''
+    Description: This function returns a column parsed as dates. The parsed column is cached with the DataFrame, so later date operations on the same dataset do not parse it again.
+
+    Args:
+    df (pd.DataFrame): The DataFrame containing the data.
+    column (str): The name of the date column.
+
+    Returns:
+    pd.Series: The parsed column, invalid dates becoming NaT.
+    '''
+    return frame_cache.cached(df, ("dates", column), lambda: as_datetime(df[column]))
+
+def date_parts(df, column):
+    '''
+    Description: This function returns the year, month and day of a date column, cached with the DataFrame like the parsed column.
+
+    Args:
+    df (pd.DataFrame): The DataFrame containing the data.
+    column (str): The name of the date column.
+
+    Returns:
+    dict: The 'year', 'month' and 'day' columns.
+    '''
+    def build():
+        dates = parsed_dates(df, column)
+        return {'year': dates.dt.year, 'month': dates.dt.month, 'day': dates.dt.day}
+    return frame_cache.cached(df, ("date_parts", column), build)
+
+@out_of_core.rowwise
 def date_operations(df, date_column):
     '''
     Description: This function performs operations like extracting the month, day, and year from date columns in a DataFrame.
@@ -242,18 +332,24 @@ def date_operations(df, date_column):
     date_column (str): The name of the date column.
 
     Returns:
-    pd.DataFrame: The DataFrame with new columns added for year, month, and day extracted from the date column.
+    pd.DataFrame: A new DataFrame with the date column parsed and new columns added for year, month, and day extracted from it, the input DataFrame is left unchanged.
     '''
     if date_column not in df.columns:
         raise HTTPException(status_code=400, detail=f"Column '{date_column}' not found in DataFrame.")
 
-    df[date_column] = pd.to_datetime(df[date_column], errors='coerce')
-    df['year'] = df[date_column].dt.year
-    df['month'] = df[date_column].dt.month
-    df['day'] = df[date_column].dt.day
+    dates, parts = parsed_dates(df, date_column), date_parts(df, date_column)
+    df = df.copy(deep=False)
+
+    df[date_column] = dates
+    df['year'] = parts['year']
+    df['month'] = parts['month']
+    df['day'] = parts['day']
+    # The result holds the same dates, the next date operations chained on it reuse them
+    frame_cache.derived(df).update({("dates", date_column): dates, ("date_parts", date_column): parts})
     return df
 
 
+@out_of_core.rowwise
 def date_difference(df, start_date_column, end_date_column, result_column_name):
     '''
     Description: This function calculates the difference between two dates in days and stores the result in a new column.
@@ -265,17 +361,38 @@ def date_difference(df, start_date_column, end_date_column, result_column_name):
     result_column_name (str): The name of the new column to store the result.
 
     Returns:
-    pd.DataFrame: The DataFrame with the new column added containing the difference in days between the two dates.
+    pd.DataFrame: A new DataFrame with the date columns parsed and the new column added containing the difference in days between the two dates, the input DataFrame is left unchanged.
     '''
     if start_date_column not in df.columns or end_date_column not in df.columns:
         raise HTTPException(status_code=400, detail="One or both date columns are missing in the DataFrame.")
 
-    df[start_date_column] = pd.to_datetime(df[start_date_column], errors='coerce')
-    df[end_date_column] = pd.to_datetime(df[end_date_column], errors='coerce')
-    df[result_column_name] = (df[end_date_column] - df[start_date_column]).dt.days
+    start, end = parsed_dates(df, start_date_column), parsed_dates(df, end_date_column)
+    df = df.copy(deep=False)
+
+    df[start_date_column] = start
+    df[end_date_column] = end
+    df[result_column_name] = (end - start).dt.days
+    if result_column_name not in (start_date_column, end_date_column):
+        frame_cache.derived(df).update({("dates", start_date_column): start, ("dates", end_date_column): end})
     return df
 
 
+def check_columns(df, columns):
+    '''
+    Description: This function checks that columns exist in a DataFrame.
+
+    Args:
+    df (pd.DataFrame): The DataFrame containing the data.
+    columns (list): The names of the columns.
+
+    Returns:
+    None
+    '''
+    missing = [col for col in columns if col not in df.columns]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Column(s) {missing} not found in DataFrame.")
+
+@out_of_core.rowwise
 def filter_data(df, column_name, value, dropna=True):
     '''
     Description: This function filters the data in a DataFrame based on a column value.
@@ -292,14 +409,15 @@ def filter_data(df, column_name, value, dropna=True):
     if column_name not in df.columns:
         raise HTTPException(status_code=400, detail=f"Column '{column_name}' not found in DataFrame.")
     
-    filtered_df = df[df[column_name] == value]
+    filtered_df = column_index.select(df, column_name, value)
     
     if dropna:
         filtered_df = filtered_df.dropna()
     
     return filtered_df
 
-def sum_with_filter(df, column_name, value):
+@out_of_core.streamed(out_of_core.sum_with_filter)
+def sum_with_filter(df, column_name, value, target_column=None):
     '''
     Description: This function calculates the sum of a column in a DataFrame after filtering based on a column value.
 
@@ -307,16 +425,19 @@ def sum_with_filter(df, column_name, value):
     df (pd.DataFrame): The DataFrame containing the data.
     column_name (str): The name of the column to filter on.
     value: The value to filter on.
+    target_column (str): The column to sum. If None, every numerical column is summed.
 
     Returns:
-    float: The sum of the column after filtering.
+    float or pd.Series: The sum of the target column, or of every numerical column, after filtering.
     '''
-    if column_name not in df.columns:
-        raise HTTPException(status_code=400, detail=f"Column '{column_name}' not found in DataFrame.")
-    
-    return df[df[column_name] == value].sum()
+    check_columns(df, [column_name] if target_column is None else [column_name, target_column])
+    rows = column_index.select(df, column_name, value)
+    if target_column is not None:
+        return rows[target_column].sum()
+    return rows[column_index.summary_columns(rows)].sum()
 
-def avg_with_filter(df, column_name, value):
+@out_of_core.streamed(out_of_core.avg_with_filter)
+def avg_with_filter(df, column_name, value, target_column=None):
     '''
     Description: This function calculates the average of a column in a DataFrame after filtering based on a column value.
 
@@ -324,15 +445,53 @@ def avg_with_filter(df, column_name, value):
     df (pd.DataFrame): The DataFrame containing the data.
     column_name (str): The name of the column to filter on.
     value: The value to filter on.
+    target_column (str): The column to average. If None, every numerical column is averaged.
 
     Returns:
-    float: The average of the column after filtering.
+    float or pd.Series: The average of the target column, or of every numerical column, after filtering.
     '''
-    if column_name not in df.columns:
-        raise HTTPException(status_code=400, detail=f"Column '{column_name}' not found in DataFrame.")
-    
-    return df[df[column_name] == value].mean(numeric_only=True)
+    check_columns(df, [column_name] if target_column is None else [column_name, target_column])
+    rows = column_index.select(df, column_name, value)
+    if target_column is not None:
+        return rows[target_column].mean()
+    return rows[column_index.summary_columns(rows)].mean()
+
+@out_of_core.in_memory
+def group_aggregate(df, group_by, measures=None, aggfuncs='sum'):
+    '''
+    Description: This function groups a DataFrame by one or more columns and computes one or more aggregations of one or more columns, in a single pass.
+
+    Args:
+    df (pd.DataFrame): The DataFrame containing the data.
+    group_by (str or list): The column(s) to group by.
+    measures (str or list): The column(s) to aggregate. If None, every numerical column that is not a group key is used.
+    aggfuncs (str or list): The aggregation(s) to compute. Choose from ['sum', 'mean', 'min', 'max', 'count', 'median', 'std', 'nunique'].
 
+    Returns:
+    pd.DataFrame: One row per group with the group keys and a '<measure>_<aggfunc>' column per measure and aggregation.
+    '''
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    check_columns(df, group_by)
+    if measures is None:
+        measures = [col for col in df.select_dtypes(include=["number", "bool"]).columns if col not in group_by]
+    else:
+        measures = [measures] if isinstance(measures, str) else list(measures)
+        check_columns(df, measures)
+    aggfuncs = [aggfuncs] if isinstance(aggfuncs, str) else list(aggfuncs)
+    unknown = [func for func in aggfuncs if func not in AGGREGATIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Invalid aggregation(s) {unknown}. Choose from {list(AGGREGATIONS)}")
+    funcs = list(dict.fromkeys(AGGREGATIONS[func] for func in aggfuncs))
+    if set(funcs) & NUMERIC_AGGREGATIONS:
+        non_numeric = [col for col in measures if not pd.api.types.is_numeric_dtype(df[col].dtype)]
+        if non_numeric:
+            raise HTTPException(status_code=400, detail=f"Column(s) {non_numeric} are not numerical, use 'count', 'nunique', 'min' or 'max'.")
+
+    result = df.groupby(group_by, observed=True)[measures].agg(funcs)
+    result.columns = [f"{measure}_{func}" for measure, func in result.columns]
+    return result.reset_index()
+
+@out_of_core.streamed(out_of_core.total_avg)
 def total_avg(df, column_name):
     '''
     Description: This function calculates the total average of a column in a DataFrame.
@@ -347,8 +506,12 @@ def total_avg(df, column_name):
     if column_name not in df.columns:
         raise HTTPException(status_code=400, detail=f"Column '{column_name}' not found in DataFrame.")
     
+    index = column_index.peek(df)
+    if index is not None and "mean" in index.stats[column_name]:
+        return index.stats[column_name]["mean"]
     return df[column_name].mean(numeric_only=True)
 
+@out_of_core.streamed(out_of_core.min_max_values)
 def min_max_values(df, column_name):
     '''
     Description: This function calculates the minimum and maximum values of a column in a DataFrame.
@@ -363,34 +526,31 @@ def min_max_values(df, column_name):
     if column_name not in df.columns:
         raise HTTPException(status_code=400, detail=f"Column '{column_name}' not found in DataFrame.")
     
+    index = column_index.peek(df)
+    if index is not None and "min" in index.stats[column_name]:
+        return index.stats[column_name]["min"], index.stats[column_name]["max"]
     return df[column_name].min(numeric_only=True), df[column_name].max(numeric_only=True)
 
-MAX_CHAR_LIMIT = 23000
-
-def truncate_text(text_list, max_chars=MAX_CHAR_LIMIT):
-    combined_text = "\n".join(text_list)
-    if len(combined_text) > max_chars:
-        combined_text = combined_text[:max_chars] 
-    return combined_text
-
-
-def get_sentiment(df,text_column):
+@out_of_core.in_memory
+def get_sentiment(df,text_column, backend=None):
     '''
-    Description: This function is used to get the sentiment of the text
+    Description: This function is used to get the sentiment of every entry of a text column. The labels of the texts already scored are read from the sentiment cache, the other entries are scored by the selected backend, so no entry is dropped.
     
     Args:
-    text: The text for which sentiment needs to be calculated
+    df (pd.DataFrame): The DataFrame containing the data.
+    text_column (str): The name of the text column.
+    backend (str): The sentiment backend, 'llm' (high accuracy) or 'lexicon' (local, fast bulk scoring). Default is the SENTIMENT_BACKEND setting.
     
     Returns:
-    sentiment: The sentiment of the text
+    pd.DataFrame: The text column with a 'Sentiment' column (Positive, Negative or Neutral) aligned to the DataFrame index, empty entries have no label. The number of rows served from the cache and newly scored are kept in the `attrs` of the DataFrame.
     '''
     if text_column not in df.columns:
         raise HTTPException(status_code=400, detail=f"Column '{text_column}' not found in the sheet.")
-    text_data = df[text_column].dropna().astype(str).tolist()
-    text_data = truncate_text(text_data)
-    prompt = f"Analyze the sentiment of the following text entries:\n{text_data}\n"
-    prompt += "Classify each entry as Positive, Negative, or Neutral."
-
-    result = groq_chat.invoke(prompt)
-    response = result.content
-    return response
\ No newline at end of file
+    text_data = df[text_column].dropna().astype(str)
+    labels, cache_stats = sentiment.score_texts_cached(sentiment.get_backend(backend, groq_chat, llm_limiter), text_data)
+
+    result = df[[text_column]].astype(object)
+    result['Sentiment'] = labels.reindex(df.index)
+    result = result.where(result.notna(), None)
+    result.attrs.update(cache_stats)
+    return result
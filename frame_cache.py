@@ -0,0 +1,65 @@
+# Per-DataFrame cache of derived data (join indexes, column indexes, ...). The loaded sheets and dataset versions are never mutated,
+# so what is derived from a DataFrame stays valid for as long as the DataFrame lives, and is dropped with it.
+
+import threading
+import weakref
+
+_caches = {}
+_lock = threading.Lock()
+
+
+def derived(df):
+    '''
+    Description: This function returns the cache of the data derived from a DataFrame. The cache is released when the DataFrame is garbage-collected.
+
+    Args:
+    df (pd.DataFrame): The DataFrame.
+
+    Returns:
+    dict: The cache of the DataFrame.
+    '''
+    key = id(df)
+    with _lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = {}
+            weakref.finalize(df, _release, key)
+        return cache
+
+
+def cached(df, name, build):
+    '''
+    Description: This function returns a value derived from a DataFrame, building it only on the first call.
+
+    Args:
+    df (pd.DataFrame): The DataFrame.
+    name (hashable): The name of the derived value.
+    build (callable): The function building the value.
+
+    Returns:
+    The derived value.
+    '''
+    cache = derived(df)
+    if name not in cache:
+        cache[name] = build()
+    return cache[name]
+
+
+def peek(df, name):
+    '''
+    Description: This function returns a value derived from a DataFrame if it was already built, without building it.
+
+    Args:
+    df (pd.DataFrame): The DataFrame.
+    name (hashable): The name of the derived value.
+
+    Returns:
+    The derived value, or None if it was not built.
+    '''
+    with _lock:
+        return _caches.get(id(df), {}).get(name)
+
+
+def _release(key):
+    with _lock:
+        _caches.pop(key, None)
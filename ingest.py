@@ -0,0 +1,209 @@
+# Background ingestion of the uploaded workbooks.
+#
+# The uploaded file is copied to a temporary file next to the workbook, in blocks, while it is hashed, so the workbook
+# is never read back to compute its content hash and the upload is never held in memory as a whole. The upload itself
+# is not streamed: the multipart body has already been spooled to a temporary file by Starlette when the endpoint
+# runs, so the file is written to disk twice. The parse then runs as a job in the worker pool: the upload returns
+# the job ID at once, and the job reports its stage and outcome on the status endpoint. The received file is parsed
+# without the dataset lock, which the job only takes to swap in the new workbook and its sheets once they are parsed,
+# so the operations keep being served from the previous workbook until the new one is ready.
+
+import asyncio
+import contextlib
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+from metrics import span
+
+INGEST_BLOCK_BYTES = int(os.getenv("INGEST_BLOCK_BYTES", 1024 * 1024))
+# Number of finished jobs whose status is kept
+INGEST_JOBS_MAX = int(os.getenv("INGEST_JOBS_MAX", 256))
+
+
+class IngestJob:
+    '''
+    Description: The state of the ingestion of one uploaded workbook.
+    '''
+
+    def __init__(self, dataset_id, workbook):
+        self.job_id = uuid.uuid4().hex
+        self.dataset_id = dataset_id
+        self.workbook = workbook
+        self.status = "receiving"
+        self.bytes_received = 0
+        self.sha256 = None
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        '''
+        Description: This function returns the status of the job.
+
+        Args:
+        None
+
+        Returns:
+        dict: The status of the job, with the parse result once it is done or the error if it failed.
+        '''
+        status = {
+            "job_id": self.job_id,
+            "dataset_id": self.dataset_id,
+            "workbook": self.workbook,
+            "status": self.status,
+            "bytes_received": self.bytes_received,
+            "sha256": self.sha256,
+            "seconds": round((self.finished or time.time()) - self.created, 4),
+        }
+        if self.result is not None:
+            status["result"] = self.result
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+
+class IngestJobs:
+    '''
+    Description: Registry of the ingestion jobs keyed by job ID, keeping the status of the last INGEST_JOBS_MAX jobs.
+    '''
+
+    def __init__(self, max_jobs=INGEST_JOBS_MAX):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, dataset_id, workbook):
+        '''
+        Description: This function registers a new job.
+
+        Args:
+        dataset_id (str): The dataset the workbook is uploaded to.
+        workbook (str): 'main' or 'second'.
+
+        Returns:
+        IngestJob: The job.
+        '''
+        job = IngestJob(dataset_id, workbook)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.finished is None:
+                    break
+                self._jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id):
+        '''
+        Description: This function returns a job.
+
+        Args:
+        job_id (str): The ID of the job.
+
+        Returns:
+        IngestJob: The job.
+        '''
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Upload job '{job_id}' not found or expired.")
+        return job
+
+    def stats(self):
+        '''
+        Description: This function returns the number of jobs per status.
+
+        Args:
+        None
+
+        Returns:
+        dict: The number of jobs per status.
+        '''
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+
+async def receive(upload, path, job):
+    '''
+    Description: This function copies an uploaded file, already spooled by Starlette, to a temporary file next to its destination in blocks, hashing it on the way.
+
+    Args:
+    upload (UploadFile): The uploaded file.
+    path (str): The destination of the file.
+    job (IngestJob): The job, its received bytes and hash are updated.
+
+    Returns:
+    str: The path of the temporary file.
+    '''
+    loop = asyncio.get_running_loop()
+    digest = hashlib.sha256()
+    tmp_path = f"{path}.{job.job_id}.tmp"
+    try:
+        with span("receive", workbook=job.workbook) as attributes, open(tmp_path, "wb") as buffer:
+            while True:
+                block = await upload.read(INGEST_BLOCK_BYTES)
+                if not block:
+                    break
+                digest.update(block)
+                await loop.run_in_executor(None, buffer.write, block)
+                job.bytes_received += len(block)
+            attributes["bytes"] = job.bytes_received
+    except BaseException:
+        # The file may not exist if the failure happened before it was opened
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    job.sha256 = digest.hexdigest()
+    job.status = "queued"
+    return tmp_path
+
+
+def run(job, dataset, tmp_path, sheet_names, engine=None, chunked=None):
+    '''
+    Description: This function runs an ingestion job: the received file replaces the workbook of the dataset, and its sheets are parsed, indexed and snapshotted.
+
+    Args:
+    job (IngestJob): The job.
+    dataset (Dataset): The dataset the workbook is uploaded to.
+    tmp_path (str): The received file.
+    sheet_names (list): The sheets to parse.
+    engine (str): The engine used to parse the workbook.
+    chunked (bool): Whether to ingest the workbook out of core, None to decide from its size.
+
+    Returns:
+    dict: The parsed sheets keyed like `sheet_names`, or None if the job failed.
+    '''
+    job.status = "parsing"
+    sheets = None
+    try:
+        with span("parse", workbook=job.workbook, job_id=job.job_id) as attributes:
+            sheets, parse_seconds, memory = dataset.ingest(job.workbook, tmp_path, job.sha256, sheet_names, engine, chunked)
+            attributes["rows_out"] = sum(len(df) for df in sheets.values())
+        job.result = {
+            "rows": {name: len(df) for name, df in zip(parse_seconds, sheets.values())},
+            "parse_seconds": parse_seconds,
+            "memory": memory,
+        }
+    except HTTPException as e:
+        job.error = e.detail
+    except Exception as e:
+        job.error = f"An error occurred while parsing the file: {str(e)}"
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    job.finished = time.time()
+    job.status = "done" if sheets is not None else "failed"
+    return sheets
+
+
+ingest_jobs = IngestJobs()
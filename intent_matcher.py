@@ -0,0 +1,232 @@
+# Deterministic matcher translating the common query shapes into excel_functions calls without calling the LLM.
+
+import re
+
+import pandas as pd
+
+import column_index
+import dtype_optimizer
+from out_of_core import ChunkedDataset
+
+SUM_WORDS = r"(?:total|sum)"
+AVG_WORDS = r"(?:average|avg|mean)"
+LEAD = r"(?:(?:what is|what's|what are|find|get|show|show me|give me|calculate|compute|list|display)\s+)?(?:the\s+)?"
+FILTER_LINK = r"(?:where|when|for|with|in|of)"
+IS_WORDS = r"(?:is|=|==|equals|equal to)"
+GROUP_LINK = r"(?:per|by|for each|for every|in each|across)"
+GROUP_SPLIT = re.compile(r"\s*(?:,|\band\b)\s*")
+AGGREGATION_WORDS = {"total": "sum", "sum": "sum", "average": "mean", "avg": "mean", "mean": "mean", "min": "min", "minimum": "min", "max": "max", "maximum": "max"}
+
+RULES = [
+    ("summary", re.compile(rf"^{LEAD}(?:a\s+)?summary(?:\s+(?:report|statistics|stats))?(?:\s+of\s+(?:all\s+)?(?:the\s+)?(?:numerical\s+)?(?:columns|fields|data))?$")),
+    ("min_max", re.compile(rf"^{LEAD}(?:min(?:imum)?\s+and\s+max(?:imum)?|max(?:imum)?\s+and\s+min(?:imum)?|range)(?:\s+values?)?\s+(?:of|for|in)\s+(?P<target>.+)$")),
+    ("group", re.compile(rf"^{LEAD}(?P<agg>{SUM_WORDS}|{AVG_WORDS}|min(?:imum)?|max(?:imum)?)(?:\s+of)?\s+(?P<target>.+?)\s+{GROUP_LINK}\s+(?P<groups>.+)$")),
+    ("sum_where", re.compile(rf"^{LEAD}{SUM_WORDS}(?:\s+of)?\s+(?P<target>.+?)\s+{FILTER_LINK}\s+(?P<column>.+?)\s+{IS_WORDS}\s+(?P<value>.+)$")),
+    ("avg_where", re.compile(rf"^{LEAD}{AVG_WORDS}(?:\s+of)?\s+(?P<target>.+?)\s+{FILTER_LINK}\s+(?P<column>.+?)\s+{IS_WORDS}\s+(?P<value>.+)$")),
+    ("sum_in", re.compile(rf"^{LEAD}{SUM_WORDS}(?:\s+of)?\s+(?P<target>.+?)\s+(?:in|for|of)\s+(?P<value>.+)$")),
+    ("avg_in", re.compile(rf"^{LEAD}{AVG_WORDS}(?:\s+of)?\s+(?P<target>.+?)\s+(?:in|for|of)\s+(?P<value>.+)$")),
+    ("avg", re.compile(rf"^{LEAD}(?:overall\s+|total\s+)?{AVG_WORDS}(?:\s+of)?\s+(?P<target>.+)$")),
+    ("filter", re.compile(rf"^{LEAD}(?:all\s+)?(?:rows|records|entries|employees|data)\s+(?:where|with)\s+(?P<column>.+?)\s+{IS_WORDS}\s+(?P<value>.+)$")),
+    ("filter_in", re.compile(rf"^{LEAD}(?:all\s+)?(?:rows|records|entries|employees|data)\s+(?:in|from|of)\s+(?P<value>.+)$")),
+    ("sentiment", re.compile(r"^(?:analy[sz]e\s+|get\s+|find\s+)?(?:the\s+)?sentiments?(?:\s+analysis)?\s+(?:of|for|on)\s+(?P<target>.+)$")),
+]
+
+FILLER = re.compile(r"^(?:the|all|every)\s+|\s+(?:column|field|values?)$")
+
+
+def normalize(text):
+    '''
+    Description: This function lower-cases a query and strips the punctuation around it.
+
+    Args:
+    text (str): The text to normalize.
+
+    Returns:
+    str: The normalized text.
+    '''
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.strip(" .?!")
+
+
+def find_column(df, text):
+    '''
+    Description: This function resolves a column mentioned in a query, matching case-insensitively and treating underscores as spaces.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    text (str): The text naming the column.
+
+    Returns:
+    str: The name of the column, or None if no column matches.
+    '''
+    text = text.strip(" '\"`")
+    previous = None
+    while previous != text:
+        previous = text
+        text = FILLER.sub("", text).strip(" '\"`")
+    wanted = text.replace("_", " ")
+    for col in df.columns:
+        if str(col).lower().replace("_", " ") == wanted:
+            return col
+    return None
+
+
+def searched_values(df, column):
+    '''
+    Description: This function returns the values searched for a value mentioned in a query: the distinct values of an indexed column, else the column itself. The columns of a ChunkedDataset are only searched when indexed, they are not loaded to match a query.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The dataset.
+    column (str): The column.
+
+    Returns:
+    pd.Series: The values, or None if the column is not searched.
+    '''
+    index = column_index.peek(df)
+    if index is not None and column in index.positions:
+        return pd.Series(list(index.positions[column]))
+    if isinstance(df, ChunkedDataset):
+        return None
+    return df[column]
+
+
+def find_value(series, text):
+    '''
+    Description: This function resolves a value mentioned in a query against the values of a column.
+
+    Args:
+    series (pd.Series): The values of the column to search, see searched_values.
+    text (str): The text naming the value.
+
+    Returns:
+    tuple: (True, value) if the value exists in the column, (False, None) otherwise.
+    '''
+    if series is None:
+        return False, None
+    text = text.strip(" '\"`")
+    if pd.api.types.is_bool_dtype(series.dtype):
+        value = dtype_optimizer.BOOLEAN_WORDS.get(text)
+        if value is None or not series.eq(value).any():
+            return False, None
+        return True, value
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        try:
+            number = float(text)
+        except ValueError:
+            return False, None
+        if not series.eq(number).any():
+            return False, None
+        return True, int(number) if number.is_integer() else number
+    for value in pd.unique(series.dropna()):
+        if isinstance(value, str) and value.lower() == text:
+            return True, str(value)
+    return False, None
+
+
+def find_filter(df, text):
+    '''
+    Description: This function resolves a bare value (e.g. "IT" or "the IT department") to the only text column containing it.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    text (str): The text naming the value.
+
+    Returns:
+    tuple: The column and the value, or None if the value is missing or found in several columns.
+    '''
+    text = text.strip(" '\"`")
+    text = re.sub(r"^the\s+", "", text)
+    matches = []
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df.dtypes[col]) or pd.api.types.is_datetime64_any_dtype(df.dtypes[col]):
+            continue
+        candidate = text
+        suffix = " " + str(col).lower().replace("_", " ")
+        if candidate.endswith(suffix):
+            candidate = candidate[:-len(suffix)]
+        found, value = find_value(searched_values(df, col), candidate)
+        if found:
+            matches.append((col, value))
+    return matches[0] if len(matches) == 1 else None
+
+
+def match_intent(df, query):
+    '''
+    Description: This function translates a query into a function call when it has one of the common shapes and every column and value it mentions exists in the dataset.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    query (str): The query provided by the user.
+
+    Returns:
+    str: The function call, or None if the query is ambiguous and should go to the LLM.
+    '''
+    text = normalize(query)
+    for name, pattern in RULES:
+        match = pattern.match(text)
+        if match is None:
+            continue
+        call = build_call(df, name, match.groupdict())
+        if call is not None:
+            return call
+    return None
+
+
+def build_call(df, name, slots):
+    '''
+    Description: This function builds the function call of a matched rule, resolving its columns and values.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    name (str): The name of the matched rule.
+    slots (dict): The text captured by the rule.
+
+    Returns:
+    str: The function call, or None if a column or a value could not be resolved.
+    '''
+    if name == "summary":
+        return "calculate_summary_report(df)"
+
+    if "target" in slots:
+        target = find_column(df, slots["target"])
+        if target is None:
+            return None
+        if name == "sentiment":
+            return f"get_sentiment(df, {target!r})"
+        if not pd.api.types.is_numeric_dtype(df.dtypes[target]) or pd.api.types.is_bool_dtype(df.dtypes[target]):
+            return None
+        if name == "min_max":
+            return f"min_max_values(df, {target!r})"
+        if name == "avg":
+            return f"total_avg(df, {target!r})"
+        if name == "group":
+            groups = [find_column(df, part) for part in GROUP_SPLIT.split(slots["groups"]) if part]
+            if not groups or None in groups or target in groups:
+                return None
+            group_by = groups[0] if len(groups) == 1 else groups
+            return f"group_aggregate(df, {group_by!r}, {target!r}, {AGGREGATION_WORDS[slots['agg']]!r})"
+
+    if "column" in slots:
+        column = find_column(df, slots["column"])
+        if column is None:
+            return None
+        found, value = find_value(searched_values(df, column), slots["value"])
+        if not found:
+            return None
+    else:
+        resolved = find_filter(df, slots["value"])
+        if resolved is None:
+            return None
+        column, value = resolved
+
+    function_name = {
+        "sum_where": "sum_with_filter",
+        "sum_in": "sum_with_filter",
+        "avg_where": "avg_with_filter",
+        "avg_in": "avg_with_filter",
+        "filter": "filter_data",
+        "filter_in": "filter_data",
+    }[name]
+    if "target" in slots:
+        return f"{function_name}(df, {column!r}, {value!r}, {target!r})"
+    return f"{function_name}(df, {column!r}, {value!r})"
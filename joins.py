@@ -0,0 +1,233 @@
+# Join helpers for join_datasets: dtype alignment of the keys, key indexes cached per DataFrame and a chunked
+# out-of-core path for large left datasets.
+#
+# The key index of a dataset (the row positions of the dataset indexed by its aligned keys) is cached with the dataset in
+# the frame cache, so the hash table pandas builds on the index is reused by every join on the same keys instead of being
+# rebuilt. Only the keys and the positions are cached, the joined rows are taken from the datasets themselves. When both
+# keys are sorted pandas merges them directly instead of hashing.
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from fastapi import HTTPException
+
+import frame_cache
+
+JOIN_TYPES = ("inner", "left", "right", "outer", "cross")
+# Left datasets longer than this are joined one chunk at a time (inner and left joins only)
+JOIN_CHUNK_ROWS = int(os.getenv("JOIN_CHUNK_ROWS", 500000))
+# Directory the joined chunks are spilled to as Arrow files, keeping them in memory if empty
+JOIN_SPILL_DIRECTORY = os.getenv("JOIN_SPILL_DIRECTORY", "")
+
+
+def key_dtypes(left, right, on):
+    '''
+    Description: This function chooses the common dtype of each join key: the common numeric dtype when both keys are numeric, else string.
+
+    Args:
+    left (pd.DataFrame): The left dataset.
+    right (pd.DataFrame): The right dataset.
+    on (list): The join keys.
+
+    Returns:
+    dict: The dtype of each join key.
+    '''
+    dtypes = {}
+    for key in on:
+        left_dtype, right_dtype = left[key].dtype, right[key].dtype
+        if left_dtype == right_dtype:
+            dtypes[key] = left_dtype
+        elif pd.api.types.is_numeric_dtype(left_dtype) and pd.api.types.is_numeric_dtype(right_dtype):
+            both_integer = pd.api.types.is_integer_dtype(left_dtype) and pd.api.types.is_integer_dtype(right_dtype)
+            dtypes[key] = "int64" if both_integer else "float64"
+        else:
+            dtypes[key] = "str"
+    return dtypes
+
+
+def align_keys(df, dtypes):
+    '''
+    Description: This function casts the join keys of a dataset to their common dtype.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    dtypes (dict): The dtype of each join key.
+
+    Returns:
+    pd.DataFrame: The dataset with aligned keys, the dataset itself if they already have the right dtype.
+    '''
+    casts = {key: dtype for key, dtype in dtypes.items() if df[key].dtype != dtype}
+    if not casts:
+        return df
+    return df.astype(casts)
+
+
+def key_positions(df, dtypes):
+    '''
+    Description: This function returns the row positions of a dataset indexed by its aligned join keys.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    dtypes (dict): The dtype of each join key.
+
+    Returns:
+    pd.Series: The position of each row, indexed by the join keys.
+    '''
+    keys = align_keys(df[list(dtypes)], dtypes)
+    return keys.assign(position=np.arange(len(df))).set_index(list(dtypes))["position"]
+
+
+def key_index(df, dtypes):
+    '''
+    Description: This function returns the row positions of a dataset indexed by its aligned join keys, cached with the dataset. The cache holds the keys and the positions only, not a copy of the dataset.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    dtypes (dict): The dtype of each join key.
+
+    Returns:
+    pd.Series: The position of each row, indexed by the join keys.
+    '''
+    name = ("join_index", tuple((key, str(dtype)) for key, dtype in dtypes.items()))
+    return frame_cache.cached(df, name, lambda: key_positions(df, dtypes))
+
+
+def take_rows(df, positions):
+    '''
+    Description: This function takes rows of a dataset by position, a missing position giving a row of nulls (the unmatched rows of outer joins).
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    positions (pd.Series): The row positions, NaN for the missing rows.
+
+    Returns:
+    pd.DataFrame: The rows, with a default index.
+    '''
+    if positions.isna().any():
+        return df.reset_index(drop=True).reindex(positions.to_numpy()).reset_index(drop=True)
+    return df.take(positions.to_numpy(dtype=np.int64)).reset_index(drop=True)
+
+
+def join_indexed(left, right, left_positions, right_positions, how, on):
+    '''
+    Description: This function joins two datasets on their key indexes and takes the joined rows from the datasets, the keys as the first columns.
+
+    Args:
+    left (pd.DataFrame): The left dataset.
+    right (pd.DataFrame): The right dataset.
+    left_positions (pd.Series): The row positions of the left dataset indexed by the join keys.
+    right_positions (pd.Series): The row positions of the right dataset indexed by the join keys.
+    how (str): The type of join.
+    on (list): The join keys.
+
+    Returns:
+    pd.DataFrame: The joined dataset, overlapping columns taking the '_x' and '_y' suffixes.
+    '''
+    matches = left_positions.to_frame("left").join(right_positions.to_frame("right"), how=how)
+    overlap = (set(left.columns) & set(right.columns)) - set(on)
+    left_rows = take_rows(left.drop(columns=on), matches["left"]).rename(columns=lambda col: f"{col}_x" if col in overlap else col)
+    right_rows = take_rows(right.drop(columns=on), matches["right"]).rename(columns=lambda col: f"{col}_y" if col in overlap else col)
+    keys = matches.index.to_frame(index=False)
+    return pd.concat([keys, left_rows, right_rows], axis=1)
+
+
+def column_order(left, right, on):
+    '''
+    Description: This function returns the columns of a join in the order pd.merge gives them, overlapping columns taking the '_x' and '_y' suffixes.
+
+    Args:
+    left (pd.DataFrame): The left dataset.
+    right (pd.DataFrame): The right dataset.
+    on (list): The join keys.
+
+    Returns:
+    list: The ordered columns.
+    '''
+    overlap = (set(left.columns) & set(right.columns)) - set(on)
+    order = [f"{col}_x" if col in overlap else col for col in left.columns]
+    order += [f"{col}_y" if col in overlap else col for col in right.columns if col not in on]
+    return order
+
+
+def chunked_join(left, right, right_positions, how, dtypes, chunk_rows=JOIN_CHUNK_ROWS, spill_directory=JOIN_SPILL_DIRECTORY):
+    '''
+    Description: This function joins a large left dataset one chunk at a time, so that only one chunk of the left keys is hashed and joined at a time. The joined chunks are spilled to Arrow files when a spill directory is set.
+
+    Args:
+    left (pd.DataFrame): The left dataset.
+    right (pd.DataFrame): The right dataset.
+    right_positions (pd.Series): The row positions of the right dataset indexed by the join keys.
+    how (str): 'inner' or 'left'.
+    dtypes (dict): The dtype of each join key.
+    chunk_rows (int): The number of left rows joined at a time.
+    spill_directory (str): The directory of the spill files, the chunks are kept in memory if empty.
+
+    Returns:
+    pd.DataFrame: The joined dataset.
+    '''
+    chunks = []
+    for start in range(0, len(left), chunk_rows):
+        chunk = left.iloc[start:start + chunk_rows]
+        chunks.append(join_indexed(chunk, right, key_positions(chunk, dtypes), right_positions, how, list(dtypes)))
+        if spill_directory:
+            chunks[-1] = spill(chunks[-1], spill_directory)
+    if not spill_directory:
+        return pd.concat(chunks, ignore_index=True)
+    return pa.concat_tables(chunks, promote_options="default").to_pandas(split_blocks=True)
+
+
+def spill(df, spill_directory):
+    '''
+    Description: This function writes a joined chunk to an Arrow file and memory-maps it back, so that its pages can be dropped from memory until the chunks are concatenated.
+
+    Args:
+    df (pd.DataFrame): The joined chunk.
+    spill_directory (str): The directory of the spill file.
+
+    Returns:
+    pa.Table: The memory-mapped chunk.
+    '''
+    os.makedirs(spill_directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".arrow", dir=spill_directory)
+    os.close(fd)
+    try:
+        feather.write_feather(df, path, compression="uncompressed")
+        return feather.read_table(path, memory_map=True)
+    finally:
+        # The mapping stays valid after the file is unlinked
+        os.remove(path)
+
+
+def join(left, right, how="inner", on=None):
+    '''
+    Description: This function joins two datasets on aligned, cached key indexes.
+
+    Args:
+    left (pd.DataFrame): The left dataset.
+    right (pd.DataFrame): The right dataset.
+    how (str): The type of join, one of JOIN_TYPES.
+    on (str or list): The join keys.
+
+    Returns:
+    pd.DataFrame: The joined dataset.
+    '''
+    if how not in JOIN_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid join type '{how}'. Choose from {list(JOIN_TYPES)}")
+    if how == "cross":
+        return pd.merge(left, right, how="cross")
+    on = [on] if isinstance(on, str) else list(on)
+    missing = [key for key in on if key not in left.columns or key not in right.columns]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Join column(s) {missing} not found in both datasets.")
+
+    dtypes = key_dtypes(left, right, on)
+    right_positions = key_index(right, dtypes)
+    if how in ("inner", "left") and len(left) > JOIN_CHUNK_ROWS:
+        joined = chunked_join(left, right, right_positions, how, dtypes)
+    else:
+        joined = join_indexed(left, right, key_index(left, dtypes), right_positions, how, on)
+    return joined[column_order(left, right, on)]
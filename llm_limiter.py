@@ -0,0 +1,53 @@
+# Global limit on the concurrent LLM calls, shared by the query translations and the sentiment scoring.
+
+import asyncio
+import os
+
+from fastapi import HTTPException
+
+from metrics import span
+from prompt_builder import prompt_stats
+
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', 8))
+LLM_MAX_PENDING = int(os.getenv('LLM_MAX_PENDING', 64))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 30))
+
+
+class LLMLimiter:
+    '''
+    Description: Bounds the number of concurrent LLM calls. Requests beyond LLM_CONCURRENCY wait for a slot, and once LLM_MAX_PENDING requests are waiting new ones are rejected instead of queueing behind slow model calls.
+    '''
+
+    def __init__(self, concurrency=LLM_CONCURRENCY, max_pending=LLM_MAX_PENDING, timeout=LLM_TIMEOUT):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+
+    async def invoke(self, llm, prompt):
+        '''
+        Description: This function sends a prompt to the LLM without blocking the event loop.
+
+        Args:
+        llm: The chat model.
+        prompt (str): The prompt sent to the LLM.
+
+        Returns:
+        str: The content of the LLM response.
+        '''
+        if self.pending >= self.max_pending:
+            raise HTTPException(status_code=503, detail="Too many queries waiting for the LLM, please retry later.")
+        self.pending += 1
+        try:
+            with span("llm") as attributes:
+                async with self.semaphore:
+                    result = await asyncio.wait_for(llm.ainvoke(prompt), timeout=self.timeout)
+                attributes.update(prompt_stats.record(prompt, result))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=f"The LLM did not answer within {self.timeout} seconds.")
+        finally:
+            self.pending -= 1
+        return result.content
+
+
+llm_limiter = LLMLimiter()
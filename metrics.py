@@ -0,0 +1,327 @@
+# Timing spans and Prometheus metrics of the request stages.
+#
+# Every stage of a request (loading the dataset, translating the query, compiling and running the operation,
+# serializing the result, receiving and parsing an upload) runs in a span. A span records its duration in the
+# excel_ai_stage_seconds histogram and its rows in and out in the excel_ai_stage_rows histogram, and is appended with
+# its attributes (rows, tokens, cache outcome, ...) to the profile of the current request, which is returned in the
+# X-Profile response header when the request sends an X-Profile header. The metrics are served in the Prometheus text
+# format on /metrics, together with the counters of the caches.
+#
+# The profile of a request is held in a context variable, so the spans of the work a request runs in the worker pool
+# are added to it as long as the work runs in a copy of the request context (see app.run_in_worker).
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+METRIC_PREFIX = "excel_ai"
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+# Span attributes recorded in the excel_ai_stage_rows histogram
+ROW_ATTRIBUTES = ("rows_in", "rows_out")
+
+_profile = ContextVar("request_profile", default=None)
+_current = ContextVar("current_span", default=None)
+
+
+def label_text(names, values):
+    '''
+    Description: This function formats the labels of a sample.
+
+    Args:
+    names (tuple): The names of the labels.
+    values (tuple): Their values.
+
+    Returns:
+    str: The labels in the Prometheus text format, empty if there are none.
+    '''
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    '''
+    Description: This function escapes a label value.
+
+    Args:
+    value: The label value.
+
+    Returns:
+    str: The escaped value.
+    '''
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    '''
+    Description: A Prometheus counter, one value per combination of label values.
+    '''
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        '''
+        Description: This function increments the counter.
+
+        Args:
+        amount (float): The increment.
+        labels: The label values.
+
+        Returns:
+        None
+        '''
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        '''
+        Description: This function returns the samples of the counter.
+
+        Args:
+        None
+
+        Returns:
+        list: The lines of the samples.
+        '''
+        with self._lock:
+            return [f"{self.name}{label_text(self.labels, key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    '''
+    Description: A Prometheus histogram with fixed buckets, one per combination of label values.
+    '''
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        '''
+        Description: This function records an observation.
+
+        Args:
+        value (float): The observed value.
+        labels: The label values.
+
+        Returns:
+        None
+        '''
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][position] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        '''
+        Description: This function returns the samples of the histogram: the cumulative bucket counts, the sum and the count.
+
+        Args:
+        None
+
+        Returns:
+        list: The lines of the samples.
+        '''
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{label_text(self.labels + ('le',), key + (bound,))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{label_text(self.labels + ('le',), key + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{label_text(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{label_text(self.labels, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    '''
+    Description: The metrics of the engine, rendered in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+        self.requests = self.counter("requests_total", "Requests served, by route and status.", ("route", "status"))
+        self.request_seconds = self.histogram("request_seconds", "Duration of the requests, by route.", ("route",))
+        self.response_bytes = self.histogram("response_bytes", "Size of the (non-streamed) response bodies, by route.", ("route",), BYTES_BUCKETS)
+        self.stage_seconds = self.histogram("stage_seconds", "Duration of the request stages.", ("stage",))
+        self.stage_rows = self.histogram("stage_rows", "Rows read (rows_in) and produced (rows_out) by the request stages.", ("stage", "direction"), ROWS_BUCKETS)
+        self.stage_errors = self.counter("stage_errors_total", "Request stages that raised an error.", ("stage",))
+        self.translations = self.counter("translations_total", "Queries translated, by source (intent matcher, translation cache or LLM).", ("source",))
+
+    def counter(self, name, description, labels=()):
+        '''
+        Description: This function registers a counter.
+
+        Args:
+        name (str): The name of the counter, without the prefix.
+        description (str): The help text.
+        labels (tuple): The names of its labels.
+
+        Returns:
+        Counter: The counter.
+        '''
+        metric = Counter(f"{METRIC_PREFIX}_{name}", description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, labels=(), buckets=SECONDS_BUCKETS):
+        '''
+        Description: This function registers a histogram.
+
+        Args:
+        name (str): The name of the histogram, without the prefix.
+        description (str): The help text.
+        labels (tuple): The names of its labels.
+        buckets (tuple): The upper bounds of its buckets.
+
+        Returns:
+        Histogram: The histogram.
+        '''
+        metric = Histogram(f"{METRIC_PREFIX}_{name}", description, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, stats=None):
+        '''
+        Description: This function renders the metrics, and the statistics of the caches as untyped samples (e.g. excel_ai_workbook_cache_hits).
+
+        Args:
+        stats (dict): The statistics of each cache, as returned by /cache-stats.
+
+        Returns:
+        str: The metrics in the Prometheus text format.
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        for section, values in (stats or {}).items():
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{METRIC_PREFIX}_{section}_{key}"
+                lines.append(f"# TYPE {name} untyped")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def span(stage, **attributes):
+    '''
+    Description: This context manager times a stage of the request. The attributes yielded can be completed in the block (e.g. rows_out, source) and are added to the profile of the request.
+
+    Args:
+    stage (str): The name of the stage, e.g. 'translate' or 'execute'.
+    attributes: The attributes of the stage known when it starts, e.g. rows_in.
+
+    Yields:
+    dict: The attributes of the stage.
+    '''
+    start = time.perf_counter()
+    token = _current.set(attributes)
+    try:
+        yield attributes
+    except BaseException:
+        attributes["error"] = True
+        metrics.stage_errors.inc(stage=stage)
+        raise
+    finally:
+        _current.reset(token)
+        seconds = time.perf_counter() - start
+        metrics.stage_seconds.observe(seconds, stage=stage)
+        for name in ROW_ATTRIBUTES:
+            if attributes.get(name) is not None:
+                metrics.stage_rows.observe(attributes[name], stage=stage, direction=name[5:])
+        profile = _profile.get()
+        if profile is not None:
+            profile.append({"stage": stage, "seconds": round(seconds, 6), **attributes})
+
+
+def annotate(**attributes):
+    '''
+    Description: This function adds attributes to the innermost span running, if any, e.g. the cache outcome of a lookup made inside the span.
+
+    Args:
+    attributes: The attributes.
+
+    Returns:
+    None
+    '''
+    current = _current.get()
+    if current is not None:
+        current.update(attributes)
+
+
+def start_profile():
+    '''
+    Description: This function starts the profile of the current request.
+
+    Args:
+    None
+
+    Returns:
+    list: The spans of the request, appended as they end.
+    '''
+    profile = []
+    _profile.set(profile)
+    return profile
+
+
+def profile_header(profile, seconds, response_bytes=None):
+    '''
+    Description: This function formats the profile of a request for the X-Profile response header.
+
+    Args:
+    profile (list): The spans of the request.
+    seconds (float): The duration of the request.
+    response_bytes (int): The size of the response body, if known.
+
+    Returns:
+    str: The profile as compact JSON.
+    '''
+    summary = {"seconds": round(seconds, 6), "spans": profile}
+    if response_bytes is not None:
+        summary["response_bytes"] = response_bytes
+    return json.dumps(summary, separators=(",", ":"), default=str)
+
+
+def rows(value):
+    '''
+    Description: This function returns the number of rows of an operation input or output.
+
+    Args:
+    value: The input or output of the operation.
+
+    Returns:
+    int: The number of rows of a table, None for the other outputs.
+    '''
+    shape = getattr(value, "shape", None)
+    return int(shape[0]) if shape else None
+
+
+metrics = MetricsRegistry()
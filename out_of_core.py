@@ -0,0 +1,862 @@
+# Out-of-core execution of the operations on the sheets too large to be held in memory.
+#
+# A large workbook (OUT_OF_CORE_MIN_BYTES or more, or when the upload asks for it) is not parsed into DataFrames: its
+# sheets are streamed row by row from openpyxl's read-only mode into the record batches of their Arrow snapshot, and
+# are served as ChunkedDatasets, which memory-map the snapshot and convert it to pandas one chunk of rows at a time.
+# The chunks are sized so that the memory used to process one of them stays within OUT_OF_CORE_MEMORY_BUDGET.
+#
+# The operations run on a ChunkedDataset in one of three ways, chosen with a decorator in excel_functions:
+# - rowwise: the operation (filters, column maths, date columns) is applied to each chunk and the chunks of its result
+#   are spilled to an Arrow file in OUT_OF_CORE_SPILL_DIRECTORY, itself served as a ChunkedDataset;
+# - streamed: the aggregation is computed as partial aggregates of each chunk (sums, counts, minimums, maximums) that
+#   are merged at the end, the aggregations that cannot be merged fall back to in_memory;
+# - in_memory: the dataset is loaded as a DataFrame if it fits in the budget, else the operation is refused.
+
+import functools
+import inspect
+import os
+import tempfile
+import time
+import uuid
+import weakref
+
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from fastapi import HTTPException
+
+import column_index
+import dtype_optimizer
+import frame_cache
+import snapshot
+from metrics import annotate
+
+# Workbooks of this size or more are ingested out of core, unless the upload says otherwise
+OUT_OF_CORE_MIN_BYTES = int(os.getenv("OUT_OF_CORE_MIN_BYTES", 200 * 1024 * 1024))
+# Memory the processing of one chunk may use, and the largest dataset loaded in memory by the in_memory operations
+OUT_OF_CORE_MEMORY_BUDGET = int(os.getenv("OUT_OF_CORE_MEMORY_BUDGET", 256 * 1024 * 1024))
+OUT_OF_CORE_SPILL_DIRECTORY = os.getenv("OUT_OF_CORE_SPILL_DIRECTORY") or os.path.join(tempfile.gettempdir(), "excel_ai_spill")
+# Rows of a page of a chunked result returned as JSON when the request sets no limit
+OUT_OF_CORE_PAGE_ROWS = int(os.getenv("OUT_OF_CORE_PAGE_ROWS", 10000))
+# Memory used while processing a chunk, relative to the memory of the chunk itself (copies, masks, intermediate columns)
+WORKING_FACTOR = 4
+# Approximate memory of a cell read by openpyxl (a Python object in a row tuple)
+CELL_BYTES = 100
+# Rows converted to measure the memory of a row in pandas
+SAMPLE_ROWS = 1024
+# Partial aggregates and the aggregation merging them
+MERGES = {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+
+
+class ChunkedDataset:
+    '''
+    Description: A dataset whose rows stay on disk, in a memory-mapped Arrow file, and are read one chunk of rows at a time. It has the `columns`, `dtypes`, `shape` and `attrs` of a DataFrame, so the code describing or checking a dataset works on both.
+    '''
+
+    def __init__(self, table, path=None, owned=False):
+        self.table = table
+        self.path = path
+        self.owned = owned
+        self.attrs = {}
+        self._dtypes = None
+        self._row_bytes = {}
+        if owned:
+            # Spilled results are deleted with the last dataset reading them
+            weakref.finalize(self, remove_file, path)
+
+    @classmethod
+    def open(cls, path, owned=False):
+        '''
+        Description: This function memory-maps an Arrow file as a ChunkedDataset.
+
+        Args:
+        path (str): The path of the file.
+        owned (bool): Whether the file is deleted when the dataset is garbage-collected. Default is False.
+
+        Returns:
+        ChunkedDataset: The dataset.
+        '''
+        return cls(feather.read_table(path, memory_map=True), path, owned)
+
+    @property
+    def columns(self):
+        return pd.Index(self.table.column_names)
+
+    @property
+    def dtypes(self):
+        if self._dtypes is None:
+            self._dtypes = self.table.schema.empty_table().to_pandas().dtypes
+        return self._dtypes
+
+    @property
+    def shape(self):
+        return (self.table.num_rows, self.table.num_columns)
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __getitem__(self, column):
+        return self.to_pandas([column])[column]
+
+    def row_bytes(self, columns=None):
+        '''
+        Description: This function estimates the memory of a row in pandas, from the conversion of the first rows.
+
+        Args:
+        columns (list): The columns converted, all of them if None.
+
+        Returns:
+        float: The estimated number of bytes per row.
+        '''
+        key = None if columns is None else tuple(columns)
+        if key not in self._row_bytes:
+            table = self.table if columns is None else self.table.select(list(columns))
+            sample = table.slice(0, SAMPLE_ROWS).to_pandas()
+            self._row_bytes[key] = max(float(sample.memory_usage(deep=True, index=False).sum()) / max(len(sample), 1), 1.0)
+        return self._row_bytes[key]
+
+    def memory_bytes(self, columns=None):
+        '''
+        Description: This function estimates the memory of the dataset loaded as a DataFrame.
+
+        Args:
+        columns (list): The columns loaded, all of them if None.
+
+        Returns:
+        int: The estimated number of bytes.
+        '''
+        return int(self.row_bytes(columns) * len(self))
+
+    def chunk_rows(self, columns=None):
+        '''
+        Description: This function returns the number of rows of a chunk, so that processing it stays within the memory budget.
+
+        Args:
+        columns (list): The columns of the chunks, all of them if None.
+
+        Returns:
+        int: The number of rows per chunk.
+        '''
+        return max(1, int(OUT_OF_CORE_MEMORY_BUDGET // (self.row_bytes(columns) * WORKING_FACTOR)))
+
+    def iter_chunks(self, columns=None, batch_rows=None):
+        '''
+        Description: This function reads the dataset one chunk of rows at a time. An empty dataset yields one empty chunk, so the operations still see its columns.
+
+        Args:
+        columns (list): The columns to read, all of them if None.
+        batch_rows (int): The maximum number of rows per chunk, the chunks are only sized by the memory budget if None.
+
+        Yields:
+        pd.DataFrame: The rows of a chunk.
+        '''
+        table = self.table if columns is None else self.table.select(list(columns))
+        step = self.chunk_rows(columns)
+        if batch_rows:
+            step = min(step, batch_rows)
+        for start in range(0, max(len(self), 1), step):
+            yield table.slice(start, step).to_pandas(split_blocks=True)
+
+    def to_pandas(self, columns=None):
+        '''
+        Description: This function loads the dataset as a DataFrame, if it fits in the memory budget.
+
+        Args:
+        columns (list): The columns to load, all of them if None.
+
+        Returns:
+        pd.DataFrame: The dataset.
+        '''
+        size = self.memory_bytes(columns)
+        if size > OUT_OF_CORE_MEMORY_BUDGET:
+            raise HTTPException(status_code=413, detail=f"The dataset has {len(self)} rows (about {size / 2**20:.1f} MB in memory), more than the memory budget of {OUT_OF_CORE_MEMORY_BUDGET / 2**20:.1f} MB of the out-of-core mode. Filter it first or request it in pages.")
+        table = self.table if columns is None else self.table.select(list(columns))
+        return table.to_pandas(split_blocks=True)
+
+    def slice(self, offset, length):
+        '''
+        Description: This function returns a range of rows of the dataset, without reading them.
+
+        Args:
+        offset (int): The first row.
+        length (int): The number of rows.
+
+        Returns:
+        ChunkedDataset: The rows.
+        '''
+        return ChunkedDataset(self.table.slice(offset, length), self.path)
+
+
+class SpillWriter:
+    '''
+    Description: Writes the chunks of a result to an Arrow file of the spill directory, one record batch per chunk.
+    '''
+
+    def __init__(self, schema, directory=OUT_OF_CORE_SPILL_DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{uuid.uuid4().hex}.arrow")
+        self.schema = schema
+        self._writer = None
+
+    def write(self, df):
+        '''
+        Description: This function appends a chunk of the result, converted to the schema of the result.
+
+        Args:
+        df (pd.DataFrame): The chunk.
+
+        Returns:
+        None
+        '''
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        if self._writer is None:
+            self._writer = pa.ipc.new_file(self.path, self.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        '''
+        Description: This function finishes the file and opens it as the result.
+
+        Args:
+        None
+
+        Returns:
+        ChunkedDataset: The result, its file is deleted when it is garbage-collected.
+        '''
+        self._writer.close()
+        return ChunkedDataset.open(self.path, owned=True)
+
+    def discard(self):
+        '''
+        Description: This function deletes the file of a result that failed.
+
+        Args:
+        None
+
+        Returns:
+        None
+        '''
+        if self._writer is not None:
+            self._writer.close()
+        remove_file(self.path)
+
+
+class ChunkedIndex(column_index.ColumnIndex):
+    '''
+    Description: The column index of a ChunkedDataset, built in one pass over its chunks: the statistics and the summary report of its columns, and the distinct values of its low-cardinality columns. It keeps no row positions, so the filters scan the chunks.
+    '''
+
+    def __init__(self, ds, max_cardinality=column_index.COLUMN_INDEX_MAX_CARDINALITY):
+        self.rows = len(ds)
+        dtypes = ds.dtypes
+        partials, counts = [], []
+        # Distinct values of the columns with at most max_cardinality of them, in order of appearance
+        values = {column: {} for column, dtype in dtypes.items() if not pd.api.types.is_datetime64_any_dtype(dtype) and not pd.api.types.is_timedelta64_dtype(dtype)}
+        for chunk in ds.iter_chunks():
+            partials.append(summary_partial(chunk))
+            counts.append(chunk.count())
+            for column in list(values):
+                try:
+                    values[column].update(dict.fromkeys(pd.unique(chunk[column].dropna())))
+                except TypeError:
+                    values[column] = None
+                if values[column] is None or len(values[column]) > max_cardinality:
+                    del values[column]
+
+        self.summary = merge_summary(partials)
+        count = pd.concat(counts, axis=1).sum(axis=1)
+        self.stats = {}
+        for column, dtype in dtypes.items():
+            stats = {"dtype": str(dtype), "count": int(count[column]), "null_count": self.rows - int(count[column])}
+            if column in self.summary.index:
+                summary = self.summary
+                stats.update(sum=summary.at[column, "sum"], mean=summary.at[column, "average"], min=summary.at[column, "min"], max=summary.at[column, "max"])
+            self.stats[column] = stats
+        self.codes = {}
+        self.positions = {column: dict.fromkeys(found) for column, found in values.items() if found}
+
+    def lookup(self, column, value):
+        return None
+
+
+def page_rows(ds):
+    '''
+    Description: This function returns the number of rows of a JSON page of a chunked result when the request sets no limit.
+
+    Args:
+    ds (ChunkedDataset): The result.
+
+    Returns:
+    int: OUT_OF_CORE_PAGE_ROWS, or fewer if a page that large would not fit in the memory budget.
+    '''
+    return min(OUT_OF_CORE_PAGE_ROWS, ds.chunk_rows())
+
+
+def remove_file(path):
+    '''
+    Description: This function deletes a file if it still exists.
+
+    Args:
+    path (str): The path of the file.
+
+    Returns:
+    None
+    '''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def wants_chunks(path):
+    '''
+    Description: This function tells whether a workbook is large enough to be ingested out of core.
+
+    Args:
+    path (str): The path of the workbook.
+
+    Returns:
+    bool: Whether the workbook is at least OUT_OF_CORE_MIN_BYTES.
+    '''
+    return os.path.getsize(path) >= OUT_OF_CORE_MIN_BYTES
+
+
+def column_names(header):
+    '''
+    Description: This function names the columns from the header row like pandas does: unnamed columns are 'Unnamed: <position>' and repeated names get a '.<n>' suffix.
+
+    Args:
+    header (tuple): The values of the header row.
+
+    Returns:
+    list: The column names.
+    '''
+    names, seen = [], {}
+    for position, value in enumerate(header):
+        name = f"Unnamed: {position}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def to_arrow(rows, names):
+    '''
+    Description: This function converts a batch of rows read by openpyxl into an Arrow table. The columns holding values of several types are converted to text.
+
+    Args:
+    rows (list): The row tuples.
+    names (list): The column names.
+
+    Returns:
+    pa.Table: The batch.
+    '''
+    df = pd.DataFrame.from_records(rows, columns=names)
+    arrays = []
+    for name in names:
+        try:
+            array = pa.array(df[name], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            array = pa.array(df[name].map(lambda value: None if pd.isna(value) else str(value)), type=pa.string(), from_pandas=True)
+        if pa.types.is_large_string(array.type):
+            array = array.cast(pa.string())
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=[str(name) for name in names])
+
+
+def common_type(types):
+    '''
+    Description: This function returns the type of a column whose batches were read with different types: the numbers of the batches mixing integers and floats are floats, the other mixes are text.
+
+    Args:
+    types (list): The types of the column in each batch.
+
+    Returns:
+    pa.DataType: The type of the column.
+    '''
+    types = [t for t in types if not pa.types.is_null(t)]
+    if not types:
+        return pa.string()
+    if all(t == types[0] for t in types):
+        return types[0]
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64() if any(pa.types.is_floating(t) for t in types) else pa.int64()
+    if all(pa.types.is_timestamp(t) for t in types):
+        return types[0]
+    return pa.string()
+
+
+def ingest_sheet(worksheet, xlsx_path, sheet_name, source_hash):
+    '''
+    Description: This function streams a sheet into its snapshot, one batch of rows at a time. The batches are first spooled with their own types, then written with the types common to all of them.
+
+    Args:
+    worksheet: The read-only openpyxl worksheet.
+    xlsx_path (str): The path of the workbook.
+    sheet_name (str or int): The name or the position of the sheet, as the snapshot is keyed.
+    source_hash (str): The content hash of the workbook.
+
+    Returns:
+    ChunkedDataset: The sheet.
+    '''
+    path = snapshot.snapshot_path(xlsx_path, sheet_name)
+    spool = f"{path}.spool"
+    os.makedirs(spool, exist_ok=True)
+    try:
+        rows = worksheet.iter_rows(values_only=True)
+        names = column_names(next(rows, ()))
+        batch_rows = max(1024, min(snapshot.SNAPSHOT_BATCH_ROWS, OUT_OF_CORE_MEMORY_BUDGET // (max(len(names), 1) * CELL_BYTES * WORKING_FACTOR)))
+        batches, batch = [], []
+
+        def spill():
+            table = to_arrow(batch, names)
+            batch_path = os.path.join(spool, f"{len(batches)}.arrow")
+            with pa.ipc.new_file(batch_path, table.schema) as writer:
+                writer.write_table(table)
+            batches.append((batch_path, table.schema))
+            batch.clear()
+
+        for row in rows:
+            # Blank rows are skipped, like pandas does
+            if all(value is None for value in row):
+                continue
+            batch.append(row[:len(names)] + (None,) * (len(names) - len(row)))
+            if len(batch) >= batch_rows:
+                spill()
+        if batch or not batches:
+            spill()
+
+        schema = pa.schema(
+            [(field.name, common_type([batch_schema.field(position).type for _, batch_schema in batches])) for position, field in enumerate(batches[0][1])],
+            metadata={snapshot.SOURCE_HASH_KEY: source_hash.encode(), snapshot.CHUNKED_KEY: b"1"},
+        )
+        tmp_path = path + ".tmp"
+        with pa.ipc.new_file(tmp_path, schema) as writer:
+            for batch_path, _ in batches:
+                table = feather.read_table(batch_path, memory_map=True)
+                writer.write_table(table.cast(schema))
+        os.replace(tmp_path, path)
+    finally:
+        for name in os.listdir(spool):
+            os.remove(os.path.join(spool, name))
+        os.rmdir(spool)
+    return ChunkedDataset.open(path)
+
+
+def ingest_workbook(path, sheet_names, source_hash):
+    '''
+    Description: This function ingests several sheets of a workbook out of core, the workbook is opened only once. The snapshots are written next to the workbook, under its name.
+
+    Args:
+    path (str): The path of the workbook.
+    sheet_names (list): The names or the positions of the sheets.
+    source_hash (str): The content hash of the workbook.
+
+    Returns:
+    tuple: A dictionary of the ChunkedDatasets keyed like `sheet_names`, a dictionary of the ingestion time in seconds and a dictionary of their rows and size on disk, both keyed by the sheet name.
+    '''
+    sheets, timings, storage = {}, {}, {}
+    # Opened from a file object, openpyxl rejects the paths without an Excel extension (e.g. a received upload)
+    source = open(path, "rb")
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        for sheet in sheet_names:
+            start = time.perf_counter()
+            worksheet = workbook.worksheets[sheet] if isinstance(sheet, int) else workbook[sheet]
+            sheets[sheet] = ingest_sheet(worksheet, path, sheet, source_hash)
+            timings[worksheet.title] = round(time.perf_counter() - start, 4)
+            storage[worksheet.title] = {
+                "out_of_core": True,
+                "rows": len(sheets[sheet]),
+                "disk_bytes": os.path.getsize(sheets[sheet].path),
+                "columns": {field.name: str(field.type) for field in sheets[sheet].table.schema},
+            }
+    finally:
+        workbook.close()
+        source.close()
+    return sheets, timings, storage
+
+
+def build_index(ds):
+    '''
+    Description: This function builds the column index of a ChunkedDataset, or returns it if it was already built.
+
+    Args:
+    ds (ChunkedDataset): The dataset, typically a loaded sheet.
+
+    Returns:
+    ChunkedIndex: The column index.
+    '''
+    return frame_cache.cached(ds, column_index.CACHE_NAME, lambda: ChunkedIndex(ds))
+
+
+def materialize(value):
+    '''
+    Description: This function loads an argument of an operation in memory if it is a ChunkedDataset.
+
+    Args:
+    value: The argument.
+
+    Returns:
+    The argument, as a DataFrame if it was a ChunkedDataset.
+    '''
+    return value.to_pandas() if isinstance(value, ChunkedDataset) else value
+
+
+def chunked_argument(arguments):
+    '''
+    Description: This function finds the first ChunkedDataset argument of an operation.
+
+    Args:
+    arguments (dict): The bound arguments.
+
+    Returns:
+    str: The name of the argument, or None if there is none.
+    '''
+    return next((name for name, value in arguments.items() if isinstance(value, ChunkedDataset)), None)
+
+
+def in_memory(func):
+    '''
+    Description: This decorator runs an operation that cannot be split in chunks (e.g. a join or a sentiment analysis) on its ChunkedDataset arguments loaded as DataFrames, if they fit in the memory budget.
+
+    Args:
+    func (callable): The operation.
+
+    Returns:
+    callable: The operation, with the signature of `func`.
+    '''
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        if chunked_argument(arguments) is None:
+            return func(*args, **kwargs)
+        annotate(out_of_core="in_memory")
+        return func(**{name: materialize(value) for name, value in arguments.items()})
+    return wrapper
+
+
+def rowwise(func):
+    '''
+    Description: This decorator runs an operation producing each row of its result from one row of its input (e.g. a filter or a new column) chunk by chunk on a ChunkedDataset, and spills the result.
+
+    Args:
+    func (callable): The operation.
+
+    Returns:
+    callable: The operation, with the signature of `func`, returning a ChunkedDataset when its input is one.
+    '''
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        name = chunked_argument(arguments)
+        if name is None:
+            return func(*args, **kwargs)
+        return map_chunks(arguments[name], lambda chunk: func(**{**arguments, name: chunk}))
+    return wrapper
+
+
+def streamed(implementation):
+    '''
+    Description: This decorator computes an aggregation on a ChunkedDataset with its streamed implementation, merging the partial aggregates of the chunks. The implementation returns NotImplemented for the arguments it cannot stream (e.g. a median), the operation then runs in_memory.
+
+    Args:
+    implementation (callable): The streamed implementation, taking the arguments of the operation.
+
+    Returns:
+    callable: The decorator.
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+        fallback = in_memory(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            if chunked_argument(bound.arguments) is None:
+                return func(*args, **kwargs)
+            bound.apply_defaults()
+            result = implementation(**bound.arguments)
+            if result is NotImplemented:
+                return fallback(**bound.arguments)
+            annotate(out_of_core="streamed")
+            return result
+        return wrapper
+    return decorator
+
+
+def result_schema(ds, operation):
+    '''
+    Description: This function returns the Arrow schema of the result of a row-wise operation, from the operation run on no rows, so that every chunk of the result is written with the same types whichever chunk comes first. The object columns, which have no type without values (e.g. on pandas < 3), take the type of the input column of the same name, else string.
+
+    Args:
+    ds (ChunkedDataset): The dataset.
+    operation (callable): The operation, taking and returning a DataFrame.
+
+    Returns:
+    pa.Schema: The schema of the result.
+    '''
+    schema = pa.Schema.from_pandas(operation(ds.table.slice(0, 0).to_pandas(split_blocks=True)), preserve_index=False)
+    fields = []
+    for field in schema:
+        if pa.types.is_null(field.type):
+            field = field.with_type(ds.table.schema.field(field.name).type if field.name in ds.table.schema.names else pa.string())
+        fields.append(field)
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def map_chunks(ds, operation):
+    '''
+    Description: This function applies an operation to each chunk of a dataset and spills the chunks of the result.
+
+    Args:
+    ds (ChunkedDataset): The dataset.
+    operation (callable): The operation, taking and returning a DataFrame.
+
+    Returns:
+    ChunkedDataset: The result.
+    '''
+    chunks = 0
+    # The chunks are transient, sharing their filtered rows would keep every chunk in memory until the end of a batch
+    with column_index.unshared_selections():
+        writer = SpillWriter(result_schema(ds, operation))
+        try:
+            for chunk in ds.iter_chunks():
+                writer.write(operation(chunk))
+                chunks += 1
+            result = writer.close()
+        except BaseException:
+            writer.discard()
+            raise
+    annotate(out_of_core="rowwise", chunks=chunks)
+    return result
+
+
+def check_columns(ds, columns):
+    '''
+    Description: This function checks that columns exist in a dataset.
+
+    Args:
+    ds (ChunkedDataset): The dataset.
+    columns (list): The names of the columns.
+
+    Returns:
+    None
+    '''
+    missing = [col for col in columns if col not in ds.columns]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Column(s) {missing} not found in DataFrame.")
+
+
+def matching(chunk, column, value):
+    '''
+    Description: This function returns the rows of a chunk where a column equals a value, the value being coerced to the type of the column like in column_index.select.
+
+    Args:
+    chunk (pd.DataFrame): The chunk.
+    column (str): The column to filter on.
+    value: The value to filter on.
+
+    Returns:
+    pd.DataFrame: The matching rows.
+    '''
+    return chunk[chunk[column] == dtype_optimizer.coerce_value(chunk[column], value)]
+
+
+def summary_partial(chunk):
+    '''
+    Description: This function computes the partial aggregates of the summary report on a chunk.
+
+    Args:
+    chunk (pd.DataFrame): The chunk.
+
+    Returns:
+    pd.DataFrame: The sum, count, min and max of each numerical column of the chunk.
+    '''
+    numeric = chunk[column_index.summary_columns(chunk)]
+    return pd.DataFrame({"sum": numeric.sum(), "count": numeric.count(), "min": numeric.min(), "max": numeric.max()})
+
+
+def merge_summary(partials):
+    '''
+    Description: This function merges the partial aggregates of the chunks into the summary report.
+
+    Args:
+    partials (list): The partial aggregates of each chunk.
+
+    Returns:
+    pd.DataFrame: The sum, average, min and max of each numerical column.
+    '''
+    merged = pd.concat(partials).groupby(level=0, sort=False).agg(MERGES)
+    return pd.DataFrame({"sum": merged["sum"], "average": merged["sum"] / merged["count"], "min": merged["min"], "max": merged["max"]})
+
+
+def calculate_summary_report(df):
+    '''
+    Description: This function streams the summary report of a ChunkedDataset, or reads it from its column index.
+
+    Args:
+    df (ChunkedDataset): The dataset.
+
+    Returns:
+    pd.DataFrame: The sum, average, min and max of each numerical column.
+    '''
+    index = column_index.peek(df)
+    if index is not None:
+        return index.summary
+    columns = column_index.summary_columns(df)
+    return merge_summary([summary_partial(chunk) for chunk in df.iter_chunks(columns)])
+
+
+def filtered_totals(df, column_name, value, target_column):
+    '''
+    Description: This function streams the sum and the count of the values of the rows where a column equals a value.
+
+    Args:
+    df (ChunkedDataset): The dataset.
+    column_name (str): The column to filter on.
+    value: The value to filter on.
+    target_column (str): The column to total, every numerical column if None.
+
+    Returns:
+    tuple: The sums and the counts, scalars for a target column, else Series keyed by column. None if the target column is not numerical.
+    '''
+    check_columns(df, [column_name] if target_column is None else [column_name, target_column])
+    if target_column is not None and not pd.api.types.is_numeric_dtype(df.dtypes[target_column]):
+        return None
+    targets = [target_column] if target_column is not None else column_index.summary_columns(df)
+    partials = []
+    for chunk in df.iter_chunks(list(dict.fromkeys([column_name, *targets]))):
+        rows = matching(chunk, column_name, value)[targets]
+        partials.append(pd.DataFrame({"sum": rows.sum(), "count": rows.count()}))
+    merged = pd.concat(partials).groupby(level=0, sort=False).sum()
+    if target_column is not None:
+        return merged["sum"].iloc[0], merged["count"].iloc[0]
+    return merged["sum"], merged["count"]
+
+
+def sum_with_filter(df, column_name, value, target_column=None):
+    '''
+    Description: This function streams the sum of a column, or of every numerical column, over the rows where a column equals a value.
+
+    Args:
+    df (ChunkedDataset): The dataset.
+    column_name (str): The column to filter on.
+    value: The value to filter on.
+    target_column (str): The column to sum, every numerical column if None.
+
+    Returns:
+    float or pd.Series: The sum, or NotImplemented if the target column is not numerical.
+    '''
+    totals = filtered_totals(df, column_name, value, target_column)
+    return NotImplemented if totals is None else totals[0]
+
+
+def avg_with_filter(df, column_name, value, target_column=None):
+    '''
+    Description: This function streams the average of a column, or of every numerical column, over the rows where a column equals a value.
+
+    Args:
+    df (ChunkedDataset): The dataset.
+    column_name (str): The column to filter on.
+    value: The value to filter on.
+    target_column (str): The column to average, every numerical column if None.
+
+    Returns:
+    float or pd.Series: The average, or NotImplemented if the target column is not numerical.
+    '''
+    totals = filtered_totals(df, column_name, value, target_column)
+    if totals is None:
+        return NotImplemented
+    sums, counts = totals
+    if target_column is not None:
+        return sums / counts if counts else float("nan")
+    return sums / counts
+
+
+def total_avg(df, column_name):
+    '''
+    Description: This function streams the average of a column, or reads it from the column index.
+
+    Args:
+    df (ChunkedDataset): The dataset.
+    column_name (str): The column.
+
+    Returns:
+    float: The average, or NotImplemented if the column is not numerical.
+    '''
+    check_columns(df, [column_name])
+    index = column_index.peek(df)
+    if index is not None and "mean" in index.stats[column_name]:
+        return index.stats[column_name]["mean"]
+    if not pd.api.types.is_numeric_dtype(df.dtypes[column_name]):
+        return NotImplemented
+    total, count = 0, 0
+    for chunk in df.iter_chunks([column_name]):
+        total += chunk[column_name].sum()
+        count += chunk[column_name].count()
+    return total / count if count else float("nan")
+
+
+def min_max_values(df, column_name):
+    '''
+    Description: This function streams the minimum and the maximum of a column, or reads them from the column index.
+
+    Args:
+    df (ChunkedDataset): The dataset.
+    column_name (str): The column.
+
+    Returns:
+    tuple: The minimum and the maximum.
+    '''
+    check_columns(df, [column_name])
+    index = column_index.peek(df)
+    if index is not None and "min" in index.stats[column_name]:
+        return index.stats[column_name]["min"], index.stats[column_name]["max"]
+    minimums, maximums = [], []
+    for chunk in df.iter_chunks([column_name]):
+        column = chunk[column_name].dropna()
+        if len(column):
+            minimums.append(column.min())
+            maximums.append(column.max())
+    if not minimums:
+        return float("nan"), float("nan")
+    return min(minimums), max(maximums)
+
+
+def pivot_table(df, index, columns, values, aggfunc='sum'):
+    '''
+    Description: This function streams a pivot table: the partial aggregates of each group of each chunk are merged, then the groups are pivoted.
+
+    Args:
+    df (ChunkedDataset): The dataset.
+    index (str or list): The column(s) to use as index for the pivot table.
+    columns (str or list): The column(s) to use as columns for the pivot table.
+    values (str): The column to aggregate.
+    aggfunc (str): 'sum', 'mean', 'min', 'max' or 'count'.
+
+    Returns:
+    pd.DataFrame: The pivot table, or NotImplemented for the other aggregations.
+    '''
+    rows = [index] if isinstance(index, str) else list(index)
+    pivoted = [columns] if isinstance(columns, str) else list(columns)
+    if not isinstance(values, str) or not isinstance(aggfunc, str) or (aggfunc not in MERGES and aggfunc != "mean"):
+        return NotImplemented
+    if values in rows + pivoted:
+        return NotImplemented
+    check_columns(df, rows + pivoted + [values])
+
+    keys = rows + pivoted
+    funcs = ["sum", "count"] if aggfunc == "mean" else [aggfunc]
+    partials = [chunk.groupby(keys, observed=True)[values].agg(funcs) for chunk in df.iter_chunks(keys + [values])]
+    merged = pd.concat(partials).groupby(level=list(range(len(keys)))).agg({func: MERGES[func] for func in funcs})
+    table = merged["sum"] / merged["count"] if aggfunc == "mean" else merged[aggfunc]
+    return table.unstack(list(range(len(rows), len(keys))))
@@ -0,0 +1,338 @@
+# Compact prompts for the LLM translating the queries into function calls.
+#
+# A prompt is made of the fixed instructions, the schema of the dataset (name, dtype, and range or a few values of each
+# column), the reference of the functions relevant to the query, and the query. The instructions and the schema come
+# first and do not change between the queries on a dataset, so the provider can reuse its cached prompt prefix; only
+# the function reference and the query vary. The functions are chosen from the words of the query and the types of the
+# columns it names, and the whole reference is sent when nothing matches.
+
+import os
+import re
+import threading
+from contextvars import ContextVar
+
+import pandas as pd
+
+import column_index
+import frame_cache
+from sentiment import estimate_tokens
+
+# Send only the functions relevant to the query, set to 0 to always send the whole reference
+PROMPT_SELECT_FUNCTIONS = os.getenv("PROMPT_SELECT_FUNCTIONS", "1") not in ("0", "false", "False")
+SCHEMA_CACHE_NAME = "prompt_schema"
+WORD = re.compile(r"[a-z0-9]+")
+
+PREAMBLE = '''You translate questions about a dataset into calls of the Pandas functions listed below. The dataset is `df`; `df2` is the second uploaded dataset.
+Answer with the function call only, in plain text, no explanation, no markdown. Use the exact column names of the schema and quote text values as listed.
+When a query needs several operations, answer with one call per line; from the second line `result` is the output of the previous call, e.g.
+date_operations(df, 'JoiningDate')
+pivot_table(result, 'Department', 'year', 'Salary')
+'''
+
+MATH_WORDS = ("add", "subtract", "multipl", "divide", "double", "triple", "half", "halve", "square", "plus", "minus", "times", "ratio", "profit", "increase", "decrease", "product", "differen")
+AGGREGATE_WORDS = ("sum", "sums", "total", "average", "avg", "mean", "min", "max", "minimum", "maximum", "highest", "lowest", "largest", "smallest", "count", "how many", "number of", "median", "std", "range")
+
+# The reference of each function and the words of the queries it is relevant to, in the order of the prompt
+FUNCTIONS = {
+    "maths_operations_on_same_col": (
+        "maths_operations_on_same_col(action, df, input_column_name): `add`, `subtract`, `multiply` or `divide` a column by itself into a new column. "
+        "\"Double the values in 'Salary'\" -> maths_operations_on_same_col('add', df, 'Salary')",
+        MATH_WORDS),
+    "maths_operations_on_diff_cols": (
+        "maths_operations_on_diff_cols(action, df, column1, column2): `add`, `subtract`, `multiply` or `divide` two columns into a new column. "
+        "\"Profit as 'Revenue' minus 'Cost'\" -> maths_operations_on_diff_cols('subtract', df, 'Revenue', 'Cost')",
+        MATH_WORDS),
+    "calculate_summary_report": (
+        "calculate_summary_report(df): sum, average, min and max of every numerical column. \"Summary statistics of the numerical fields\"",
+        ("summary", "summar", "statistic", "stats", "overview", "describe", "report")),
+    "sum_with_filter": (
+        "sum_with_filter(df, column_name, value, target_column=None): sum of `target_column` (every numerical column if None) over the rows where `column_name` equals `value`. "
+        "\"Total sales in IT\" -> sum_with_filter(df, 'Department', 'IT', 'Sales')",
+        ("sum", "sums", "total", "how much")),
+    "avg_with_filter": (
+        "avg_with_filter(df, column_name, value, target_column=None): average of `target_column` (every numerical column if None) over the rows where `column_name` equals `value`. "
+        "\"Average salary of Finance\" -> avg_with_filter(df, 'Department', 'Finance', 'Salary')",
+        ("average", "avg", "mean")),
+    "group_aggregate": (
+        "group_aggregate(df, group_by, measures=None, aggfuncs='sum'): one or more aggregations (`sum`, `mean`, `min`, `max`, `count`, `median`, `std`, `nunique`) of one or more columns for every group of one or more columns, in one pass. Prefer it to several filtered calls when every group is asked. "
+        "\"Average salary per department\" -> group_aggregate(df, 'Department', 'Salary', 'mean'); \"Sum and max of projects per location and remote work\" -> group_aggregate(df, ['Location', 'Remote_Work'], ['Project_Count'], ['sum', 'max'])",
+        AGGREGATE_WORDS + ("per", "each", "every", "by", "group", "breakdown", "across")),
+    "total_avg": (
+        "total_avg(df, column_name): overall average of a numerical column. \"Average revenue across all departments\"",
+        ("average", "avg", "mean", "overall")),
+    "min_max_values": (
+        "min_max_values(df, column_name): minimum and maximum of a numerical column. \"Lowest and highest 'Salary'\"",
+        ("min", "max", "minimum", "maximum", "lowest", "highest", "smallest", "largest", "range")),
+    "filter_data": (
+        "filter_data(df, column_name, value, dropna=True): rows where a column equals a value. \"Show the employees of HR\" -> filter_data(df, 'Department', 'HR')",
+        ("show", "list", "filter", "only", "where", "rows", "which", "who", "find", "get", "display", "select")),
+    "pivot_table": (
+        "pivot_table(df, index, columns, values, aggfunc='sum'): pivot table. \"Total revenue per department per year\" -> pivot_table(df, 'Department', 'year', 'Revenue')",
+        ("pivot", "per", "cross", "matrix", "by")),
+    "unpivot_table": (
+        "unpivot_table(df, value_vars, var_name='variable', value_name='value'): unpivots columns into rows. \"Unpivot the quarterly sales columns\"",
+        ("unpivot", "melt", "long format", "wide", "reshape")),
+    "date_operations": (
+        "date_operations(df, date_column): year, month and day columns of a date column. \"Extract the year from 'JoiningDate'\"",
+        ("date", "year", "month", "day", "week", "quarter", "when")),
+    "date_difference": (
+        "date_difference(df, start_date_column, end_date_column, result_column_name): days between two date columns. \"Days between 'StartDate' and 'EndDate'\"",
+        ("between", "days", "duration", "elapsed", "tenure", "differen")),
+    "join_datasets": (
+        "join_datasets(df, df2, join_type='inner', on=None): joins with the second dataset (`inner`, `left`, `right`, `outer` or `cross`), on the common columns if `on` is None. "
+        "\"Join with the second file on 'EmployeeID'\" -> join_datasets(df, df2, 'inner', 'EmployeeID')",
+        ("join", "merge", "combine", "second", "other file", "lookup", "match", "df2")),
+    "get_sentiment": (
+        "get_sentiment(df, text_column, backend=None): sentiment of each text of a column; pass backend='lexicon' only for a quick or offline analysis. \"Sentiment of the 'Review' column\"",
+        ("sentiment", "review", "feedback", "opinion", "positive", "negative", "tone", "feel", "mood", "happy")),
+}
+
+# Functions relevant to the queries naming a column of these kinds
+DATE_FUNCTIONS = ("date_operations", "date_difference")
+TEXT_FUNCTIONS = ("get_sentiment", "filter_data")
+
+INTENT_INSTRUCTIONS = ('What operation should be performed? Choose from: sum, average, min, max, filter, join, pivot, unpivot, sentiment, summarize, date difference. '
+                       'The output should be only the json, do not provide any explanation. Expected Output: {"operation": "average", "column": "Salary", "filter": {"Department": "IT"}}')
+BATCH_INSTRUCTIONS = 'Answer with one line per query, in order, formatted as `<query number>: <function call>`, separating the calls of a multi-step query with `; `.'
+
+_usage = ContextVar("prompt_usage", default=None)
+
+
+def schema(df):
+    '''
+    Description: This function returns the compact schema of a dataset sent to the LLM, built once per dataset so that it is the same text for every query on it.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+
+    Returns:
+    str: One line per column with its name, dtype, and range or first values.
+    '''
+    return frame_cache.cached(df, SCHEMA_CACHE_NAME, lambda: column_index.describe(df))
+
+
+def prefix(df):
+    '''
+    Description: This function returns the part of the prompts shared by every query on a dataset: the instructions and the schema.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+
+    Returns:
+    str: The prompt prefix.
+    '''
+    return PREAMBLE + "\nColumns:\n" + schema(df) + "\n"
+
+
+def mentions(query, word):
+    '''
+    Description: This function checks whether a query mentions a word, as one of its words, as a prefix of one of its words for words of 4 letters or more (e.g. 'averages' for 'average'), or as a phrase.
+
+    Args:
+    query (str): The query, lower-cased.
+    word (str): The word or phrase.
+
+    Returns:
+    bool: Whether the query mentions it.
+    '''
+    if " " in word:
+        return word in query
+    return any(token == word or (len(word) >= 4 and token.startswith(word)) for token in WORD.findall(query))
+
+
+def is_text(dtype):
+    '''
+    Description: This function tells whether a column holds text, including the low-cardinality text columns loaded as categoricals.
+
+    Args:
+    dtype: The dtype of the column.
+
+    Returns:
+    bool: Whether the column holds text.
+    '''
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    return pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype)
+
+
+def relevant_functions(df, queries):
+    '''
+    Description: This function chooses the functions relevant to queries, from their words and from the types of the columns they name.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    queries (list): The queries.
+
+    Returns:
+    list: The names of the functions in reference order, all of them if none is relevant.
+    '''
+    if not PROMPT_SELECT_FUNCTIONS:
+        return list(FUNCTIONS)
+    names = set()
+    for query in queries:
+        query = query.lower()
+        names.update(name for name, (_, words) in FUNCTIONS.items() if any(mentions(query, word) for word in words))
+        for column, dtype in df.dtypes.items():
+            if str(column).lower() not in query:
+                continue
+            if pd.api.types.is_datetime64_any_dtype(dtype):
+                names.update(DATE_FUNCTIONS)
+            elif is_text(dtype):
+                names.update(TEXT_FUNCTIONS)
+    if not names:
+        return list(FUNCTIONS)
+    return [name for name in FUNCTIONS if name in names]
+
+
+def reference(names):
+    '''
+    Description: This function returns the reference of functions.
+
+    Args:
+    names (list): The names of the functions.
+
+    Returns:
+    str: One paragraph per function.
+    '''
+    return "\nFunctions:\n" + "\n".join(f"- {FUNCTIONS[name][0]}" for name in names) + "\n"
+
+
+def operation_prompt(df, query):
+    '''
+    Description: This function builds the prompt translating a query into a function call.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    query (str): The query.
+
+    Returns:
+    str: The prompt.
+    '''
+    return prefix(df) + reference(relevant_functions(df, [query])) + "\nUser Query: " + query
+
+
+def batch_prompt(df, queries):
+    '''
+    Description: This function builds the prompt translating several queries into function calls at once.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    queries (list): The queries.
+
+    Returns:
+    str: The prompt.
+    '''
+    numbered = "\n".join(f"{number}. {query}" for number, query in enumerate(queries, 1))
+    return prefix(df) + reference(relevant_functions(df, queries)) + "\nUser Queries:\n" + numbered + "\n" + BATCH_INSTRUCTIONS
+
+
+def intent_prompt(df, query):
+    '''
+    Description: This function builds the prompt extracting the intent of a query as JSON.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    query (str): The query.
+
+    Returns:
+    str: The prompt.
+    '''
+    return "Columns:\n" + schema(df) + "\n\nUser Query: " + query + "\n" + INTENT_INSTRUCTIONS
+
+
+class PromptStats:
+    '''
+    Description: Counts the prompts sent to the LLM and their tokens, in total and for the request being served. The provider's token counts are used when the response reports them, else the tokens are estimated.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = new_usage()
+
+    def track(self):
+        '''
+        Description: This function starts counting the prompts of the current request (and of the tasks it starts).
+
+        Args:
+        None
+
+        Returns:
+        dict: The usage of the request, updated as its prompts are sent.
+        '''
+        usage = new_usage()
+        _usage.set(usage)
+        return usage
+
+    def record(self, prompt, message):
+        '''
+        Description: This function counts a prompt and the response of the LLM.
+
+        Args:
+        prompt (str): The prompt.
+        message: The response of the LLM.
+
+        Returns:
+        dict: The counts of the prompt.
+        '''
+        reported = getattr(message, "usage_metadata", None) or {}
+        counts = {
+            "llm_calls": 1,
+            "prompt_tokens": reported.get("input_tokens") or estimate_tokens(prompt),
+            "completion_tokens": reported.get("output_tokens") or estimate_tokens(str(getattr(message, "content", ""))),
+            "cached_tokens": (reported.get("input_token_details") or {}).get("cache_read") or 0,
+        }
+        usages = [self.totals]
+        if _usage.get() is not None:
+            usages.append(_usage.get())
+        with self._lock:
+            for usage in usages:
+                for key, count in counts.items():
+                    usage[key] += count
+        return counts
+
+    def stats(self):
+        '''
+        Description: This function returns the number of prompts and tokens sent since the start.
+
+        Args:
+        None
+
+        Returns:
+        dict: The prompt statistics.
+        '''
+        with self._lock:
+            return dict(self.totals)
+
+
+def new_usage():
+    '''
+    Description: This function returns empty prompt counters.
+
+    Args:
+    None
+
+    Returns:
+    dict: The counters.
+    '''
+    return {"llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+
+
+def usage_headers(usage):
+    '''
+    Description: This function returns the response headers reporting the prompt tokens of a request.
+
+    Args:
+    usage (dict): The usage of the request.
+
+    Returns:
+    dict: The headers.
+    '''
+    return {
+        "X-LLM-Calls": str(usage["llm_calls"]),
+        "X-Prompt-Tokens": str(usage["prompt_tokens"]),
+        "X-Completion-Tokens": str(usage["completion_tokens"]),
+        "X-Cached-Prompt-Tokens": str(usage["cached_tokens"]),
+    }
+
+
+prompt_stats = PromptStats()
@@ -1,122 +1,117 @@
 from langchain_groq import ChatGroq
+import asyncio
 import json
+import re
 import os
+import time
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 from fastapi import HTTPException
 import excel_functions
 import excel_functions as ef
+from translation_cache import translation_cache
+from intent_matcher import match_intent
+from serialization import to_records
+from out_of_core import ChunkedDataset
+import prompt_builder
+from prompt_builder import prompt_stats
+from call_compiler import CallCompiler
+from metrics import metrics, span, annotate, rows
+from workers import run_in_worker
+from llm_limiter import llm_limiter
 
 load_dotenv()
 
 groq_api_key = os.environ['GROQ_API_KEY']
 model = 'llama3-8b-8192'
 
+# Number of queries of a batch translated by one LLM call
+LLM_BATCH_SIZE = int(os.getenv('LLM_BATCH_SIZE', 20))
+
+BATCH_LINE = re.compile(r"^\s*(\d+)\s*[:.)]\s*(.+?)\s*$")
+
 groq_chat = ChatGroq(
         groq_api_key=groq_api_key, 
         model_name=model
 )
 
-system_prompt = '''You are a friendly chatbot. Users provide you query and you provide the intent of the query.
-
-I have a dataset and need to perform operations using Pandas.
-
-Based on the available operations, return only structured JSON containing:
-- `operation`: The function that should be called (e.g., `avg_with_filter`).
-- `column`: The relevant column name(s).
-- `filter`: Any filtering condition needed.
-
-Use the following function reference to determine the correct mapping:
-
-    The following functions are available for structured data manipulation in Pandas. When processing user queries, extract intent and map to the most appropriate function.
-
-Basic Math Operations  
-   - `maths_operations_on_same_col(action, df, input_column_name)`:  
-     - Performs a mathematical operation (`add`, `subtract`, `multiply`, `divide`) on a single column and stores the result in a new column.  
-     - Example: "Double the values in the 'Salary' column."
-
-   - `maths_operations_on_diff_cols(action, df, column1, column2)`:  
-     - Performs a mathematical operation (`add`, `subtract`, `multiply`, `divide`) between two different columns.  
-     - Example: "Calculate profit by subtracting 'Cost' from 'Revenue'."
-
-Aggregation Functions**  
-   - `calculate_summary_report(df)`:  
-     - Computes sum, average, min, and max for all numerical columns.  
-     - Example: "Show me the summary statistics of all numerical fields."
-
-   - `sum_with_filter(df, column_name, value)`:  
-     - Filters the DataFrame based on a column value and calculates the sum.  
-     - Example: "Find the total sales in the IT department."
-
-   - `avg_with_filter(df, column_name, value)`:  
-     - Filters the DataFrame based on a column value and calculates the average.  
-     - Example: "Find the average salary of Finance employees."
-
-   - `total_avg(df, column_name)`:  
-     - Computes the overall average of a numerical column.  
-     - Example: "What is the average revenue across all departments?"
-
-  - `min_max_values(df, column_name)`:
-    - Computes the minimum and maximum values of a numerical column.
-    - Example: "What are the minimum and maximum values of the 'Salary' column?"
-
-
-Data Manipulation & Filtering
-   - `filter_data(df, column_name, value, dropna=True)`:  
-     - Filters rows where a specific column matches a given value.  
-     - Example: "Show all employees in the HR department."
-
-   - `pivot_table(df, index, columns, values, aggfunc='sum')`:  
-     - Creates a pivot table summarizing data.  
-     - Example: "Pivot table showing total revenue per department per year."
-
-   - `unpivot_table(df, value_vars, var_name='variable', value_name='value')`:  
-     - Converts a pivot table back into a normal dataset.  
-     - Example: "Unpivot the quarterly sales columns back into a single column."
-
-Date-Based Operations
-   - `date_operations(df, date_column)`:  
-     - Extracts year, month, and day from a date column.  
-     - Example: "Extract the year and month from 'JoiningDate'."
-
-   - `date_difference(df, start_date_column, end_date_column, result_column_name)`:  
-     - Calculates the difference in days between two date columns.  
-     - Example: "Calculate the number of days between 'StartDate' and 'EndDate'."
-
-Text Analysis & Sentiment
-    - `get_sentiment(df, text_column)`:
-        - Analyzes the sentiment of text data in a specific column.
-        - Example: "Analyze the sentiment of the 'Review' column."
-
-
-
-Respond with the function call only, no explaination, no markdown, in plain text.
-
-'''
-
 def get_intent(df, query):
     '''
     Description: This function is used to get the intent of the query
 
     Args:
+    df: The dataset
     query: The query provided by the user
 
     Returns:
     response_json: The response json containing the intent
     '''
     try:
-        query_updated = query + f' Available Columns: {df.columns} What operation should be performed?' +  'Choose from: sum, average, min, max, filter, join, pivot, unpivot, sentiment, summarize, date difference. the output should be only the json do not provide any explaination. Expected Output: {"operation": "average", "column": "Salary", "filter": {"Department": "IT"}}'
-
-        result = groq_chat.invoke(query_updated)
+        prompt = prompt_builder.intent_prompt(df, query)
+        result = groq_chat.invoke(prompt)
+        prompt_stats.record(prompt, result)
         response = result.content
         response_json = json.loads(response)
         return response_json
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get intent: {str(e)}")
 
+def local_operation(df, query):
+    '''
+    Description: This function is used to get the operation without calling the LLM, from the local intent matcher or the translation cache
+
+    Args:
+    df: The dataset
+    query: The query provided by the user
+
+    Returns:
+    response: The function call, or None if the LLM is needed
+    '''
+    matched = match_intent(df, query)
+    if matched is not None:
+        metrics.translations.inc(source="intent")
+        annotate(source="intent")
+        return matched
+    cached = translation_cache.get(query, df.columns)
+    if cached is not None:
+        metrics.translations.inc(source="cache")
+        annotate(source="cache")
+    return cached
+
+def local_operations(df, queries):
+    '''
+    Description: This function is used to get the operations of several queries without calling the LLM, in one worker task
+
+    Args:
+    df: The dataset
+    queries: The queries provided by the user
+
+    Returns:
+    responses: The function call of each query, None for the queries that need the LLM
+    '''
+    return [local_operation(df, query) for query in queries]
+
+def store_operation(df, query, response):
+    '''
+    Description: This function is used to keep the function call returned by the LLM in the translation cache
+
+    Args:
+    df: The dataset
+    query: The query provided by the user
+    response: The function call returned by the LLM
+
+    Returns:
+    response: The function call
+    '''
+    translation_cache.put(query, df.columns, response)
+    metrics.translations.inc(source="llm")
+    annotate(source="llm")
+    return response
+
 def get_operation(df, query):
     '''
-    Description: This function is used to get the operation to be performed
+    Description: This function is used to get the operation to be performed. Common query shapes are matched locally and translations are cached per query and columns, both skip the LLM.
     
     Args:
     query: The query provided by the user
@@ -125,37 +120,201 @@ def get_operation(df, query):
     response: The response of the operation that user has requested
     '''
     try:
-        query_updated = query + f' Available Columns: {df.columns}'
-        print(query_updated)
-        result = groq_chat.invoke(system_prompt + 'User Query: ' + query_updated)
-        response = result.content
-        if "join" in response:
-            df2 = pd.read_csv("./uploads/file2.csv")
-        return response
+        with span("translate"):
+            response = local_operation(df, query)
+            if response is not None:
+                return response
+
+            prompt = prompt_builder.operation_prompt(df, query)
+            with span("llm") as attributes:
+                result = groq_chat.invoke(prompt)
+                attributes.update(prompt_stats.record(prompt, result))
+            return store_operation(df, query, result.content)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get operation: {str(e)}")
+
+async def aget_operation(df, query):
+    '''
+    Description: This function is the non-blocking version of get_operation. Locally matched and cached queries never wait for an LLM slot.
+
+    Args:
+    df: The dataset
+    query: The query provided by the user
+
+    Returns:
+    response: The response of the operation that user has requested
+    '''
+    try:
+        with span("translate"):
+            # The intent matcher scans the sheet and the prompt describes its columns, both run in the worker pool
+            response = await run_in_worker(local_operation, df, query)
+            if response is not None:
+                return response
+
+            prompt = await run_in_worker(prompt_builder.operation_prompt, df, query)
+            content = await llm_limiter.invoke(groq_chat, prompt)
+            return store_operation(df, query, content)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get operation: {str(e)}")
 
-FUNCTION_MAP = {
-    name: func for name, func in vars(excel_functions).items() if callable(func)
-}
+# The operations the generated calls may use, nothing else of excel_functions (or Python) is reachable
+OPERATIONS = [
+    "maths_operations_on_same_col", "maths_operations_on_diff_cols", "calculate_summary_report", "join_datasets",
+    "pivot_table", "unpivot_table", "date_operations", "date_difference", "filter_data", "sum_with_filter",
+    "avg_with_filter", "group_aggregate", "total_avg", "min_max_values", "get_sentiment",
+]
+FUNCTION_MAP = {name: getattr(excel_functions, name) for name in OPERATIONS}
+call_compiler = CallCompiler(FUNCTION_MAP)
 
-def execute_llm_function(df, function_call_str):
+def uses_second_dataset(function_call_str):
     """
-    Executes a function dynamically from an LLM-generated function call.
+    Tells whether a function call reads the second dataset, so that it is only loaded when needed.
 
     Args:
-    df (pd.DataFrame): The dataset.
     function_call_str (str): The Python function call as a string.
 
     Returns:
-    result: The output of the executed function.
+    bool: True if the call references `df2`.
+    """
+    return "df2" in call_compiler.compile(function_call_str).variables
+
+def run_llm_function(df, function_call_str, overrides=None, df2=None):
     """
-    local_vars = {"df": df, **FUNCTION_MAP}
+    Executes an LLM-generated function call, or a multi-step plan of calls chained through `result`, compiled by the safe call compiler (cached per call text) instead of being evaluated.
 
+    Args:
+    df (pd.DataFrame): The dataset.
+    function_call_str (str): The Python function call as a string.
+    overrides (dict): Functions replacing the FUNCTION_MAP entries of the same name for this call, e.g. with request-level defaults.
+    df2 (pd.DataFrame): The second dataset, exposed to the call as `df2` (e.g. for joins).
+
+    Returns:
+    result: The raw output of the executed function.
+    """
+    with span("compile"):
+        plan = call_compiler.compile(function_call_str)
     try:
-        result = eval(function_call_str, {}, local_vars)
-        if isinstance(result, pd.DataFrame):
-            return result.to_dict(orient="records")
+        with span("execute", call=plan.text, rows_in=rows(df)) as attributes:
+            result = plan.run({"df": df, "df2": df2}, {**FUNCTION_MAP, **(overrides or {})})
+            attributes["rows_out"] = rows(result)
         return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to execute function: {str(e)}")
+
+def serialize_result(result):
+    """
+    Converts the output of an executed function into a JSON-serializable response.
+
+    Args:
+    result: The raw output of the executed function.
+
+    Returns:
+    result: The records of a DataFrame (or of a ChunkedDataset fitting in the memory budget), or the output with its NumPy scalars and Series converted to Python values. A DataFrame carrying `attrs` (e.g. the sentiment cache counters) is returned with them as `{**attrs, "data": records}`.
+    """
+    if isinstance(result, (pd.DataFrame, ChunkedDataset)):
+        records = to_records(result)
+        if result.attrs:
+            return {**result.attrs, "data": records}
+        return records
+    if isinstance(result, pd.Series):
+        return {key: serialize_result(value) for key, value in result.items()}
+    if isinstance(result, (tuple, list)):
+        return [serialize_result(value) for value in result]
+    if isinstance(result, np.generic):
+        result = result.item()
+    if isinstance(result, float) and not np.isfinite(result):
+        return None
+    return result
+
+def execute_llm_function(df, function_call_str, overrides=None, df2=None):
+    """
+    Executes a function dynamically from an LLM-generated function call.
+
+    Args:
+    df (pd.DataFrame): The dataset.
+    function_call_str (str): The Python function call as a string.
+    overrides (dict): Functions replacing the FUNCTION_MAP entries of the same name for this call, e.g. with request-level defaults.
+    df2 (pd.DataFrame): The second dataset, exposed to the call as `df2` (e.g. for joins).
+
+    Returns:
+    result: The output of the executed function, serialized with serialize_result.
+    """
+    return serialize_result(run_llm_function(df, function_call_str, overrides, df2))
+
+def parse_batch_response(content, count):
+    '''
+    Description: This function is used to read the function calls of a batched LLM response
+
+    Args:
+    content: The content of the LLM response
+    count: The number of queries of the batch
+
+    Returns:
+    calls: The function call of each query, None for the queries the LLM did not answer
+    '''
+    calls = [None] * count
+    for line in content.splitlines():
+        match = BATCH_LINE.match(line.strip("`"))
+        if match and 1 <= int(match.group(1)) <= count:
+            calls[int(match.group(1)) - 1] = match.group(2).strip("`")
+    return calls
+
+async def translate_batch(df, queries):
+    '''
+    Description: This function is used to translate a batch of queries with one LLM call. The queries the LLM did not answer are translated one by one.
+
+    Args:
+    df: The dataset
+    queries: The queries, none of them locally matched or cached
+
+    Returns:
+    translations: The function call (or the HTTPException raised translating it) and the translation time of each query
+    '''
+    start = time.perf_counter()
+    try:
+        prompt = await run_in_worker(prompt_builder.batch_prompt, df, queries)
+        content = await llm_limiter.invoke(groq_chat, prompt)
+        calls = parse_batch_response(content, len(queries))
+    except HTTPException as e:
+        return {query: (e, time.perf_counter() - start) for query in queries}
+    except Exception as e:
+        error = HTTPException(status_code=500, detail=f"Failed to get operation: {str(e)}")
+        return {query: (error, time.perf_counter() - start) for query in queries}
+
+    translations = {}
+    for query, call in zip(queries, calls):
+        try:
+            call = store_operation(df, query, call) if call else await aget_operation(df, query)
+        except HTTPException as e:
+            call = e
+        translations[query] = (call, time.perf_counter() - start)
+    return translations
+
+async def aget_operations(df, queries):
+    '''
+    Description: This function is the batched version of aget_operation. Identical queries are translated once, and the queries that are not matched locally or cached are sent to the LLM in batches of LLM_BATCH_SIZE, concurrently.
+
+    Args:
+    df: The dataset
+    queries: The queries provided by the user
+
+    Returns:
+    translations: The function call (or the HTTPException raised translating it) and the translation time of each distinct query
+    '''
+    translations = {}
+    pending = []
+    distinct = list(dict.fromkeys(queries))
+    for query, response in zip(distinct, await run_in_worker(local_operations, df, distinct)):
+        if response is not None:
+            translations[query] = (response, 0.0)
+        else:
+            pending.append(query)
+
+    batches = [pending[start:start + LLM_BATCH_SIZE] for start in range(0, len(pending), LLM_BATCH_SIZE)]
+    for translated in await asyncio.gather(*(translate_batch(df, batch) for batch in batches)):
+        translations.update(translated)
+    return translations
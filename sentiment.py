@@ -0,0 +1,315 @@
+# Sentiment scoring of a text column. The LLM backend splits the texts in token-budgeted chunks scored concurrently (within the global LLM limit), the lexicon backend scores the whole column locally in a vectorized pass.
+
+import asyncio
+import json
+import os
+import re
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+from fastapi import HTTPException
+
+from sentiment_cache import sentiment_cache, text_hash
+from workers import run_on_event_loop
+
+SENTIMENT_CHUNK_TOKENS = int(os.getenv("SENTIMENT_CHUNK_TOKENS", 3000))
+SENTIMENT_PARALLELISM = int(os.getenv("SENTIMENT_PARALLELISM", 4))
+SENTIMENT_MAX_RETRIES = int(os.getenv("SENTIMENT_MAX_RETRIES", 3))
+SENTIMENT_BACKOFF = float(os.getenv("SENTIMENT_BACKOFF", 1.0))
+LABELS = ("Positive", "Negative", "Neutral")
+# Backend used when the request does not choose one: 'llm' or 'lexicon'
+SENTIMENT_BACKEND = os.getenv("SENTIMENT_BACKEND", "llm")
+# Bump when build_prompt or parse_labels change, so that the cached labels of the previous prompt are not reused
+PROMPT_VERSION = 1
+
+
+def estimate_tokens(text):
+    '''
+    Description: This function estimates the number of tokens of a text (about 4 characters per token).
+
+    Args:
+    text (str): The text.
+
+    Returns:
+    int: The estimated number of tokens.
+    '''
+    return len(text) // 4 + 1
+
+
+def chunk_texts(texts, max_tokens=SENTIMENT_CHUNK_TOKENS):
+    '''
+    Description: This function splits the texts in chunks whose estimated size stays within the token budget. A text longer than the budget is truncated to it.
+
+    Args:
+    texts (pd.Series): The texts to score, indexed like the DataFrame.
+    max_tokens (int): The token budget of a chunk.
+
+    Returns:
+    list: The chunks, as lists of (index, text) pairs.
+    '''
+    chunks = []
+    current, current_tokens = [], 0
+    for index, text in texts.items():
+        text = re.sub(r"\s+", " ", text).strip()[:max_tokens * 4]
+        tokens = estimate_tokens(text) + 4
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append((index, text))
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_prompt(chunk):
+    '''
+    Description: This function builds the prompt asking the LLM for one label per numbered text.
+
+    Args:
+    chunk (list): The (index, text) pairs to score.
+
+    Returns:
+    str: The prompt.
+    '''
+    lines = "\n".join(f"{position}. {text}" for position, (_, text) in enumerate(chunk, start=1))
+    return (
+        f"Classify the sentiment of each of the following {len(chunk)} numbered text entries as Positive, Negative, or Neutral.\n"
+        f"{lines}\n"
+        f"Respond only with a JSON array of {len(chunk)} labels in the same order, no explaination, no markdown."
+    )
+
+
+def parse_labels(content, expected):
+    '''
+    Description: This function reads the labels out of the LLM response.
+
+    Args:
+    content (str): The LLM response.
+    expected (int): The number of labels expected.
+
+    Returns:
+    list: The labels.
+    '''
+    match = re.search(r"\[.*\]", content, re.DOTALL)
+    if match is None:
+        raise ValueError("no JSON array in the response")
+    labels = [str(label).strip().capitalize() for label in json.loads(match.group(0))]
+    if len(labels) != expected:
+        raise ValueError(f"expected {expected} labels, got {len(labels)}")
+    unknown = set(labels) - set(LABELS)
+    if unknown:
+        raise ValueError(f"unexpected labels {sorted(unknown)}")
+    return labels
+
+
+async def score_chunk(llm, limiter, chunk, max_retries=SENTIMENT_MAX_RETRIES, backoff=SENTIMENT_BACKOFF):
+    '''
+    Description: This function scores one chunk, retrying with an exponential backoff on failures and malformed answers.
+
+    Args:
+    llm: The chat model.
+    limiter (LLMLimiter): The global limit on the concurrent LLM calls.
+    chunk (list): The (index, text) pairs to score.
+    max_retries (int): The number of retries after the first attempt.
+    backoff (float): The delay in seconds before the first retry, doubled on every retry.
+
+    Returns:
+    list: The labels of the chunk.
+    '''
+    prompt = build_prompt(chunk)
+    for attempt in range(max_retries + 1):
+        try:
+            return parse_labels(await limiter.invoke(llm, prompt), len(chunk))
+        except Exception:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def score_chunks(llm, limiter, chunks, parallelism):
+    '''
+    Description: This function scores the chunks concurrently, at most `parallelism` of them at a time.
+
+    Args:
+    llm: The chat model.
+    limiter (LLMLimiter): The global limit on the concurrent LLM calls.
+    chunks (list): The chunks of (index, text) pairs.
+    parallelism (int): The maximum number of concurrent LLM calls of this column.
+
+    Returns:
+    list: The labels of each chunk, or the exception raised scoring it.
+    '''
+    slots = asyncio.Semaphore(max(1, parallelism))
+
+    async def score(chunk):
+        async with slots:
+            return await score_chunk(llm, limiter, chunk)
+
+    return await asyncio.gather(*(score(chunk) for chunk in chunks), return_exceptions=True)
+
+
+def score_texts(llm, limiter, texts, parallelism=SENTIMENT_PARALLELISM):
+    '''
+    Description: This function scores every text, sending the chunks concurrently through the global LLM limiter. A chunk failing after its retries does not discard the others: its rows are left unlabelled.
+
+    Args:
+    llm: The chat model.
+    limiter (LLMLimiter): The global limit on the concurrent LLM calls.
+    texts (pd.Series): The texts to score, indexed like the DataFrame.
+    parallelism (int): The maximum number of concurrent LLM calls of this column.
+
+    Returns:
+    pd.Series: The labels, aligned to the index of `texts`, None for the rows of the failed chunks. Its `attrs["error"]` describes the failures, if any.
+    '''
+    chunks = chunk_texts(texts)
+    if not chunks:
+        return pd.Series(index=texts.index, dtype=object)
+
+    labels, errors = {}, []
+    for chunk, outcome in zip(chunks, run_on_event_loop(score_chunks(llm, limiter, chunks, parallelism))):
+        if isinstance(outcome, BaseException):
+            errors.append(outcome)
+        else:
+            labels.update(zip((index for index, _ in chunk), outcome))
+    scored = pd.Series(labels, dtype=object).reindex(texts.index)
+    if errors:
+        detail = getattr(errors[0], "detail", None) or str(errors[0])
+        scored.attrs["error"] = f"Sentiment scoring failed for {len(errors)} of {len(chunks)} chunks: {detail}"
+    return scored
+
+
+POSITIVE_WORDS = {
+    "good", "great", "excellent", "amazing", "awesome", "fantastic", "love", "loved", "like", "liked", "happy", "satisfied",
+    "recommend", "recommended", "useful", "helpful", "easy", "fast", "quick", "friendly", "comfortable", "stylish", "durable",
+    "reliable", "perfect", "best", "better", "nice", "pleasant", "smooth", "exceeded", "worth", "value", "definitely", "well",
+    "impressive", "responsive", "affordable", "superb", "wonderful", "efficient", "convenient", "special",
+}
+NEGATIVE_WORDS = {
+    "bad", "terrible", "awful", "horrible", "poor", "worst", "worse", "hate", "hated", "broken", "damaged", "defective",
+    "late", "slow", "difficult", "hard", "wrong", "incorrect", "misleading", "cheap", "bugs", "buggy", "unresponsive",
+    "disappointed", "disappointing", "below", "issue", "issues", "problem", "problems", "short", "inconvenience",
+    "expensive", "useless", "rude", "delay", "delayed", "missing", "faulty", "complaint", "annoying", "unhappy", "fail", "failed",
+}
+POLARITY = {**{word: 1 for word in POSITIVE_WORDS}, **{word: -1 for word in NEGATIVE_WORDS}}
+NEGATIONS = {"not", "no", "never", "nothing", "hardly", "without", "isn't", "wasn't", "don't", "doesn't", "didn't", "won't", "cannot", "can't"}
+
+
+class SentimentBackend(ABC):
+    '''
+    Description: Interface of the sentiment backends. `score` labels a whole column of texts, `version` tags the labels in the sentiment cache.
+    '''
+    name = None
+    cacheable = True
+
+    @abstractmethod
+    def version(self):
+        ...
+
+    @abstractmethod
+    def score(self, texts):
+        ...
+
+
+class LLMSentimentBackend(SentimentBackend):
+    '''
+    Description: High-accuracy backend labelling the texts with the chat model, in concurrent token-budgeted chunks.
+    '''
+    name = "llm"
+
+    def __init__(self, llm, limiter):
+        self.llm = llm
+        self.limiter = limiter
+
+    def version(self):
+        return cache_version(self.llm)
+
+    def score(self, texts):
+        return score_texts(self.llm, self.limiter, texts)
+
+
+class LexiconSentimentBackend(SentimentBackend):
+    '''
+    Description: CPU-only backend counting positive and negative words (a negation just before a word flips it). It needs no network and scores a whole column in one vectorized pass, so it is not worth caching.
+    '''
+    name = "lexicon"
+    cacheable = False
+
+    def version(self):
+        return f"lexicon:{len(POSITIVE_WORDS)}:{len(NEGATIVE_WORDS)}"
+
+    def score(self, texts):
+        words = texts.reset_index(drop=True).str.lower().str.findall(r"[a-z']+").explode()
+        polarity = words.map(POLARITY).fillna(0).astype(int)
+        negated = words.groupby(level=0).shift(1).isin(NEGATIONS)
+        totals = polarity.where(~negated, -polarity).groupby(level=0).sum().reindex(range(len(texts)), fill_value=0)
+        labels = np.select([totals > 0, totals < 0], ["Positive", "Negative"], default="Neutral")
+        return pd.Series(labels, index=texts.index, dtype=object)
+
+
+def get_backend(name, llm, limiter):
+    '''
+    Description: This function returns the sentiment backend selected by name.
+
+    Args:
+    name (str): The name of the backend ('llm' or 'lexicon'), None for the SENTIMENT_BACKEND setting.
+    llm: The chat model used by the LLM backend.
+    limiter (LLMLimiter): The global limit on the concurrent LLM calls, used by the LLM backend.
+
+    Returns:
+    SentimentBackend: The backend.
+    '''
+    name = (name or SENTIMENT_BACKEND).lower()
+    if name == LLMSentimentBackend.name:
+        return LLMSentimentBackend(llm, limiter)
+    if name == LexiconSentimentBackend.name:
+        return LexiconSentimentBackend()
+    raise HTTPException(status_code=400, detail=f"Unknown sentiment backend '{name}'. Choose from ['llm', 'lexicon'].")
+
+
+def cache_version(llm):
+    '''
+    Description: This function returns the version tag of the cached labels, made of the model name and the prompt version.
+
+    Args:
+    llm: The chat model.
+
+    Returns:
+    str: The version tag.
+    '''
+    return f"{getattr(llm, 'model_name', type(llm).__name__)}:prompt-v{PROMPT_VERSION}"
+
+
+def score_texts_cached(backend, texts, cache=sentiment_cache):
+    '''
+    Description: This function scores every text, only sending to the backend the distinct texts missing from the sentiment cache.
+
+    Args:
+    backend (SentimentBackend): The sentiment backend.
+    texts (pd.Series): The texts to score, indexed like the DataFrame.
+    cache (SentimentCache): The cache of the labels.
+
+    Returns:
+    tuple: The labels aligned to the index of `texts`, and a dictionary with the number of rows served from the cache and newly scored.
+    '''
+    if not backend.cacheable:
+        return backend.score(texts), {"cache_hits": 0, "newly_scored": int(len(texts))}
+
+    version = backend.version()
+    hashes = texts.map(text_hash)
+    cached = cache.get_many(hashes.unique(), version)
+    hit = hashes.isin(cached.keys())
+
+    misses = texts[~hit]
+    unique_misses = misses[~hashes[~hit].duplicated()]
+    scored = backend.score(unique_misses)
+    new_labels = {key: label for key, label in zip(hashes[unique_misses.index], scored) if isinstance(label, str)}
+    if new_labels:
+        cache.put_many(new_labels, version)
+    # The labels scored before a failure stay cached, so a retry only pays for the failed texts
+    if scored.attrs.get("error"):
+        raise HTTPException(status_code=502, detail=scored.attrs["error"])
+
+    labels = hashes.map({**cached, **new_labels})
+    return labels, {"cache_hits": int(hit.sum()), "newly_scored": int(len(misses))}
@@ -0,0 +1,123 @@
+# Persistent cache of the sentiment label of each text, keyed by the hash of the text and a version tag of the model and prompt.
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SENTIMENT_CACHE_PATH = os.getenv("SENTIMENT_CACHE_PATH", "./uploads/sentiment_cache.sqlite3")
+SENTIMENT_CACHE_MAX_ROWS = int(os.getenv("SENTIMENT_CACHE_MAX_ROWS", 1000000))
+# SQLite limits the number of parameters of a statement
+BATCH_SIZE = 500
+
+
+def text_hash(text):
+    '''
+    Description: This function hashes a text for the cache key.
+
+    Args:
+    text (str): The text.
+
+    Returns:
+    str: The hex digest of the text.
+    '''
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class SentimentCache:
+    '''
+    Description: SQLite store mapping (text hash, version) to a sentiment label. Once the store holds more than `max_rows` labels, the least recently used ones are evicted.
+    '''
+
+    def __init__(self, path=SENTIMENT_CACHE_PATH, max_rows=SENTIMENT_CACHE_MAX_ROWS):
+        self.path = path
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        # The database is created on first use, importing the module leaves the disk untouched
+        self._ready = False
+
+    @contextmanager
+    def _connect(self):
+        if not self._ready:
+            self._create()
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _create(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS labels ("
+                    "text_hash TEXT NOT NULL, version TEXT NOT NULL, label TEXT NOT NULL, last_used REAL NOT NULL, "
+                    "PRIMARY KEY (text_hash, version))"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS labels_last_used ON labels (last_used)")
+        finally:
+            conn.close()
+        self._ready = True
+
+    def get_many(self, hashes, version):
+        '''
+        Description: This function looks up the labels of several texts and marks them as recently used.
+
+        Args:
+        hashes (list): The hashes of the texts.
+        version (str): The version tag of the model and prompt.
+
+        Returns:
+        dict: The labels found, keyed by text hash.
+        '''
+        hashes = list(hashes)
+        found = {}
+        with self._lock, self._connect() as conn:
+            for start in range(0, len(hashes), BATCH_SIZE):
+                batch = hashes[start:start + BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT text_hash, label FROM labels WHERE version = ? AND text_hash IN ({placeholders})",
+                    [version, *batch],
+                ).fetchall()
+                found.update(rows)
+            now = time.time()
+            conn.executemany(
+                "UPDATE labels SET last_used = ? WHERE text_hash = ? AND version = ?",
+                [(now, text_hash, version) for text_hash in found],
+            )
+        return found
+
+    def put_many(self, labels, version):
+        '''
+        Description: This function stores the labels of several texts, then evicts the least recently used labels if the store is over its size.
+
+        Args:
+        labels (dict): The labels keyed by text hash.
+        version (str): The version tag of the model and prompt.
+
+        Returns:
+        None
+        '''
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO labels (text_hash, version, label, last_used) VALUES (?, ?, ?, ?)",
+                [(text_hash, version, label, now) for text_hash, label in labels.items()],
+            )
+            count = conn.execute("SELECT COUNT(*) FROM labels").fetchone()[0]
+            if count > self.max_rows:
+                conn.execute(
+                    "DELETE FROM labels WHERE rowid IN (SELECT rowid FROM labels ORDER BY last_used LIMIT ?)",
+                    (count - self.max_rows,),
+                )
+
+
+sentiment_cache = SentimentCache()
@@ -0,0 +1,167 @@
+# Streaming and paginated serialization of the DataFrame results, so that large results are never turned into millions of Python dicts at once.
+
+import base64
+import io
+import json
+import os
+
+import pyarrow as pa
+from fastapi import HTTPException
+
+from out_of_core import ChunkedDataset
+
+RESULT_BATCH_ROWS = int(os.getenv("RESULT_BATCH_ROWS", 10000))
+FORMATS = ("json", "ndjson", "arrow")
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def to_records(df):
+    '''
+    Description: This function converts a DataFrame into JSON-safe records, missing values (e.g. the unmatched rows of a left join) becoming None.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The DataFrame to convert, typically a page.
+
+    Returns:
+    list: The records of the DataFrame.
+    '''
+    if isinstance(df, ChunkedDataset):
+        df = df.to_pandas()
+    if df.isna().to_numpy().any():
+        df = df.astype(object).where(df.notna(), None)
+    return df.to_dict(orient="records")
+
+
+def batches(df, batch_rows=RESULT_BATCH_ROWS):
+    '''
+    Description: This function splits a DataFrame, or a ChunkedDataset read from disk, into batches of rows.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The rows.
+    batch_rows (int): The number of rows per batch, at most a chunk of a ChunkedDataset so that a batch stays within the memory budget.
+
+    Yields:
+    pd.DataFrame: The rows of a batch.
+    '''
+    if isinstance(df, ChunkedDataset):
+        if len(df):
+            yield from df.iter_chunks(batch_rows=batch_rows)
+        return
+    for start in range(0, len(df), batch_rows):
+        yield df.iloc[start:start + batch_rows]
+
+
+def iter_ndjson(df, batch_rows=RESULT_BATCH_ROWS):
+    '''
+    Description: This function streams a DataFrame as newline-delimited JSON, one batch of rows at a time.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The DataFrame to stream.
+    batch_rows (int): The number of rows serialized at a time.
+
+    Yields:
+    bytes: The NDJSON lines of a batch.
+    '''
+    for batch in batches(df, batch_rows):
+        chunk = batch.to_json(orient="records", lines=True, date_format="iso")
+        yield (chunk if chunk.endswith("\n") else chunk + "\n").encode("utf-8")
+
+
+def iter_arrow(df, batch_rows=RESULT_BATCH_ROWS):
+    '''
+    Description: This function streams a DataFrame in the Arrow IPC streaming format, one record batch at a time. Like the JSON records, the index is not included. The record batches of a ChunkedDataset are streamed from disk as they are stored.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The DataFrame to stream.
+    batch_rows (int): The number of rows per record batch.
+
+    Yields:
+    bytes: The schema message, then each record batch, then the end-of-stream marker.
+    '''
+    if isinstance(df, ChunkedDataset):
+        schema = df.table.schema.remove_metadata()
+        records = (batch.replace_schema_metadata(None) for batch in df.table.to_batches(max_chunksize=batch_rows))
+    else:
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        records = (pa.RecordBatch.from_pandas(batch, schema=schema, preserve_index=False) for batch in batches(df, batch_rows))
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in records:
+            writer.write_batch(batch)
+            yield drain(sink)
+    yield drain(sink)
+
+
+def drain(sink):
+    '''
+    Description: This function returns the bytes written to a buffer so far and empties it.
+
+    Args:
+    sink (io.BytesIO): The buffer.
+
+    Returns:
+    bytes: The buffered bytes.
+    '''
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def encode_cursor(version_id, offset, limit):
+    '''
+    Description: This function builds the opaque cursor pointing at the next page of a result.
+
+    Args:
+    version_id (str): The dataset version holding the result.
+    offset (int): The first row of the next page.
+    limit (int): The number of rows per page.
+
+    Returns:
+    str: The cursor.
+    '''
+    payload = json.dumps({"v": version_id, "o": offset, "l": limit}).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor):
+    '''
+    Description: This function reads a cursor built by encode_cursor.
+
+    Args:
+    cursor (str): The cursor.
+
+    Returns:
+    tuple: The version ID, the offset and the limit.
+    '''
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return payload["v"], int(payload["o"]), int(payload["l"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+
+def paginate(df, version_id, limit=None, offset=0):
+    '''
+    Description: This function selects a page of a result.
+
+    Args:
+    df (pd.DataFrame or ChunkedDataset): The result.
+    version_id (str): The dataset version holding the result.
+    limit (int): The number of rows of the page, None for all the rows from `offset`.
+    offset (int): The first row of the page.
+
+    Returns:
+    tuple: The page and the cursor of the next page (None on the last page).
+    '''
+    if offset < 0 or (limit is not None and limit <= 0):
+        raise HTTPException(status_code=400, detail="'offset' must be positive and 'limit' strictly positive.")
+    end = len(df) if limit is None else min(offset + limit, len(df))
+    next_cursor = encode_cursor(version_id, end, limit) if end < len(df) else None
+    if isinstance(df, ChunkedDataset):
+        # The page of a chunked result is read from disk when it is serialized
+        return df.slice(offset, max(end - offset, 0)), next_cursor
+    return df.iloc[offset:end], next_cursor
@@ -0,0 +1,105 @@
+# Columnar (Arrow IPC / Feather) snapshots of the uploaded workbook sheets, so that reloads do not go back to openpyxl.
+
+import os
+import re
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# Snapshots are kept in this directory next to their workbook, so that the workbooks of different datasets never share a snapshot
+SNAPSHOT_DIRECTORY = "snapshots"
+SOURCE_HASH_KEY = b"excel_ai_engine.source_hash"
+# Set on the snapshots of the sheets ingested out of core, which are read in chunks instead of loaded (see out_of_core)
+CHUNKED_KEY = b"excel_ai_engine.chunked"
+# Rows per record batch of a snapshot, so that readers can map and convert it one row group at a time
+SNAPSHOT_BATCH_ROWS = int(os.getenv("SNAPSHOT_BATCH_ROWS", 65536))
+
+
+def snapshot_path(xlsx_path, sheet_name):
+    '''
+    Description: This function returns the path of the snapshot of a sheet of a workbook.
+
+    Args:
+    xlsx_path (str): The path of the workbook.
+    sheet_name (str or int): The name or the position of the sheet.
+
+    Returns:
+    str: The path of the snapshot file.
+    '''
+    stem = os.path.splitext(os.path.basename(xlsx_path))[0]
+    sheet = re.sub(r'\W', '_', str(sheet_name))
+    return os.path.join(os.path.dirname(xlsx_path), SNAPSHOT_DIRECTORY, f"{stem}__{sheet}.feather")
+
+
+def write_snapshot(xlsx_path, sheet_name, df, source_hash):
+    '''
+    Description: This function writes a sheet to an uncompressed Feather file, tagged with the hash of the workbook it was parsed from.
+    Uncompressed files can be memory-mapped when they are read back.
+
+    Args:
+    xlsx_path (str): The path of the workbook.
+    sheet_name (str or int): The name or the position of the sheet.
+    df (pd.DataFrame): The parsed sheet.
+    source_hash (str): The content hash of the workbook.
+
+    Returns:
+    str: The path of the snapshot, or None if the sheet could not be converted to Arrow.
+    '''
+    path = snapshot_path(xlsx_path, sheet_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError) as e:
+        # Mixed-type object columns cannot be stored, the workbook stays the source of truth.
+        print(f"Skipping snapshot of {xlsx_path} [{sheet_name}]: {e}")
+        return None
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[SOURCE_HASH_KEY] = source_hash.encode()
+    table = table.replace_schema_metadata(metadata)
+
+    tmp_path = path + ".tmp"
+    feather.write_feather(table, tmp_path, compression="uncompressed", chunksize=SNAPSHOT_BATCH_ROWS)
+    os.replace(tmp_path, path)
+    return path
+
+
+def open_snapshot(xlsx_path, sheet_name, source_hash):
+    '''
+    Description: This function memory-maps the snapshot of a sheet if it exists and was written from the same workbook content.
+
+    Args:
+    xlsx_path (str): The path of the workbook.
+    sheet_name (str or int): The name or the position of the sheet.
+    source_hash (str): The content hash of the workbook currently on disk.
+
+    Returns:
+    pa.Table: The memory-mapped sheet, or None if the snapshot is missing or stale.
+    '''
+    path = snapshot_path(xlsx_path, sheet_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        table = feather.read_table(path, memory_map=True)
+    except (pa.ArrowInvalid, OSError) as e:
+        print(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+
+    metadata = table.schema.metadata or {}
+    if metadata.get(SOURCE_HASH_KEY) != source_hash.encode():
+        return None
+    return table
+
+
+def is_chunked(table):
+    '''
+    Description: This function tells whether a snapshot was written by the out-of-core ingestion.
+
+    Args:
+    table (pa.Table): The memory-mapped snapshot.
+
+    Returns:
+    bool: Whether the sheet is read in chunks.
+    '''
+    return (table.schema.metadata or {}).get(CHUNKED_KEY) == b"1"
+
@@ -0,0 +1,13 @@
+import pandas as pd
+
+import column_index
+
+
+def test_shared_selections_are_not_reused_across_frames():
+    with column_index.shared_selections():
+        for step in range(50):
+            # Transient frames, freed after each call, like the intermediate results of a plan
+            df = pd.DataFrame({"Department": ["HR", "IT"] * 5, "Step": [step] * 10})
+            rows = column_index.select(df, "Department", "HR")
+            assert rows["Step"].tolist() == [step] * 5
+            del df, rows
@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ.setdefault("OUT_OF_CORE_SPILL_DIRECTORY", tempfile.mkdtemp(prefix="excel_ai_spill_"))
+
+import pandas as pd
+
+import excel_functions
+import out_of_core
+
+
+def test_filter_with_no_match_in_first_chunk(tmp_path, monkeypatch):
+    path = tmp_path / "workbook.xlsx"
+    pd.DataFrame({
+        "ID": range(1, 201),
+        "Department": ["HR", "IT", "Sales", "Marketing"] * 50,
+        "Salary": [30000 + 100 * i for i in range(200)],
+    }).to_excel(path, index=False)
+    monkeypatch.setattr(out_of_core, "OUT_OF_CORE_MEMORY_BUDGET", 20000)
+    ds = out_of_core.ingest_workbook(str(path), [0], "hash")[0][0]
+    assert ds.chunk_rows() < len(ds)
+
+    # Only the last row matches, every chunk before it is empty
+    result = excel_functions.filter_data(ds, "ID", 200)
+
+    assert isinstance(result, out_of_core.ChunkedDataset)
+    assert result.to_pandas().to_dict("records") == [{"ID": 200, "Department": "Marketing", "Salary": 49900}]
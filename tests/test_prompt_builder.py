@@ -0,0 +1,19 @@
+import pandas as pd
+
+import dtype_optimizer
+import prompt_builder
+
+
+def test_relevant_functions_on_categorical_text_columns():
+    df = pd.DataFrame({
+        "ID": range(1, 101),
+        "Department": ["HR", "IT", "Sales", "Marketing"] * 25,
+        "Salary": [30000 + 100 * i for i in range(100)],
+    })
+    optimized, _ = dtype_optimizer.optimize_dtypes(df)
+    assert isinstance(optimized["Department"].dtype, pd.CategoricalDtype)
+
+    query = "employees with department HR"
+    expected = prompt_builder.relevant_functions(df, [query])
+    assert expected == ["filter_data", "get_sentiment"]
+    assert prompt_builder.relevant_functions(optimized, [query]) == expected
@@ -0,0 +1,253 @@
+# Cache of the LLM translations of user queries into excel_functions calls.
+
+import atexit
+import difflib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", 1024))
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", 24 * 60 * 60))
+# Optional JSON file used to keep the translations across restarts.
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH") or None
+# Minimum similarity ratio (0-1) to reuse the translation of a close query, 0 disables the similarity mode.
+TRANSLATION_CACHE_SIMILARITY = float(os.getenv("TRANSLATION_CACHE_SIMILARITY", 0))
+# Delay in seconds before the changed translations are written to TRANSLATION_CACHE_PATH, the writes of that window are batched
+TRANSLATION_CACHE_FLUSH_SECONDS = float(os.getenv("TRANSLATION_CACHE_FLUSH_SECONDS", 5))
+
+LITERAL_PATTERN = re.compile(r"'([^']*)'|\"([^\"]*)\"|\b(\d+(?:\.\d+)?)\b")
+WORD_PATTERN = re.compile(r"\w+(?:\.\d+)?")
+
+
+def normalize_query(query):
+    '''
+    Description: This function normalizes a query so that trivial differences (case, spacing, trailing punctuation) hit the same cache entry.
+
+    Args:
+    query (str): The query provided by the user.
+
+    Returns:
+    str: The normalized query.
+    '''
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.strip(" .?!")
+
+
+def schema_key(columns):
+    '''
+    Description: This function builds the part of the cache key describing the dataset columns.
+
+    Args:
+    columns (iterable): The columns of the dataset.
+
+    Returns:
+    str: The schema key.
+    '''
+    return "|".join(str(col) for col in columns)
+
+
+def call_literals(function_call_str):
+    '''
+    Description: This function extracts the string and number literals of a function call.
+
+    Args:
+    function_call_str (str): The function call generated by the LLM.
+
+    Returns:
+    set: The lower-cased literals.
+    '''
+    return {
+        next(group for group in match if group).lower()
+        for match in LITERAL_PATTERN.findall(function_call_str)
+        if any(match)
+    }
+
+
+class TranslationCache:
+    '''
+    Description: LRU cache with a TTL of the function calls returned by the LLM, keyed by the normalized query and the dataset columns.
+    In the similarity mode, a query close enough to a cached one reuses its translation as long as every literal of the cached call that was spelled out in the cached query is also spelled out in the new one, so "average salary in IT" never answers "average salary in HR".
+    '''
+
+    def __init__(self, max_size=TRANSLATION_CACHE_SIZE, ttl=TRANSLATION_CACHE_TTL, path=TRANSLATION_CACHE_PATH, similarity=TRANSLATION_CACHE_SIMILARITY, flush_seconds=TRANSLATION_CACHE_FLUSH_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.similarity = similarity
+        self.flush_seconds = flush_seconds
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        # Serializes the writes of the file, which are made outside of _lock
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._timer = None
+        self._load()
+
+    def get(self, query, columns):
+        '''
+        Description: This function returns the cached translation of a query, if any.
+
+        Args:
+        query (str): The query provided by the user.
+        columns (iterable): The columns of the dataset.
+
+        Returns:
+        str: The cached function call, or None on a miss.
+        '''
+        key = (schema_key(columns), normalize_query(query))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl:
+                self._entries.pop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if self.similarity > 0:
+                match = self._closest(key, query, now)
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.similar_hits += 1
+                    return self._entries[match][0]
+
+            self.misses += 1
+            return None
+
+    def put(self, query, columns, function_call_str):
+        '''
+        Description: This function stores the translation of a query.
+
+        Args:
+        query (str): The query provided by the user.
+        columns (iterable): The columns of the dataset.
+        function_call_str (str): The function call returned by the LLM.
+
+        Returns:
+        None
+        '''
+        key = (schema_key(columns), normalize_query(query))
+        with self._lock:
+            self._entries[key] = (function_call_str, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._mark_dirty()
+
+    def discard(self, query, columns):
+        '''
+        Description: This function drops the translation of a query, e.g. when the cached call failed to execute.
+
+        Args:
+        query (str): The query provided by the user.
+        columns (iterable): The columns of the dataset.
+
+        Returns:
+        None
+        '''
+        key = (schema_key(columns), normalize_query(query))
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._mark_dirty()
+
+    def flush(self):
+        '''
+        Description: This function writes the translations to TRANSLATION_CACHE_PATH if they changed since the last write. It is called by the flush timer and at shutdown.
+
+        Args:
+        None
+
+        Returns:
+        None
+        '''
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                records = [[schema, normalized, call, created] for (schema, normalized), (call, created) in self._entries.items()]
+            try:
+                self._save(records)
+            except OSError as e:
+                print(f"Could not save the translation cache {self.path}: {e}")
+                with self._lock:
+                    self._mark_dirty()
+
+    def stats(self):
+        '''
+        Description: This function returns the hit/miss counters of the cache.
+
+        Args:
+        None
+
+        Returns:
+        dict: The cache statistics.
+        '''
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+    def _closest(self, key, query, now):
+        schema, normalized = key
+        words = set(WORD_PATTERN.findall(query.lower()))
+        best, best_ratio = None, self.similarity
+        for candidate, (_, created) in self._entries.items():
+            if candidate[0] != schema or now - created > self.ttl:
+                continue
+            ratio = difflib.SequenceMatcher(None, normalized, candidate[1]).ratio()
+            if ratio < best_ratio:
+                continue
+            cached_words = set(WORD_PATTERN.findall(candidate[1]))
+            literals = [set(WORD_PATTERN.findall(literal)) for literal in call_literals(self._entries[candidate][0])]
+            if all(literal <= words for literal in literals if literal <= cached_words):
+                best, best_ratio = candidate, ratio
+        return best
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                records = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring translation cache {self.path}: {e}")
+            return
+        for schema, normalized, function_call_str, created in records[-self.max_size:]:
+            self._entries[(schema, normalized)] = (function_call_str, created)
+
+    def _mark_dirty(self):
+        # Called with _lock held: the file is written by a timer, so the requests never wait for it
+        if not self.path:
+            return
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_seconds, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _save(self, records):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(records, f)
+        os.replace(tmp_path, self.path)
+
+
+translation_cache = TranslationCache()
+atexit.register(translation_cache.flush)
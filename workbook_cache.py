@@ -0,0 +1,210 @@
+# In-memory cache of the parsed sheets of the uploaded workbooks.
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+import dtype_optimizer
+import out_of_core
+import snapshot
+
+WORKBOOK_CACHE_MAX_BYTES = int(os.getenv("WORKBOOK_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Engine used to parse the workbooks, e.g. 'calamine' (needs python-calamine) or 'openpyxl' (pandas opens it read-only).
+EXCEL_ENGINE = os.getenv("EXCEL_ENGINE") or None
+
+
+def file_hash(path):
+    '''
+    Description: This function computes the SHA-256 hash of a file without loading it fully in memory.
+
+    Args:
+    path (str): The path of the file.
+
+    Returns:
+    str: The hex digest of the file content.
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_workbook(path, sheet_names, engine=None):
+    '''
+    Description: This function parses several sheets of a workbook in a single pass, the zip archive is opened and decompressed only once.
+
+    Args:
+    path (str): The path of the workbook.
+    sheet_names (list): The names or the positions of the sheets to parse.
+    engine (str): The engine used to parse the workbook. Default is the EXCEL_ENGINE setting.
+
+    Returns:
+    tuple: A dictionary of the parsed sheets, in compact dtypes, keyed like `sheet_names`, a dictionary of the parse time in seconds and a dictionary of the memory report of dtype_optimizer, both keyed by the sheet name.
+    '''
+    frames = {}
+    timings = {}
+    memory = {}
+    with pd.ExcelFile(path, engine=engine or EXCEL_ENGINE) as workbook:
+        for sheet in sheet_names:
+            start = time.perf_counter()
+            name = workbook.sheet_names[sheet] if isinstance(sheet, int) else sheet
+            frames[sheet], memory[name] = dtype_optimizer.optimize_dtypes(workbook.parse(sheet))
+            timings[name] = round(time.perf_counter() - start, 4)
+    return frames, timings, memory
+
+
+class WorkbookCache:
+    '''
+    Description: LRU cache of parsed sheets keyed by the content hash of the workbook and the sheet name.
+    The cache is bounded by the approximate memory used by the cached DataFrames.
+    '''
+
+    def __init__(self, max_bytes=WORKBOOK_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._path_hashes = {}
+        self._lock = threading.RLock()
+
+    def content_hash(self, path):
+        '''
+        Description: This function returns the content hash of a file. The hash is only recomputed when the size or the modification time of the file changes.
+
+        Args:
+        path (str): The path of the workbook.
+
+        Returns:
+        str: The content hash of the workbook.
+        '''
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._path_hashes.get(path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+        digest = file_hash(path)
+        with self._lock:
+            self._path_hashes[path] = (signature, digest)
+        return digest
+
+    def remember_hash(self, path, digest):
+        '''
+        Description: This function records the content hash of a file computed while it was written, so that it is not read again to hash it.
+
+        Args:
+        path (str): The path of the file.
+        digest (str): The SHA-256 hex digest of its content.
+
+        Returns:
+        None
+        '''
+        stat = os.stat(path)
+        with self._lock:
+            self._path_hashes[path] = ((stat.st_mtime_ns, stat.st_size), digest)
+
+    def get(self, path, sheet_name=0):
+        '''
+        Description: This function returns a parsed sheet. On a cache miss the sheet is memory-mapped from its snapshot, and the workbook is only parsed when the snapshot is missing or stale. The sheets ingested out of core are returned as ChunkedDatasets reading their snapshot.
+
+        Args:
+        path (str): The path of the workbook.
+        sheet_name (str or int): The sheet to read. Default is the first sheet.
+
+        Returns:
+        pd.DataFrame or ChunkedDataset: The cached sheet itself. Operations never mutate their input, so the sheet can be shared and what is derived from it (e.g. join indexes) stays cached with it.
+        '''
+        key = (self.content_hash(path), sheet_name)
+        with self._lock:
+            df = self._entries.get(key)
+            if df is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return df
+            self.misses += 1
+
+        table = snapshot.open_snapshot(path, sheet_name, key[0])
+        if table is not None and snapshot.is_chunked(table):
+            df = out_of_core.ChunkedDataset(table, snapshot.snapshot_path(path, sheet_name))
+        elif table is not None:
+            df = table.to_pandas(split_blocks=True)
+        elif out_of_core.wants_chunks(path):
+            df = out_of_core.ingest_workbook(path, [sheet_name], key[0])[0][sheet_name]
+        else:
+            df = parse_workbook(path, [sheet_name])[0][sheet_name]
+            snapshot.write_snapshot(path, sheet_name, df, key[0])
+        self.put(path, sheet_name, df)
+        return df
+
+    def put(self, path, sheet_name, df, write_snapshot=False):
+        '''
+        Description: This function stores an already parsed sheet in the cache and evicts the least recently used sheets if the cache is over its memory budget.
+
+        Args:
+        path (str): The path of the workbook the sheet was read from.
+        sheet_name (str or int): The name of the sheet.
+        df (pd.DataFrame or ChunkedDataset): The parsed sheet.
+        write_snapshot (bool): Whether to also write the columnar snapshot of the sheet. Default is False.
+
+        Returns:
+        None
+        '''
+        key = (self.content_hash(path), sheet_name)
+        if write_snapshot:
+            snapshot.write_snapshot(path, sheet_name, df, key[0])
+        # The rows of a ChunkedDataset stay on disk, it does not count against the memory budget
+        size = 0 if isinstance(df, out_of_core.ChunkedDataset) else int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = df
+            self._sizes[key] = size
+            while len(self._entries) > 1 and sum(self._sizes.values()) > self.max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._sizes.pop(old_key, None)
+
+    def invalidate(self, path):
+        '''
+        Description: This function drops every cached sheet of a workbook. It is called before the workbook is replaced on disk.
+
+        Args:
+        path (str): The path of the workbook.
+
+        Returns:
+        None
+        '''
+        with self._lock:
+            cached = self._path_hashes.pop(path, None)
+            if cached is None:
+                return
+            for key in [key for key in self._entries if key[0] == cached[1]]:
+                self._entries.pop(key)
+                self._sizes.pop(key, None)
+
+    def stats(self):
+        '''
+        Description: This function returns the hit/miss counters and the current size of the cache.
+
+        Args:
+        None
+
+        Returns:
+        dict: The cache statistics.
+        '''
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": sum(self._sizes.values()),
+                "max_bytes": self.max_bytes,
+            }
+
+
+workbook_cache = WorkbookCache()
@@ -0,0 +1,55 @@
+# Worker pool running the CPU-bound work (pandas operations, parsing, prompt building) off the event loop.
+
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from fastapi import HTTPException
+
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", os.cpu_count() or 4))
+EXECUTION_TIMEOUT = float(os.getenv("EXECUTION_TIMEOUT", 120))
+
+# Dedicated executor for the pandas work, so that it does not compete with the event loop or with FastAPI's default threadpool
+executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="excel-worker")
+
+# The event loop of the request running the work, so that the work can send its async calls (e.g. LLM calls) to it
+_event_loop = ContextVar("event_loop", default=None)
+
+
+async def run_in_worker(func, *args):
+    '''
+    Description: This function runs CPU-bound work in the dedicated executor, without blocking the event loop.
+
+    Args:
+    func (callable): The function to run.
+    args: The arguments of the function.
+
+    Returns:
+    The output of the function.
+    '''
+    loop = asyncio.get_running_loop()
+    # The work runs in a copy of the request context, so that its timing spans are added to the profile of the request
+    context = contextvars.copy_context()
+    context.run(_event_loop.set, loop)
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(executor, context.run, func, *args), timeout=EXECUTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"The operation did not finish within {EXECUTION_TIMEOUT} seconds.")
+
+
+def run_on_event_loop(coroutine):
+    '''
+    Description: This function runs a coroutine from the work running in the executor, on the event loop of its request, and waits for its result. Outside of a request (e.g. a script calling the operations directly) the coroutine runs on a new event loop.
+
+    Args:
+    coroutine: The coroutine to run.
+
+    Returns:
+    The result of the coroutine.
+    '''
+    loop = _event_loop.get()
+    if loop is None or loop.is_closed():
+        return asyncio.run(coroutine)
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()